@@ -0,0 +1,255 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import subprocess
+import tempfile
+import numpy as np
+import cv2
+import torch
+from profiler import profiler
+
+# Benchmarks for the propagation, rendering and export hot paths. Everything runs on
+# synthetic frames with a deterministic fake predictor, so no GPU, network or
+# checkpoint is needed. Run from the ui/ directory:
+#
+#   python benchmark.py --frames 100 500 --objects 1 8 --size 1920x1080
+#
+# Each (frames, objects) case runs in a fresh subprocess so peak RSS is per case.
+
+STAGES = ('propagate', 'render', 'export')
+
+
+# Stands in for SAM2VideoPredictor and emits moving circular masks as logits
+class FakeVideoPredictor:
+    def __init__(self, radius_fraction=0.08):
+        self.radius_fraction = radius_fraction
+
+    def init_state(self, video_path):
+        frame_names = sorted(f for f in os.listdir(video_path) if f.endswith('.jpg'))
+        height, width = cv2.imread(os.path.join(video_path, frame_names[0])).shape[:2]
+        yy, xx = torch.meshgrid(torch.arange(height, dtype=torch.float32),
+                                torch.arange(width, dtype=torch.float32), indexing='ij')
+        return {
+            'num_frames': len(frame_names),
+            'video_height': height,
+            'video_width': width,
+            'grid': (yy, xx),
+            'obj_ids': [],
+        }
+
+    def reset_state(self, inference_state):
+        inference_state['obj_ids'] = []
+
+    def _logits(self, inference_state, frame_idx, obj_ids):
+        yy, xx = inference_state['grid']
+        height, width = inference_state['video_height'], inference_state['video_width']
+        radius = self.radius_fraction * min(height, width)
+        logits = []
+        for obj_id in obj_ids:
+            phase = (obj_id * 0.37 + frame_idx * 0.005) % 1.0
+            cx = width * (0.1 + 0.8 * phase)
+            cy = height * (0.1 + 0.8 * ((obj_id * 0.61) % 1.0))
+            logits.append(radius ** 2 - ((xx - cx) ** 2 + (yy - cy) ** 2))
+        return torch.stack(logits)[:, None]
+
+    def add_new_points_or_box(self, inference_state, frame_idx, obj_id, points=None, labels=None, box=None, **kwargs):
+        if obj_id not in inference_state['obj_ids']:
+            inference_state['obj_ids'].append(obj_id)
+        obj_ids = list(inference_state['obj_ids'])
+        return frame_idx, obj_ids, self._logits(inference_state, frame_idx, obj_ids)
+
+    def propagate_in_video(self, inference_state, start_frame_idx=None, max_frame_num_to_track=None, reverse=False):
+        num_frames = inference_state['num_frames']
+        start_frame_idx = start_frame_idx or 0
+        if max_frame_num_to_track is None:
+            max_frame_num_to_track = num_frames
+        if reverse:
+            processing_order = range(start_frame_idx, max(start_frame_idx - max_frame_num_to_track, 0) - 1, -1)
+        else:
+            processing_order = range(start_frame_idx, min(start_frame_idx + max_frame_num_to_track, num_frames - 1) + 1)
+        obj_ids = list(inference_state['obj_ids'])
+        for frame_idx in processing_order:
+            yield frame_idx, obj_ids, self._logits(inference_state, frame_idx, obj_ids)
+
+
+def make_frame_folder(root, num_frames, width, height):
+    rng = np.random.default_rng(0)
+    base = np.tile(np.linspace(0, 255, width, dtype=np.uint8), (height, 1))
+    for frame_idx in range(num_frames):
+        noise = rng.integers(0, 32, size=(height, width), dtype=np.uint8)
+        frame = cv2.merge([base, np.roll(base, frame_idx, axis=1), noise])
+        cv2.imwrite(os.path.join(root, f"{frame_idx}.jpg"), frame)
+    return sorted(os.listdir(root), key=lambda f: int(os.path.splitext(f)[0]))
+
+
+def latency_stats(latencies):
+    latencies = np.asarray(latencies, dtype=np.float64) * 1000.0
+    total = latencies.sum() / 1000.0
+    return {
+        'frames': int(latencies.size),
+        'fps': float(latencies.size / total) if total > 0 else None,
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p90_ms': float(np.percentile(latencies, 90)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'max_ms': float(latencies.max()),
+    }
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def make_predictor(video_dir, num_objects):
+    from sam2_predictor import SAM2Predictor
+
+    predictor = SAM2Predictor()
+    predictor.predictor = FakeVideoPredictor()
+    predictor.inference_state = predictor.predictor.init_state(video_dir)
+    for obj_id in range(num_objects):
+        predictor.predictor.add_new_points_or_box(predictor.inference_state, 0, obj_id,
+                                                  points=np.array([[0, 0]]), labels=np.array([1]))
+    return predictor
+
+
+def bench_propagate(video_dir, num_objects, label_maps=False):
+    predictor = make_predictor(video_dir, num_objects)
+    predictor.label_map_mode = label_maps
+    stamps = [time.perf_counter()]
+    video_segments = predictor.propagate_masks(start_frame_idx=0,
+                                               progress_callback=lambda _: stamps.append(time.perf_counter()))
+    return latency_stats(np.diff(stamps)), video_segments, predictor.geometry
+
+
+def bench_render(video_dir, frame_names, video_segments, geometry, num_objects):
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt5.QtWidgets import QApplication
+    from interface import SAM2Interface
+    from ui_utils import get_object_color
+
+    app = QApplication.instance() or QApplication(sys.argv)
+    interface = SAM2Interface()
+    interface.video_dir = video_dir
+    interface.frame_names = frame_names
+    interface.video_segments = video_segments
+    interface.sam2_predictor.geometry = geometry
+    interface.geometry = geometry
+    for obj_id in range(num_objects):
+        interface.object_manager.add_object(obj_id, f"Object {obj_id}", get_object_color(obj_id))
+
+    latencies = []
+    for frame_idx in range(len(frame_names)):
+        start = time.perf_counter()
+        interface.current_frame_idx = frame_idx
+        interface.current_image = cv2.imread(os.path.join(video_dir, frame_names[frame_idx]))
+        interface.update_display(interface.current_image)
+        app.processEvents()
+        latencies.append(time.perf_counter() - start)
+    return latency_stats(latencies)
+
+
+def bench_export(video_dir, frame_names, video_segments, geometry, num_objects):
+    from coco_exporter import COCOExporter
+
+    output_file = os.path.join(os.path.dirname(video_dir), 'benchmark_coco.json')
+    exporter = COCOExporter(output_file)
+    exporter.initialize_categories([{"id": obj_id + 1, "name": f"Object {obj_id}"} for obj_id in range(num_objects)])
+    height, width = cv2.imread(os.path.join(video_dir, frame_names[0])).shape[:2]
+
+    latencies = []
+    for frame_idx, file_name in enumerate(frame_names):
+        start = time.perf_counter()
+        image_id = exporter.add_image(frame_idx, file_name, width, height)
+        for obj_id, mask in video_segments.get(frame_idx, {}).items():
+            exporter.add_annotation(image_id, obj_id + 1, mask, geometry.lookup(frame_idx, obj_id, mask))
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    exporter.update_file()
+    save_seconds = time.perf_counter() - start
+
+    results = latency_stats(latencies)
+    results['save_s'] = save_seconds
+    results['json_bytes'] = os.path.getsize(output_file)
+    return results
+
+
+def run_case(num_frames, num_objects, width, height, stages, label_maps=False):
+    root = tempfile.mkdtemp(prefix='sam2_bench_')
+    try:
+        video_dir = os.path.join(root, 'frames')
+        os.makedirs(video_dir)
+        frame_names = make_frame_folder(video_dir, num_frames, width, height)
+
+        results = {'frames': num_frames, 'objects': num_objects, 'size': f"{width}x{height}"}
+        propagate_stats, video_segments, geometry = bench_propagate(video_dir, num_objects, label_maps)
+        if 'propagate' in stages:
+            results['propagate'] = propagate_stats
+        if 'render' in stages:
+            results['render'] = bench_render(video_dir, frame_names, video_segments, geometry, num_objects)
+        if 'export' in stages:
+            results['export'] = bench_export(video_dir, frame_names, video_segments, geometry, num_objects)
+        results['spans'] = profiler.summary()['spans']
+        results['peak_rss_mb'] = peak_rss_mb()
+        return results
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def print_report(all_results):
+    header = f"{'frames':>7} {'objs':>5} {'stage':>10} {'fps':>9} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'extra':>24}"
+    print(header)
+    print('-' * len(header))
+    for results in all_results:
+        for stage in STAGES:
+            if stage not in results:
+                continue
+            stats = results[stage]
+            extra = ''
+            if stage == 'export':
+                extra = f"{stats['json_bytes'] / 1024:.0f} KiB, save {stats['save_s'] * 1000:.0f} ms"
+            print(f"{results['frames']:>7} {results['objects']:>5} {stage:>10} {stats['fps']:>9.1f} "
+                  f"{stats['p50_ms']:>9.2f} {stats['p90_ms']:>9.2f} {stats['p99_ms']:>9.2f} {extra:>24}")
+        print(f"{'':>7} {'':>5} {'peak RSS':>10} {results['peak_rss_mb']:>9.0f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark SAM2 interface hot paths with a fake predictor.")
+    parser.add_argument('--frames', type=int, nargs='+', default=[50, 200])
+    parser.add_argument('--objects', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--size', default='1280x720', help="Frame size as WIDTHxHEIGHT")
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('--output', help="Write the results as JSON to this file")
+    parser.add_argument('--label-maps', action='store_true', help="Store propagated frames as label maps")
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    width, height = (int(v) for v in args.size.lower().split('x'))
+
+    if args.single:
+        print(json.dumps(run_case(args.frames[0], args.objects[0], width, height, args.stages, args.label_maps)))
+        return
+
+    all_results = []
+    for num_frames in args.frames:
+        for num_objects in args.objects:
+            cmd = [sys.executable, os.path.abspath(__file__), '--single', '--frames', str(num_frames),
+                   '--objects', str(num_objects), '--size', args.size, '--stages', *args.stages]
+            if args.label_maps:
+                cmd.append('--label-maps')
+            output = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+            all_results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print_report(all_results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(all_results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,31 +1,28 @@
-import json
-import numpy as np
-import cv2
 import os
+from profiler import profiler
+from mask_utils import mask_geometry, mask_any, simplify_contours
+from coco_stream import COCOIndex, RawEntry, write_coco
 
 class COCOExporter:
+    # Entries already in the output file stay on disk behind a COCOIndex; only images added
+    # and annotations changed since the last save are held here, and save() streams the
+    # merged file back out one entry at a time
     def __init__(self, output_file, use_existing=False):
         self.output_file = output_file
-        self.coco_data = self.load_existing_data() if use_existing else {
-            "images": [],
-            "annotations": [],
-            "categories": []
-        }
-        # self.annotation_id = max([ann['id'] for ann in self.coco_data['annotations']], default=0)
+        self.source = self.load_existing_data() if use_existing else None
+        self.categories = list(self.source.categories) if self.source is not None else []
+        # image id -> image entry added or updated since the last save
+        self.images = {}
+        # image_id -> annotations replacing those of the image in the file
+        self.annotations = {}
 
     def load_existing_data(self):
         if os.path.exists(self.output_file):
-            with open(self.output_file, 'r') as f:
-                return json.load(f)
-        else:
-            return {
-                "images": [],
-                "annotations": [],
-                "categories": []
-            }
+            return COCOIndex(self.output_file)
+        return None
 
     def initialize_categories(self, categories):
-        existing_categories = {cat['name']: cat for cat in self.coco_data['categories']}
+        existing_categories = {cat['name']: cat for cat in self.categories}
         
         updated_categories = []
         for category in categories:
@@ -36,41 +33,50 @@ class COCOExporter:
             else:
                 updated_categories.append(category)
         
-        self.coco_data['categories'] = sorted(updated_categories, key=lambda x: x['id'])
+        self.categories = sorted(updated_categories, key=lambda x: x['id'])
 
 
     def add_image(self, frame_number, file_name, width, height):
         coco_image_id = frame_number + 1
-        
-        for image in self.coco_data['images']:
-            if image['id'] == coco_image_id:
-                image.update({
-                    "file_name": file_name,
-                    "width": width,
-                    "height": height
-                })
-                return coco_image_id
-        
-        image_info = {
-            "id": coco_image_id,
+
+        image_info = self.images.get(coco_image_id)
+        if image_info is None and self.source is not None:
+            image_info = self.source.image(coco_image_id)
+        if image_info is None:
+            image_info = {"id": coco_image_id}
+        image_info.update({
             "file_name": file_name,
             "width": width,
             "height": height
-        }
-        self.coco_data['images'].append(image_info)
+        })
+        self.images[coco_image_id] = image_info
         return coco_image_id
 
-    def add_annotation(self, image_id, category_id, mask):
+    def image_annotations(self, image_id):
+        # The image's annotations, read from the file the first time they are changed
+        if image_id not in self.annotations:
+            self.annotations[image_id] = self.source.annotations_for(image_id) if self.source is not None else []
+        return self.annotations[image_id]
+
+    def clear_annotations(self, image_id):
+        self.annotations[image_id] = []
+
+    def add_annotation(self, image_id, category_id, mask, geometry=None):
         
-        if not np.any(mask):
+        if geometry is None:
+            if not mask_any(mask):
+                return
+            with profiler.span('export.geometry'):
+                geometry = mask_geometry(mask)
+        if geometry.area == 0:
             return
     
-        contours, bbox = self.get_contours_and_bbox(mask)
-        segmentation = self.contours_to_segmentation(contours)
-        area = float(mask.sum())
+        segmentation = geometry.polygons
+        area = float(geometry.area)
+        bbox = geometry.bbox
 
-        existing_annotation = next((ann for ann in self.coco_data['annotations'] 
-                                    if ann['image_id'] == image_id and ann['category_id'] == category_id), None)
+        annotations = self.image_annotations(image_id)
+        existing_annotation = next((ann for ann in annotations if ann['category_id'] == category_id), None)
         
         if existing_annotation:
             existing_annotation.update({
@@ -88,36 +94,56 @@ class COCOExporter:
                 "bbox": bbox,
                 "iscrowd": 0
             }
-            self.coco_data['annotations'].append(annotation)
+            annotations.append(annotation)
 
     @staticmethod
     def get_contours_and_bbox(mask):
-        if len(mask.shape) > 2:
-            mask = mask.squeeze()
-        mask_binary = (mask > 0).astype(np.uint8) * 255
-        contours, _ = cv2.findContours(mask_binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        x, y, w, h = cv2.boundingRect(mask_binary)
-        return contours, [float(x), float(y), float(w), float(h)]
+        geometry = mask_geometry(mask)
+        return geometry.contours, geometry.bbox
 
     @staticmethod
     def contours_to_segmentation(contours):
-        segmentation = []
-        for contour in contours:
-            contour = contour.flatten().tolist()
-            if len(contour) > 4:
-                segmentation.append(contour)
-        return segmentation
+        return [contour.flatten().tolist() for contour in simplify_contours(contours)]
 
-    def regenerate_annotation_ids(self):
-        self.coco_data['annotations'].sort(key=lambda x: (x['image_id'], x['category_id']))
+    def iter_images(self):
+        # File order, then images added since the last save
+        if self.source is not None:
+            for image_info in self.source.iter_raw_images():
+                yield self.images.get(image_info['id'], image_info)
+        for image_id, image_info in self.images.items():
+            if self.source is None or image_id not in self.source.images:
+                yield image_info
 
-        for idx, annotation in enumerate(self.coco_data['annotations'], start=1):
-            annotation['id'] = idx
+    def iter_annotations(self):
+        # Sorted by (image_id, category_id) and numbered from 1
+        image_ids = set(self.annotations)
+        if self.source is not None:
+            image_ids.update(self.source.annotations)
+        annotation_id = 0
+        for image_id in sorted(image_ids):
+            annotations = self.annotations.get(image_id)
+            if annotations is None:
+                # Unchanged annotations are copied from the file while they keep their id
+                for span in sorted(self.source.annotations[image_id], key=lambda x: x[3]):
+                    annotation_id += 1
+                    if span[2] == annotation_id:
+                        yield RawEntry(self.source.read_raw(span), {"image_id": image_id, "id": annotation_id, "category_id": span[3]})
+                    else:
+                        annotation = next(self.source.read([span]))
+                        annotation['id'] = annotation_id
+                        yield annotation
+                continue
+            for annotation in sorted(annotations, key=lambda x: x['category_id']):
+                annotation_id += 1
+                annotation['id'] = annotation_id
+                yield annotation
 
     def save(self):
-        with open(self.output_file, 'w') as f:
-            json.dump(self.coco_data, f)
+        header = self.source.header if self.source is not None else None
+        self.source = write_coco(self.output_file, self.iter_images(), self.iter_annotations(), self.categories,
+                                 header, self.source)
+        self.images = {}
+        self.annotations = {}
 
     def update_file(self):
-        self.regenerate_annotation_ids()
         self.save()
\ No newline at end of file
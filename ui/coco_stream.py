@@ -0,0 +1,243 @@
+import os
+import re
+import json
+from profiler import profiler
+
+# Streaming COCO I/O for dataset files too large to hold in memory.
+#
+# COCOIndex scans a COCO JSON file once, decoding one image or annotation at a time, and
+# keeps only the byte span of each entry: images by id and annotations grouped by
+# image_id. Categories and any other top-level keys (info, licenses, ...) are small and
+# kept as parsed. Selective loads such as "annotations of image N" then read just those
+# spans back from disk.
+#
+# write_coco writes a COCO file from iterables of images and annotations, one entry at a
+# time, and returns the COCOIndex of the file it wrote, so a file can be saved and read
+# back selectively without scanning it again. Entries that didn't change are passed as
+# RawEntry and copied byte for byte instead of being decoded and encoded again.
+
+CHUNK_SIZE = 4 * 1024 * 1024
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class COCOScanner:
+    # Reads the file in binary chunks decoded as latin-1, which maps every byte to one
+    # character: positions in the text are byte offsets in the file, and UTF-8 sequences
+    # never contain JSON structural characters. Values decoded here only serve the index;
+    # entries are read back from their bytes as UTF-8.
+    def __init__(self, f):
+        self.f = f
+        self.text = ''
+        self.base = 0
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        chunk = self.f.read(CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        if self.pos > len(self.text) // 2:
+            self.base += self.pos
+            self.text = self.text[self.pos:]
+            self.pos = 0
+        self.text += chunk.decode('latin-1')
+        return True
+
+    def peek(self):
+        # Next character after whitespace, without consuming it
+        while True:
+            self.pos = WHITESPACE.match(self.text, self.pos).end()
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Malformed COCO file: expected {char!r} at byte {self.offset}, found {found!r}")
+        self.pos += 1
+
+    @property
+    def offset(self):
+        return self.base + self.pos
+
+    def value(self):
+        # Decodes the next JSON value; returns it with its byte offset and length
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.text, self.pos)
+                # A number may continue into the next chunk
+                if end < len(self.text) or self.eof or not isinstance(value, (int, float)):
+                    break
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+        start = self.offset
+        self.pos = end
+        return value, start, self.offset - start
+
+    def exact_value(self):
+        # The next value with its strings decoded as UTF-8, for values kept as parsed
+        _, start, length = self.value()
+        start -= self.base
+        return json.loads(self.text[start:start + length].encode('latin-1'))
+
+    def items(self):
+        # Yields (value, offset, length) for each element of the array at the cursor
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            char = self.peek()
+            self.pos += 1
+            if char == ']':
+                return
+            if char != ',':
+                raise ValueError(f"Malformed COCO file: expected ',' or ']' at byte {self.offset - 1}, found {char!r}")
+
+
+class RawEntry:
+    # Entry bytes as read from a COCO file, with the fields the index needs
+    def __init__(self, data, fields):
+        self.data = data
+        self.fields = fields
+
+    def __getitem__(self, key):
+        return self.fields[key]
+
+
+class COCOIndex:
+    def __init__(self, path, index=None):
+        self.path = path
+        self.file = None
+        if index is not None:
+            self.images, self.annotations, self.header = index
+            return
+        # image id -> (offset, length), in file order
+        self.images = {}
+        # image_id -> [(offset, length, id, category_id), ...], in file order
+        self.annotations = {}
+        # Every other top-level key, parsed
+        self.header = {}
+        with profiler.span('coco.index'), open(path, 'rb') as f:
+            self.scan(COCOScanner(f))
+
+    def scan(self, scanner):
+        scanner.expect('{')
+        if scanner.peek() == '}':
+            return
+        while True:
+            key, _, _ = scanner.value()
+            scanner.expect(':')
+            if key == 'images':
+                for image, offset, length in scanner.items():
+                    self.images[image['id']] = (offset, length)
+            elif key == 'annotations':
+                for annotation, offset, length in scanner.items():
+                    self.annotations.setdefault(annotation['image_id'], []).append(
+                        (offset, length, annotation.get('id'), annotation.get('category_id')))
+            else:
+                self.header[key] = scanner.exact_value()
+            char = scanner.peek()
+            scanner.pos += 1
+            if char == '}':
+                return
+            if char != ',':
+                raise ValueError(f"Malformed COCO file: expected ',' or '}}' at byte {scanner.offset - 1}, found {char!r}")
+
+    @property
+    def categories(self):
+        return self.header.get('categories', [])
+
+    def read(self, spans):
+        # Entries at the given (offset, length) spans, read in file order through one handle
+        # kept open between reads
+        for span in sorted(spans):
+            yield json.loads(self.read_raw(span))
+
+    def read_raw(self, span):
+        if self.file is None:
+            self.file = open(self.path, 'rb')
+        self.file.seek(span[0])
+        return self.file.read(span[1])
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def image(self, image_id):
+        span = self.images.get(image_id)
+        return next(self.read([span])) if span is not None else None
+
+    def iter_images(self):
+        return self.read(self.images.values())
+
+    def iter_raw_images(self):
+        for image_id, span in self.images.items():
+            yield RawEntry(self.read_raw(span), {'id': image_id})
+
+    def annotations_for(self, image_id):
+        return list(self.read(self.annotations.get(image_id, [])))
+
+    def iter_annotations(self):
+        # Grouped by image_id in ascending order, file order within an image
+        for image_id in sorted(self.annotations):
+            yield from self.read(self.annotations[image_id])
+
+    def num_annotations(self):
+        return sum(len(spans) for spans in self.annotations.values())
+
+    def last_annotated_image_id(self):
+        return max((image_id for image_id in self.annotations if image_id in self.images), default=None)
+
+
+def write_coco(path, images, annotations, categories, header=None, source=None):
+    # images and annotations may be generators; entries are encoded and written one at a
+    # time. The file is written next to path and moved over it at the end, so the entries
+    # can be read from path itself through source, the COCOIndex of the current file,
+    # which is closed before the move.
+    header = dict(header or {})
+    header['categories'] = categories
+    tmp_file = path + '.tmp'
+    with profiler.span('export.save'), open(tmp_file, 'wb') as f:
+        position = [0]
+
+        def write(data):
+            f.write(data)
+            position[0] += len(data)
+
+        def write_entries(key, entries, fields):
+            # Returns (values of fields, (offset, length)) of every entry written
+            spans = []
+            write(f'"{key}": ['.encode('utf-8'))
+            for count, entry in enumerate(entries):
+                if count:
+                    write(b', ')
+                start = position[0]
+                write(entry.data if isinstance(entry, RawEntry) else json.dumps(entry).encode('utf-8'))
+                spans.append((tuple(entry[field] for field in fields), (start, position[0] - start)))
+            write(b']')
+            return spans
+
+        write(b'{')
+        image_spans = {image_id: span for (image_id,), span in write_entries('images', images, ('id',))}
+        write(b', ')
+        annotation_spans = {}
+        for (image_id, annotation_id, category_id), span in write_entries('annotations', annotations,
+                                                                            ('image_id', 'id', 'category_id')):
+            annotation_spans.setdefault(image_id, []).append(span + (annotation_id, category_id))
+        for key, value in header.items():
+            write(f', {json.dumps(key)}: {json.dumps(value)}'.encode('utf-8'))
+        write(b'}')
+    if source is not None:
+        source.close()
+    os.replace(tmp_file, path)
+    return COCOIndex(path, (image_spans, annotation_spans, header))
@@ -0,0 +1,144 @@
+import os
+import json
+import numpy as np
+from profiler import profiler
+from mask_utils import as_sparse, mask_geometry
+
+# COCO-VID style export (as used by TAO / BDD100K MOT): one video entry, per-frame images
+# with frame_id, and per-frame annotations carrying a stable track_id per object. Objects
+# that share a category name share a category id, and each track is listed once under
+# "tracks". Annotations are streamed to disk as frames are added, so memory stays flat
+# for long videos; only the small image and track tables are held until close().
+
+
+def encode_rle(mask):
+    # Uncompressed COCO RLE (column-major run lengths starting with background), computed
+    # from the bbox crop without materializing the full frame
+    mask = as_sparse(mask)
+    height, width = mask.shape
+    if mask.area == 0:
+        return {"size": [height, width], "counts": [height * width]}
+    x0, y0 = mask.offset
+    h, w = mask.crop.shape
+    padded = np.zeros((w, h + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask.crop.T
+    cols, rows = np.nonzero(np.diff(padded, axis=1))
+    # Boundaries alternate start/end within each column; a run that ends at the bottom of
+    # one column and restarts at the top of the next is a single run in column-major order
+    boundaries = (x0 + cols) * height + y0 + rows
+    touching = np.flatnonzero(boundaries[1:-1:2] == boundaries[2::2])
+    if touching.size:
+        boundaries = np.delete(boundaries, np.concatenate([2 * touching + 1, 2 * touching + 2]))
+    counts = np.diff(np.concatenate(([0], boundaries, [height * width])))
+    if counts[-1] == 0:
+        counts = counts[:-1]
+    return {"size": [height, width], "counts": counts.tolist()}
+
+
+class COCOVideoExporter:
+    def __init__(self, output_file, video_name, width, height, num_frames, segmentation='polygon'):
+        self.output_file = output_file
+        self.segmentation = segmentation
+        self.video = {"id": 1, "name": video_name, "width": width, "height": height, "length": num_frames}
+        self.categories = []
+        self.track_categories = {}
+        self.track_names = {}
+        self.images = []
+        self.tracks_seen = set()
+        self.annotation_id = 0
+        self.tmp_file = output_file + '.tmp'
+        self.file = open(self.tmp_file, 'w')
+        self.file.write('{"annotations": [')
+
+    def initialize_categories(self, objects):
+        # objects maps obj_id -> category name; one category per distinct name, in order of
+        # the first object using it
+        category_ids = {}
+        for obj_id in sorted(objects):
+            name = objects[obj_id]
+            if name not in category_ids:
+                category_ids[name] = len(category_ids) + 1
+                self.categories.append({"id": category_ids[name], "name": name})
+            self.track_categories[obj_id] = category_ids[name]
+            self.track_names[obj_id] = name
+
+    def add_frame(self, frame_idx, file_name, masks, geometries=None):
+        geometries = geometries or {}
+        image_id = frame_idx + 1
+        self.images.append({
+            "id": image_id,
+            "video_id": self.video["id"],
+            "frame_id": frame_idx,
+            "file_name": file_name,
+            "width": self.video["width"],
+            "height": self.video["height"],
+        })
+
+        for obj_id, mask in masks.items():
+            if obj_id not in self.track_categories:
+                continue
+            geometry = geometries.get(obj_id)
+            if geometry is None:
+                with profiler.span('export.geometry'):
+                    geometry = mask_geometry(mask)
+            if geometry.area == 0:
+                continue
+
+            if self.segmentation == 'rle':
+                segmentation = encode_rle(mask)
+            else:
+                segmentation = geometry.polygons
+            self.annotation_id += 1
+            annotation = {
+                "id": self.annotation_id,
+                "image_id": image_id,
+                "video_id": self.video["id"],
+                "track_id": obj_id + 1,
+                "instance_id": obj_id + 1,
+                "category_id": self.track_categories[obj_id],
+                "segmentation": segmentation,
+                "area": float(geometry.area),
+                "bbox": geometry.bbox,
+                "iscrowd": 0,
+            }
+            if self.annotation_id > 1:
+                self.file.write(',')
+            json.dump(annotation, self.file)
+            self.tracks_seen.add(obj_id)
+
+    def close(self):
+        tracks = [{"id": obj_id + 1, "category_id": self.track_categories[obj_id], "video_id": self.video["id"],
+                   "name": self.track_names[obj_id]} for obj_id in sorted(self.tracks_seen)]
+        with profiler.span('export.save'):
+            self.file.write('], "videos": ')
+            json.dump([self.video], self.file)
+            self.file.write(', "images": ')
+            json.dump(self.images, self.file)
+            self.file.write(', "tracks": ')
+            json.dump(tracks, self.file)
+            self.file.write(', "categories": ')
+            json.dump(self.categories, self.file)
+            self.file.write('}')
+            self.file.close()
+        os.replace(self.tmp_file, self.output_file)
+        return self.output_file
+
+
+def export_video_segments(output_file, video_name, frame_names, frame_size, video_segments, objects,
+                          geometry=None, segmentation='polygon', progress_callback=None, overrides=None):
+    # Single pass over the segment store; geometry is an optional GeometryIndex whose cached
+    # contours are reused, overrides maps frame_idx -> masks taking precedence over the store
+    overrides = overrides or {}
+    height, width = frame_size
+    exporter = COCOVideoExporter(output_file, video_name, width, height, len(frame_names), segmentation)
+    exporter.initialize_categories(objects)
+    for frame_idx, file_name in enumerate(frame_names):
+        if frame_idx in overrides:
+            masks = overrides[frame_idx]
+        else:
+            masks = video_segments[frame_idx] if frame_idx in video_segments else {}
+        geometries = {obj_id: geometry.lookup(frame_idx, obj_id, mask) for obj_id, mask in masks.items()} if geometry is not None else None
+        exporter.add_frame(frame_idx, file_name, masks, geometries)
+        if progress_callback:
+            progress_callback(frame_idx)
+    return exporter.close()
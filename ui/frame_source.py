@@ -0,0 +1,256 @@
+import os
+import re
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.webm', '.m4v')
+
+MANIFEST_NAME = '.sam2_frames.json'
+MANIFEST_VERSION = 1
+MANIFEST_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'sam2-interface', 'frame_index')
+
+# Forward seeks shorter than this are decoded through instead of asking the demuxer to
+# seek, which is both faster and always frame-accurate
+MAX_GRAB_DISTANCE = 64
+
+
+def is_video_file(path):
+    return os.path.isfile(path) and os.path.splitext(path)[1].lower() in VIDEO_EXTENSIONS
+
+
+def open_frame_source(path):
+    if os.path.isdir(path):
+        return ImageFolderFrameSource(path)
+    if is_video_file(path):
+        return VideoFileFrameSource(path)
+    raise ValueError(f"Unsupported video source: {path}")
+
+
+def natural_sort_key(name):
+    # "2.jpg" < "10.jpg", and non-numeric names like "frame_0002.png" sort the same way
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', name)]
+
+
+def probe_image_size(path):
+    # Reads only the image header when Pillow is available
+    if Image is not None:
+        with Image.open(path) as img:
+            width, height = img.size
+        return width, height
+    height, width = cv2.imread(path).shape[:2]
+    return width, height
+
+
+class FrameIndex:
+    # Sorted listing of a frame folder with sizes, mtimes and image dimensions, persisted as a
+    # sidecar manifest. An unchanged folder is loaded from the manifest without listing it,
+    # and after changes only new or modified files are probed again.
+    def __init__(self, folder, refresh=False, num_workers=16):
+        self.folder = os.path.abspath(folder)
+        self.num_workers = num_workers
+        manifest = self.read_manifest()
+        dir_mtime_ns = os.stat(self.folder).st_mtime_ns
+
+        # The folder's mtime only changes when files are added, removed or renamed; frames
+        # overwritten in place are caught by comparing each file's size and mtime
+        changed = None
+        if manifest is not None and not refresh and manifest['dir_mtime_ns'] == dir_mtime_ns:
+            changed = self.changed_entries(manifest['frames'])
+        if changed is not None:
+            self.entries = manifest['frames']
+            if changed:
+                self.probe(changed)
+                self.write_manifest()
+        else:
+            previous = {entry[0]: entry for entry in manifest['frames']} if manifest is not None else {}
+            self.entries = self.scan(previous)
+            self.write_manifest()
+
+        self.names = [entry[0] for entry in self.entries]
+
+    def manifest_paths(self):
+        cache_name = hashlib.sha1(self.folder.encode()).hexdigest() + '.json'
+        return [os.path.join(self.folder, MANIFEST_NAME), os.path.join(MANIFEST_CACHE_DIR, cache_name)]
+
+    def read_manifest(self):
+        for path in self.manifest_paths():
+            try:
+                with open(path, 'r') as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if manifest.get('version') == MANIFEST_VERSION and manifest.get('folder') == self.folder:
+                return manifest
+        return None
+
+    def changed_entries(self, entries):
+        # Entries whose file changed since the manifest was written, updated with the new
+        # size and mtime; None if a file is gone and the folder has to be scanned again
+        changed = []
+        for entry in entries:
+            try:
+                stat = os.stat(os.path.join(self.folder, entry[0]))
+            except OSError:
+                return None
+            if entry[1] != stat.st_size or entry[2] != stat.st_mtime_ns:
+                entry[1], entry[2] = stat.st_size, stat.st_mtime_ns
+                changed.append(entry)
+        return changed
+
+    def probe(self, entries):
+        with ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+            sizes = pool.map(lambda entry: probe_image_size(os.path.join(self.folder, entry[0])), entries)
+            for entry, (width, height) in zip(entries, sizes):
+                entry[3], entry[4] = width, height
+        print(f"Indexed {len(entries)} new or changed frames in {self.folder}")
+
+    def scan(self, previous):
+        entries = []
+        to_probe = []
+        with os.scandir(self.folder) as it:
+            for dir_entry in it:
+                if not dir_entry.name.lower().endswith(IMAGE_EXTENSIONS) or not dir_entry.is_file():
+                    continue
+                stat = dir_entry.stat()
+                old = previous.get(dir_entry.name)
+                if old is not None and old[1] == stat.st_size and old[2] == stat.st_mtime_ns:
+                    entries.append(old)
+                else:
+                    entry = [dir_entry.name, stat.st_size, stat.st_mtime_ns, None, None]
+                    entries.append(entry)
+                    to_probe.append(entry)
+
+        if to_probe:
+            self.probe(to_probe)
+
+        entries.sort(key=lambda entry: natural_sort_key(entry[0]))
+        return entries
+
+    def write_manifest(self):
+        manifest = {'version': MANIFEST_VERSION, 'folder': self.folder, 'dir_mtime_ns': None, 'frames': self.entries}
+        for path in self.manifest_paths():
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(manifest, f)
+                os.replace(tmp_path, path)
+                # Creating the manifest changes the folder's mtime, so record the mtime after
+                # the rename and rewrite the file in place, which leaves the folder untouched
+                manifest['dir_mtime_ns'] = os.stat(self.folder).st_mtime_ns
+                with open(path, 'w') as f:
+                    json.dump(manifest, f)
+                return
+            except OSError:
+                continue
+
+    def __len__(self):
+        return len(self.entries)
+
+    def frame_size(self, frame_idx=0):
+        _, _, _, width, height = self.entries[frame_idx]
+        return height, width
+
+
+class ImageFolderFrameSource:
+    def __init__(self, folder, refresh_index=False):
+        self.path = folder
+        self.name = os.path.basename(os.path.normpath(folder))
+        self.index = FrameIndex(folder, refresh=refresh_index)
+        self.frame_names = self.index.names
+
+    def __len__(self):
+        return len(self.frame_names)
+
+    def frame_name(self, frame_idx):
+        return self.frame_names[frame_idx]
+
+    def read(self, frame_idx):
+        return cv2.imread(os.path.join(self.path, self.frame_names[frame_idx]))
+
+    def frame_size(self, frame_idx=0):
+        return self.index.frame_size(frame_idx)
+
+    def clear_cache(self):
+        pass
+
+
+class VideoFileFrameSource:
+    # Decodes frames straight from a video container. Reads are served from a small LRU
+    # cache shared by the display and the predictor's frame loader.
+    def __init__(self, video_path, cache_size=64):
+        self.path = video_path
+        self.name = os.path.splitext(os.path.basename(video_path))[0]
+        self.capture = cv2.VideoCapture(video_path)
+        if not self.capture.isOpened():
+            raise ValueError(f"Could not open video file: {video_path}")
+        self.height = int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.width = int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.num_frames = int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        if self.num_frames <= 0:
+            self.num_frames = self._count_frames()
+        self.next_frame_idx = 0
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _count_frames(self):
+        num_frames = 0
+        while self.capture.grab():
+            num_frames += 1
+        self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        return num_frames
+
+    def __len__(self):
+        return self.num_frames
+
+    def frame_name(self, frame_idx):
+        # Matches the "%05d.jpg" layout of frames extracted with ffmpeg -start_number 0
+        return f"{frame_idx:05d}.jpg"
+
+    def read(self, frame_idx):
+        with self.lock:
+            frame = self.cache.get(frame_idx)
+            if frame is not None:
+                self.cache.move_to_end(frame_idx)
+                return frame
+
+            if frame_idx != self.next_frame_idx:
+                distance = frame_idx - self.next_frame_idx
+                if self.next_frame_idx >= 0 and 0 < distance <= MAX_GRAB_DISTANCE:
+                    for _ in range(distance):
+                        self.capture.grab()
+                else:
+                    self.capture.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+
+            ok, frame = self.capture.read()
+            if not ok:
+                self.next_frame_idx = -1
+                return None
+            self.next_frame_idx = frame_idx + 1
+
+            self.cache[frame_idx] = frame
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+            return frame
+
+    def frame_size(self, frame_idx=0):
+        return self.height, self.width
+
+    def clear_cache(self):
+        with self.lock:
+            self.cache.clear()
+
+    def close(self):
+        with self.lock:
+            self.capture.release()
@@ -0,0 +1,147 @@
+from collections import deque
+import numpy as np
+from mask_utils import SparseMask, as_sparse
+
+# Undo/redo for annotation edits. Commands keep only what changed: the prompt arrays
+# before and after a click, and the XOR of the mask before and after, run-length encoded
+# over the union of both bboxes. The same delta applied again reverts it, so one record
+# serves both undo and redo. Masks are immutable once produced, so commands that drop
+# whole objects keep references to them instead of copies.
+
+
+def rle_encode(bits):
+    flat = bits.ravel()
+    if flat.size == 0:
+        return False, np.zeros(0, dtype=np.uint32)
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    runs = np.diff(np.concatenate(([0], changes, [flat.size])))
+    return bool(flat[0]), runs.astype(np.uint32)
+
+
+def rle_decode(first, runs, shape):
+    values = (np.arange(len(runs)) % 2 == 0) == first
+    return np.repeat(values, runs).reshape(shape)
+
+
+def mask_shape(mask):
+    return mask.shape if isinstance(mask, SparseMask) else np.asarray(mask).shape[-2:]
+
+
+class MaskDelta:
+    def __init__(self, before, after):
+        self.had_before = before is not None
+        self.has_after = after is not None
+        self.shape = tuple(mask_shape(before if before is not None else after))
+        before = as_sparse(before) if before is not None else SparseMask.empty(self.shape)
+        after = as_sparse(after) if after is not None else SparseMask.empty(self.shape)
+
+        boxes = [mask.bbox_xyxy for mask in (before, after) if mask.area > 0]
+        if not boxes:
+            self.roi = None
+            return
+        self.roi = (min(b[0] for b in boxes), min(b[1] for b in boxes),
+                    max(b[2] for b in boxes), max(b[3] for b in boxes))
+        self.first, self.runs = rle_encode(before.crop_to(self.roi) ^ after.crop_to(self.roi))
+
+    def apply(self, mask, forward=True):
+        # forward turns the "before" mask into the "after" mask, backward the reverse
+        if not (self.has_after if forward else self.had_before):
+            return None
+        mask = as_sparse(mask) if mask is not None else SparseMask.empty(self.shape)
+        if self.roi is None:
+            return mask
+        x0, y0, x1, y1 = self.roi
+        bits = mask.crop_to(self.roi) ^ rle_decode(self.first, self.runs, (y1 - y0, x1 - x0))
+        return SparseMask.from_crop(bits, (x0, y0), self.shape)
+
+
+def copy_prompts(prompts):
+    if prompts is None:
+        return None
+    coords, labels = prompts
+    return coords.copy(), labels.copy()
+
+
+class PromptCommand:
+    # A click on an object: its prompt list and resulting mask on one frame
+    def __init__(self, frame_idx, obj_id, prompts_before, prompts_after, mask_before, mask_after):
+        self.frame_idx = frame_idx
+        self.obj_id = obj_id
+        self.prompts_before = copy_prompts(prompts_before)
+        self.prompts_after = copy_prompts(prompts_after)
+        self.mask_delta = MaskDelta(mask_before, mask_after) if (mask_before is not None or mask_after is not None) else None
+
+    def undo(self, interface):
+        interface.restore_prompt_state(self.frame_idx, self.obj_id, self.prompts_before, self.mask_delta, forward=False)
+
+    def redo(self, interface):
+        interface.restore_prompt_state(self.frame_idx, self.obj_id, self.prompts_after, self.mask_delta, forward=True)
+
+
+class AddObjectCommand:
+    def __init__(self, obj_id, obj_data):
+        self.obj_id = obj_id
+        self.obj_data = dict(obj_data)
+
+    def undo(self, interface):
+        interface.delete_object(self.obj_id, record=False)
+
+    def redo(self, interface):
+        interface.restore_object(self.obj_id, self.obj_data, None, {})
+
+
+class DeleteObjectCommand:
+    def __init__(self, obj_id, obj_data, mask, segments):
+        self.obj_id = obj_id
+        self.obj_data = dict(obj_data)
+        self.mask = mask
+        self.segments = segments
+
+    def undo(self, interface):
+        interface.restore_object(self.obj_id, self.obj_data, self.mask, self.segments)
+
+    def redo(self, interface):
+        interface.delete_object(self.obj_id, record=False)
+
+
+class RenameCommand:
+    def __init__(self, obj_id, old_name, new_name):
+        self.obj_id = obj_id
+        self.old_name = old_name
+        self.new_name = new_name
+
+    def undo(self, interface):
+        interface.rename_object(self.obj_id, self.old_name)
+
+    def redo(self, interface):
+        interface.rename_object(self.obj_id, self.new_name)
+
+
+class CommandHistory:
+    def __init__(self, limit=2000):
+        self.undo_stack = deque(maxlen=limit)
+        self.redo_stack = []
+
+    def push(self, command):
+        self.undo_stack.append(command)
+        self.redo_stack.clear()
+
+    def undo(self, interface):
+        if not self.undo_stack:
+            return None
+        command = self.undo_stack.pop()
+        command.undo(interface)
+        self.redo_stack.append(command)
+        return command
+
+    def redo(self, interface):
+        if not self.redo_stack:
+            return None
+        command = self.redo_stack.pop()
+        command.redo(interface)
+        self.undo_stack.append(command)
+        return command
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack.clear()
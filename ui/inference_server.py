@@ -0,0 +1,277 @@
+import os
+import json
+import struct
+import socket
+import argparse
+import tempfile
+import threading
+import traceback
+import socketserver
+from contextlib import nullcontext
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+import torch
+from frame_source import open_frame_source
+from mask_utils import LabelMap, SparseMask, as_sparse
+
+# Local SAM2 inference service. The model runs in this process instead of the Qt process,
+# so inference no longer freezes the UI, a crash in torch leaves the annotator running,
+# and every UI connected to the socket shares one loaded model (each connection gets its
+# own inference state). Run from the ui/ directory:
+#
+#   python inference_server.py --socket /tmp/sam2-inference.sock
+#
+# and start the UI with SAM2_INFERENCE_SERVER=/tmp/sam2-inference.sock.
+#
+# Protocol: length-prefixed JSON messages over a Unix socket, one reply per request. The
+# server opens the video from its path itself, so frames never cross the socket. Masks are
+# written into a shared-memory buffer owned by the connection, and replies carry only
+# their offsets and shapes; the buffer is reused for every reply, so the client copies the
+# masks out before sending the next request. Propagation is pulled one frame per "next"
+# request, which lets the client stop early and lets connections take turns on the model.
+
+DEFAULT_SOCKET_PATH = os.path.join(tempfile.gettempdir(), 'sam2-inference.sock')
+DEFAULT_BUFFER_SIZE = 16 * 1024 * 1024
+HEADER = struct.Struct('!I')
+
+
+def send_message(sock, message):
+    data = json.dumps(message).encode('utf-8')
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def recv_exact(sock, size):
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionError("Inference server connection closed")
+        received += count
+    return bytes(data)
+
+
+def recv_message(sock):
+    size, = HEADER.unpack(recv_exact(sock, HEADER.size))
+    return json.loads(recv_exact(sock, size).decode('utf-8'))
+
+
+class SharedBuffer:
+    # Shared-memory segment mask payloads are written into; replaced by a larger one when
+    # a payload doesn't fit, so replies name the segment they used
+    def __init__(self, size=DEFAULT_BUFFER_SIZE):
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def reserve(self, size):
+        if size > self.shm.size:
+            self.release()
+            self.shm = shared_memory.SharedMemory(create=True, size=max(size, 2 * self.shm.size))
+        return self.shm.buf
+
+    def pack(self, masks):
+        if isinstance(masks, LabelMap):
+            labels = np.ascontiguousarray(masks.labels)
+            np.frombuffer(self.reserve(labels.nbytes), dtype=labels.dtype, count=labels.size)[:] = labels.ravel()
+            return {"buffer": self.name, "type": "label_map", "dtype": labels.dtype.name,
+                    "shape": list(labels.shape), "obj_ids": masks.obj_ids}
+
+        masks = {obj_id: as_sparse(mask) for obj_id, mask in masks.items()}
+        buf = self.reserve(sum(mask.crop.size for mask in masks.values()))
+        entries = []
+        start = 0
+        shape = None
+        for obj_id, mask in masks.items():
+            h, w = mask.crop.shape
+            np.frombuffer(buf, dtype=bool, count=h * w, offset=start)[:] = mask.crop.ravel()
+            entries.append([obj_id, mask.offset[0], mask.offset[1], h, w, start])
+            start += h * w
+            shape = mask.shape
+        return {"buffer": self.name, "type": "masks", "shape": list(shape) if shape else None, "masks": entries}
+
+    def release(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def attach_buffer(name):
+    shm = shared_memory.SharedMemory(name=name)
+    # The server owns the segment; without this the client's resource tracker would unlink
+    # it when the UI exits
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def unpack_masks(buf, descriptor):
+    # Copies masks out of the shared buffer, which the server overwrites on the next reply
+    shape = tuple(descriptor["shape"]) if descriptor["shape"] else None
+    if descriptor["type"] == "label_map":
+        dtype = np.dtype(descriptor["dtype"])
+        labels = np.frombuffer(buf, dtype=dtype, count=int(np.prod(shape))).reshape(shape).copy()
+        return LabelMap(labels, descriptor["obj_ids"])
+    masks = {}
+    for obj_id, x0, y0, h, w, start in descriptor["masks"]:
+        crop = np.frombuffer(buf, dtype=bool, count=h * w, offset=start).reshape(h, w).copy()
+        masks[obj_id] = SparseMask(crop, (x0, y0), shape)
+    return masks
+
+
+def inference_context():
+    if torch.cuda.is_available():
+        return torch.autocast("cuda", dtype=torch.bfloat16)
+    return nullcontext()
+
+
+class InferenceHandler(socketserver.BaseRequestHandler):
+    # One UI connection: its own SAM2Predictor session over the process-wide model
+    def setup(self):
+        self.session = None
+        self.frames = None
+        self.buffer = SharedBuffer()
+
+    def handle(self):
+        while True:
+            try:
+                message = recv_message(self.request)
+            except ConnectionError:
+                break
+            op = message.get('op')
+            if op == 'close':
+                send_message(self.request, {"ok": True})
+                break
+            handler = getattr(self, f'op_{op}', None)
+            try:
+                if handler is None:
+                    raise ValueError(f"Unknown operation: {op}")
+                if op != 'init' and self.session is None:
+                    raise RuntimeError("No video initialized on this connection")
+                # Connections take turns on the shared model, one call or frame at a time
+                with self.server.model_lock, inference_context():
+                    reply = handler(message)
+                reply["ok"] = True
+            except Exception as e:
+                traceback.print_exc()
+                reply = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+            send_message(self.request, reply)
+
+    def finish(self):
+        if self.frames is not None:
+            self.frames.close()
+        self.buffer.release()
+
+    def op_init(self, message):
+        frame_source = open_frame_source(message['path'])
+        self.stop_propagation()
+        self.session = self.server.session_factory()
+        self.session.initialize_predictor(frame_source)
+        return {"num_frames": len(frame_source), "frame_size": list(frame_source.frame_size())}
+
+    def op_points(self, message):
+        coords = np.array(message['coords'], dtype=np.float32)
+        labels = np.array(message['labels'], dtype=np.int32)
+        mask = self.session.predict_mask_with_points(message['frame_idx'], message['obj_id'], coords, labels)
+        return {"mask": self.buffer.pack({message['obj_id']: mask}) if mask is not None else None}
+
+    def op_box(self, message):
+        mask = self.session.generate_mask_with_box(message['frame_idx'], message['obj_id'], message['box'])
+        return {"mask": self.buffer.pack({message['obj_id']: mask})}
+
+    def op_clear(self, message):
+        # Returns the prompt log entries the clear added, including the object's removal
+        # when it has no prompts left
+        logged = len(self.session.prompt_log)
+        self.session.clear_prompts(message['frame_idx'], message['obj_id'])
+        return {"entries": self.session.prompt_log[logged:]}
+
+    def op_remove(self, message):
+        return {"removed": self.session.suspend_object(message['obj_id'], message['frame_idx'])}
+
+    def op_reset(self, message):
+        self.stop_propagation()
+        self.session.reset_state()
+        return {}
+
+    def op_propagate(self, message):
+        self.stop_propagation()
+        self.session.label_map_mode = message.get('label_map_mode', False)
+        self.session.prune_lost_objects = message.get('prune_lost_objects', False)
+        tracked_objects = message.get('tracked_objects')
+        self.frames = self.session.propagate_frames(message.get('start_frame_idx', 0), message.get('max_frame_num_to_track'),
+                                                    set(tracked_objects) if tracked_objects is not None else None)
+        return {}
+
+    def op_next(self, message):
+        if self.frames is None:
+            raise RuntimeError("No propagation running")
+        suspended = dict(self.session.suspended)
+        output = next(self.frames, None)
+        # Objects dropped while producing this frame, reported so the client can mirror them
+        dropped = [[obj_id, frame_idx] for obj_id, frame_idx in self.session.suspended.items()
+                   if suspended.get(obj_id) != frame_idx]
+        if output is None:
+            self.frames = None
+            return {"done": True, "suspended": dropped}
+        frame_idx, frame_masks, scores = output
+        # The client keeps its own geometry index
+        self.session.geometry.clear()
+        return {"done": False, "frame_idx": frame_idx, "masks": self.buffer.pack(frame_masks),
+                "scores": [[obj_id, score] for obj_id, score in scores.items()], "suspended": dropped}
+
+    def op_stop(self, message):
+        self.stop_propagation()
+        return {}
+
+    def stop_propagation(self):
+        if self.frames is not None:
+            self.frames.close()
+            self.frames = None
+
+
+class InferenceServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, session_factory=None):
+        if session_factory is None:
+            from sam2_predictor import SAM2Predictor
+            session_factory = SAM2Predictor
+        self.session_factory = session_factory
+        self.model_lock = threading.Lock()
+        super().__init__(socket_path, InferenceHandler)
+
+
+def serve(socket_path=DEFAULT_SOCKET_PATH, session_factory=None):
+    if os.path.exists(socket_path):
+        # A socket left behind by a server that didn't shut down cleanly
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+            probe.close()
+            raise RuntimeError(f"An inference server is already listening on {socket_path}")
+        except ConnectionRefusedError:
+            os.remove(socket_path)
+    server = InferenceServer(socket_path, session_factory)
+    print(f"SAM2 inference server listening on {socket_path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve SAM2 inference to annotation UIs over a Unix socket.")
+    parser.add_argument('--socket', default=DEFAULT_SOCKET_PATH, help="Path of the Unix socket to listen on")
+    args = parser.parse_args()
+    try:
+        serve(args.socket)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,32 @@
 import os
-import cv2
 import sys
-import json
 import torch
 import numpy as np
 from datetime import datetime
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QFileDialog, 
-                             QLabel, QTableWidget, QTableWidgetItem, QHeaderView, 
+                             QLabel, QTableView, QHeaderView, 
                              QScrollArea, QMessageBox, QVBoxLayout, QHBoxLayout,
-                             QProgressDialog, QPushButton)
-from PyQt5.QtGui import QBrush
-from PyQt5.QtCore import Qt, QTimer
+                             QProgressDialog, QInputDialog)
+from PyQt5.QtCore import Qt, QTimer, QEventLoop
 from sam2_predictor import SAM2Predictor
-from visualization import show_mask, show_points, show_mask_with_contours_and_bbox
+from remote_predictor import RemoteSAM2Predictor
+from sharded_propagation import propagate_sharded
+from visualization import show_mask, show_label_map, show_points, show_mask_with_contours_and_bbox
 from coco_exporter import COCOExporter
+from coco_stream import COCOIndex
+from coco_video_exporter import export_video_segments
+from mask_exporters import MaskArchiveExporter, EXPORT_FORMATS
 from ui_utils import (create_button, create_vertical_layout, create_horizontal_layout,
-                      get_object_color, CenteredCheckBox, AlignDelegate, MatplotlibWidget)
+                      get_object_color, AlignDelegate, CheckBoxDelegate, MatplotlibWidget)
 from object_manager import ObjectManager
+from object_table import ObjectTableModel, RESEGMENT_COLUMN, CATEGORY_COLUMN, COLOR_COLUMN, TRACKING_COLUMN
+from profiler import profiler
+from frame_source import open_frame_source, VIDEO_EXTENSIONS
+from mask_utils import LabelMap, SparseMask, mask_any, simplification
+from history import CommandHistory, PromptCommand, AddObjectCommand, DeleteObjectCommand, RenameCommand
+from session import (SessionSaver, read_session, snapshot_segments, remove_object_masks, insert_object_masks,
+                     SESSION_VERSION, SESSION_EXTENSION, AUTOSAVE_INTERVAL_MS)
+from memory_governor import MemoryGovernor, MEMORY_CHECK_INTERVAL_MS
 
 os.environ['TORCH_CUDNN_SDPA_ENABLED'] = '1'
 
@@ -39,23 +49,53 @@ class SAM2UI:
         self.main_widget.keyPressEvent = self.keyPressEvent
 
     def keyPressEvent(self, event):
-        if event.key() == Qt.Key_Right:
+        if event.modifiers() & Qt.ControlModifier:
+            if (event.key() == Qt.Key_Z and event.modifiers() & Qt.ShiftModifier) or event.key() == Qt.Key_Y:
+                self.interface.redo()
+            elif event.key() == Qt.Key_Z:
+                self.interface.undo()
+        elif event.key() == Qt.Key_Right:
             self.interface.navigate_frame('right')
         elif event.key() == Qt.Key_Left:
             self.interface.navigate_frame('left')
+        elif event.key() == Qt.Key_P:
+            self.interface.toggle_perf_overlay()
+        elif event.key() == Qt.Key_F:
+            self.mpl_widget.reset_view()
+        elif event.key() == Qt.Key_N:
+            self.interface.jump_to_suspicious('left' if event.modifiers() & Qt.ShiftModifier else 'right')
 
     def create_left_panel(self):
         self.load_btn = create_button('Load Video', self.interface.load_video_or_frames)
+        self.load_video_file_btn = create_button('Load Video File', self.interface.load_video_file)
         self.load_coco_btn = create_button('Load COCO JSON', self.interface.load_coco_and_propagate)
         self.add_obj_btn = create_button('New Object', self.interface.prepare_new_object)
         self.propagate_btn = create_button('Propagate Masks', lambda: self.interface.propagate_masks(type=None))
+        self.propagate_correction_btn = create_button('Propagate Correction',
+                                                      lambda: self.interface.propagate_masks(type=None, correction=True))
         self.export_btn = create_button('Start COCO Export', self.interface.initialize_coco_export)
         self.reset_btn = create_button('Reset Tracking', lambda: self.interface.reset_inference_state(type=None))
         self.propagate_and_export_btn = create_button('Propagate and Export All', self.interface.propagate_and_export_all)
+        self.export_video_coco_btn = create_button('Export Video COCO', self.interface.export_video_coco)
+        self.export_masks_btn = create_button('Export Mask Archive', self.interface.export_mask_archive)
+        self.export_profile_btn = create_button('Export Profile', self.interface.export_profile)
+        self.roi_mode_btn = create_button('ROI Tracking: Off', self.interface.toggle_roi_mode)
+        self.roi_mode_btn.setCheckable(True)
+        self.label_map_btn = create_button('Label Maps: Off', self.interface.toggle_label_map_mode)
+        self.label_map_btn.setCheckable(True)
+        self.sharded_btn = create_button('Sharded Export: Off', self.interface.toggle_sharded_export)
+        self.sharded_btn.setCheckable(True)
+        self.prune_btn = create_button('Drop Lost Objects: Off', self.interface.toggle_prune_lost_objects)
+        self.prune_btn.setCheckable(True)
+        self.polygon_btn = create_button(self.polygon_button_text(), self.interface.set_polygon_simplification)
+        self.save_session_btn = create_button('Save Session', lambda: self.interface.save_session(choose_file=True))
+        self.load_session_btn = create_button('Load Session', self.interface.load_session)
     
         left_layout = create_vertical_layout(
-            self.load_btn, self.load_coco_btn, self.add_obj_btn, self.propagate_btn, 
-            self.export_btn, self.reset_btn, self.propagate_and_export_btn
+            self.load_btn, self.load_video_file_btn, self.load_coco_btn, self.add_obj_btn, self.propagate_btn, 
+            self.propagate_correction_btn, self.export_btn, self.reset_btn, self.propagate_and_export_btn, self.export_video_coco_btn,
+            self.export_masks_btn, self.roi_mode_btn, self.label_map_btn, self.sharded_btn, self.prune_btn, self.polygon_btn,
+            self.save_session_btn, self.load_session_btn, self.export_profile_btn
     )
         
         left_layout.addStretch(1)
@@ -69,14 +109,21 @@ class SAM2UI:
         self.mpl_widget = MatplotlibWidget()
         self.mpl_widget.setFixedSize(1600, 900)
         self.mpl_widget.canvas.mpl_connect('button_press_event', self.interface.on_click)
+        self.mpl_widget.view_changed = lambda: self.interface.update_display(self.interface.current_image)
         
         self.prev_btn = create_button('Prev Frame', lambda: self.interface.navigate_frame('left'))
         self.next_btn = create_button('Next Frame', lambda: self.interface.navigate_frame('right'))
-        nav_layout = create_horizontal_layout(self.prev_btn, self.next_btn)
+        self.prev_flagged_btn = create_button('Prev Suspicious (Shift+N)', lambda: self.interface.jump_to_suspicious('left'))
+        self.next_flagged_btn = create_button('Next Suspicious (N)', lambda: self.interface.jump_to_suspicious('right'))
+        nav_layout = create_horizontal_layout(self.prev_flagged_btn, self.prev_btn, self.next_btn, self.next_flagged_btn)
 
         self.load_curr_coco_btn = create_button('Load Current Frame COCO', self.interface.load_coco_for_current_frame)
         self.save_curr_coco_btn = create_button('Save Current Frame COCO', self.interface.export_current_frame_to_coco)
         curr_frame_layout = create_horizontal_layout(self.load_curr_coco_btn, self.save_curr_coco_btn)
+
+        self.undo_btn = create_button('Undo (Ctrl+Z)', self.interface.undo)
+        self.redo_btn = create_button('Redo (Ctrl+Y)', self.interface.redo)
+        history_layout = create_horizontal_layout(self.undo_btn, self.redo_btn)
         
         self.frame_info_label = QLabel()
         
@@ -84,6 +131,7 @@ class SAM2UI:
         center_layout.addWidget(self.mpl_widget)
         center_layout.addLayout(nav_layout)
         center_layout.addLayout(curr_frame_layout)
+        center_layout.addLayout(history_layout)
         center_layout.addWidget(self.frame_info_label)
         
         center_widget = QWidget()
@@ -92,25 +140,38 @@ class SAM2UI:
         return center_widget
 
     def create_right_panel(self):
-        self.table = QTableWidget(0, 4)
-        self.table.setHorizontalHeaderLabels(['Re-segment', 'Category', 'Color', 'Tracking'])
+        self.table_model = ObjectTableModel(self.interface, self.interface.object_manager)
+        self.table = QTableView()
+        self.table.setModel(self.table_model)
         self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        self.table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.table.verticalHeader().setDefaultSectionSize(30)
         self.table.setFixedWidth(300)
-        self.table.itemChanged.connect(self.interface.on_category_name_change)
 
         self.table.horizontalHeader().setDefaultAlignment(Qt.AlignCenter)
 
         align_delegate = AlignDelegate(self.table)
-        self.table.setItemDelegateForColumn(1, align_delegate)
-        self.table.setItemDelegateForColumn(2, align_delegate)
+        self.table.setItemDelegateForColumn(CATEGORY_COLUMN, align_delegate)
+        self.table.setItemDelegateForColumn(COLOR_COLUMN, align_delegate)
+        checkbox_delegate = CheckBoxDelegate(self.table)
+        self.table.setItemDelegateForColumn(RESEGMENT_COLUMN, checkbox_delegate)
+        self.table.setItemDelegateForColumn(TRACKING_COLUMN, checkbox_delegate)
 
         scroll = QScrollArea()
         scroll.setWidget(self.table)
         scroll.setWidgetResizable(True)
         scroll.setFixedWidth(320) 
 
+        # Memory use against the budget and what the memory governor did about it
+        self.memory_label = QLabel("Memory: measuring...")
+        self.memory_label.setWordWrap(True)
+        self.memory_label.setFixedWidth(320)
+        self.memory_budget_btn = create_button('Memory Budget', self.interface.set_memory_budget)
+
         right_layout = QVBoxLayout()
         right_layout.addWidget(scroll)
+        right_layout.addWidget(self.memory_label)
+        right_layout.addWidget(self.memory_budget_btn)
 
         right_widget = QWidget()
         right_widget.setLayout(right_layout)
@@ -120,64 +181,59 @@ class SAM2UI:
     def disable_all_buttons(self):
         self.add_obj_btn.setEnabled(False)
         self.propagate_btn.setEnabled(False)
+        self.propagate_correction_btn.setEnabled(False)
         self.export_btn.setEnabled(False)
         self.prev_btn.setEnabled(False)
         self.next_btn.setEnabled(False)
+        self.prev_flagged_btn.setEnabled(False)
+        self.next_flagged_btn.setEnabled(False)
         self.load_curr_coco_btn.setEnabled(False)
         self.save_curr_coco_btn.setEnabled(False)
         self.reset_btn.setEnabled(False)
         self.propagate_and_export_btn.setEnabled(False)
+        self.export_video_coco_btn.setEnabled(False)
+        self.export_masks_btn.setEnabled(False)
+        self.save_session_btn.setEnabled(False)
 
     def enable_buttons_after_video_load(self):
         self.add_obj_btn.setEnabled(True)
         self.prev_btn.setEnabled(True)
         self.next_btn.setEnabled(True)
+        self.prev_flagged_btn.setEnabled(True)
+        self.next_flagged_btn.setEnabled(True)
         self.load_curr_coco_btn.setEnabled(True)
+        self.export_video_coco_btn.setEnabled(True)
+        self.export_masks_btn.setEnabled(True)
+        self.save_session_btn.setEnabled(True)
 
     def update_table(self):
-        self.table.setRowCount(len(self.interface.object_manager.get_all_objects()))
-        for i, (obj_id, obj_data) in enumerate(self.interface.object_manager.get_all_objects().items()):
-            checkbox_widget = CenteredCheckBox()
-            checkbox_widget.checkbox.stateChanged.connect(lambda state, x=obj_id: self.interface.on_resegment_checked(state, x))
-            self.table.setCellWidget(i, 0, checkbox_widget)
-            
-            name_item = QTableWidgetItem(obj_data['category_name'])
-            name_item.setTextAlignment(Qt.AlignCenter)
-            self.table.setItem(i, 1, name_item)
-            
-            color_item = QTableWidgetItem()
-            color_item.setBackground(QBrush(obj_data['color']))
-            self.table.setItem(i, 2, color_item)
-
-            # delete_btn = QPushButton("Delete")
-            # delete_btn.clicked.connect(lambda _, x=obj_id: self.interface.delete_object(x))
-            # self.table.setCellWidget(i, 3, delete_btn)
-
-            tracking_checkbox = CenteredCheckBox()
-            tracking_checkbox.setChecked(obj_data['tracking'])
-            tracking_checkbox.stateChanged.connect(lambda state, x=obj_id: self.interface.on_tracking_changed(state, x))
-            self.table.setCellWidget(i, 3, tracking_checkbox)
+        # Rows follow the object manager on their own; this repaints state kept elsewhere,
+        # such as objects suspended during propagation
+        self.table_model.refresh()
 
-        for row in range(self.table.rowCount()):
-            self.table.setRowHeight(row, 30)
+    def polygon_button_text(self):
+        return f"Polygon Tolerance: {simplification.tolerance:g} px"
 
-    def set_delete_buttons_enabled(self, enabled):
-        for row in range(self.table.rowCount()):
-            delete_btn = self.table.cellWidget(row, 3)
-            if isinstance(delete_btn, QPushButton):
-                delete_btn.setEnabled(enabled)
 
 class SAM2Interface:
     def __init__(self):
-        self.ui = SAM2UI(self)
-        self.sam2_predictor = SAM2Predictor()
         self.object_manager = ObjectManager()
+        self.ui = SAM2UI(self)
+        # SAM2_INFERENCE_SERVER=<socket path> runs the model in inference_server.py instead of
+        # this process
+        server_socket = os.environ.get('SAM2_INFERENCE_SERVER')
+        if server_socket:
+            self.sam2_predictor = RemoteSAM2Predictor(
+                server_socket, idle_callback=lambda: QApplication.processEvents(QEventLoop.ExcludeUserInputEvents))
+        else:
+            self.sam2_predictor = SAM2Predictor()
         self.coco_exporter = None
         self.default_load_dir = os.path.abspath("../data/")
         self.default_export_dir = os.path.abspath("../output/")
         self.input_folder_name = None
         self.coco_export_file = None
         self.video_dir = None
+        self.frame_source = None
         self.frame_names = []
         self.current_frame_idx = 0
         self.current_image = None
@@ -187,7 +243,17 @@ class SAM2Interface:
         self.first_mask_created = False
         self.current_object_id = None
         self.masks = {}
-        self.object_bboxes = {}
+        self.geometry = self.sam2_predictor.geometry
+        self.quality = self.sam2_predictor.quality
+        self.show_perf_overlay = False
+        self.sharded_export = False
+        self.history = CommandHistory()
+        # Segments from before the last tracking reset, merged back in by correction propagation
+        self.previous_segments = None
+        self.session_file = None
+        self.session_saver = SessionSaver()
+        self.memory_governor = MemoryGovernor(self)
+        self.sam2_predictor.segments_factory = self.memory_governor.new_segments
 
     def run(self):
         self.window = QMainWindow()
@@ -198,26 +264,69 @@ class SAM2Interface:
         self.ui.load_btn.setEnabled(True)
         self.ui.load_coco_btn.setEnabled(False)
 
+        self.autosave_timer = QTimer()
+        self.autosave_timer.timeout.connect(self.save_session)
+        self.autosave_timer.start(AUTOSAVE_INTERVAL_MS)
+
+        # Also fires while propagating, since progress updates process events
+        self.memory_timer = QTimer()
+        self.memory_timer.timeout.connect(self.check_memory)
+        self.memory_timer.start(MEMORY_CHECK_INTERVAL_MS)
+        self.check_memory()
+
+    def check_memory(self):
+        self.memory_governor.check()
+        self.ui.memory_label.setText(self.memory_governor.status())
+
+    def set_memory_budget(self):
+        budget, ok = QInputDialog.getDouble(self.window, "Memory Budget", "Memory budget (GB):",
+                                            self.memory_governor.budget_mb / 1024, 0.5, 1024.0, 1)
+        if ok:
+            self.memory_governor.budget_mb = budget * 1024
+            print(f"Memory budget set to: {budget} GB")
+            self.check_memory()
+
     # Video and Frame Management
     # --------------------------
     def load_video_or_frames(self):
+        if not self.confirm_reload():
+            return
+
+        video_dir = QFileDialog.getExistingDirectory(self.window, "Select Video Directory", self.default_load_dir)
+        self.load_frame_source(video_dir)
+
+    def load_video_file(self):
+        if not self.confirm_reload():
+            return
+
+        patterns = " ".join(f"*{ext}" for ext in VIDEO_EXTENSIONS)
+        video_file = QFileDialog.getOpenFileName(self.window, "Select Video File", self.default_load_dir,
+                                                 f"Video files ({patterns})")[0]
+        self.load_frame_source(video_file)
+
+    def confirm_reload(self):
         if self.video_dir:
             reply = QMessageBox.question(self.window, 'Confirm Reload', 
                                         'Are you sure you want to load a new video? This will reset all current work.',
                                         QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
             if reply == QMessageBox.No:
-                return
+                return False
+        return True
 
-        self.video_dir = QFileDialog.getExistingDirectory(self.window, "Select Video Directory", self.default_load_dir)
+    def load_frame_source(self, path):
+        self.video_dir = path
         if self.video_dir:
-            self.frame_names = [
-                f for f in os.listdir(self.video_dir) if f.endswith(('.jpg', '.jpeg', '.JPG', '.JPEG', '.png', '.PNG'))
-            ]
-            self.frame_names.sort(key=lambda f: int(os.path.splitext(f)[0]))
+            try:
+                self.frame_source = open_frame_source(self.video_dir)
+            except ValueError as e:
+                QMessageBox.critical(self.window, "Error", str(e))
+                self.video_dir = None
+                return
+            self.frame_names = [self.frame_source.frame_name(i) for i in range(len(self.frame_source))]
 
             if self.frame_names:
                 self.current_frame_idx = 0
-                self.current_image = cv2.imread(os.path.join(self.video_dir, self.frame_names[self.current_frame_idx]))
+                self.current_image = self.read_frame(self.current_frame_idx)
                 self.update_display(self.current_image)
 
                 progress = QProgressDialog("Initializing SAM2 Predictor...", None, 0, 0, self.window)
@@ -232,7 +341,7 @@ class SAM2Interface:
                     QApplication.processEvents()
 
                 try:
-                    self.sam2_predictor.initialize_predictor(self.video_dir, progress_callback=update_progress)
+                    self.sam2_predictor.initialize_predictor(self.frame_source, progress_callback=update_progress)
                 except Exception as e:
                     QMessageBox.critical(self.window, "Error", f"Failed to initialize SAM2 Predictor: {str(e)}")
                     progress.close()
@@ -241,13 +350,17 @@ class SAM2Interface:
                 progress.close()
 
                 print(f"Loaded video frames from {self.video_dir}")
+                self.history.clear()
+                self.session_file = None
+                self.previous_segments = None
+                self.ui.propagate_correction_btn.setEnabled(False)
                 self.masks_propagated = False
                 self.first_mask_created = False
                 self.ui.enable_buttons_after_video_load()
-                self.ui.set_delete_buttons_enabled(True)
-                self.input_folder_name = os.path.basename(self.video_dir)
+                self.input_folder_name = self.frame_source.name
 
                 self.ui.load_coco_btn.setEnabled(True)
+                return True
             else:
                 QMessageBox.warning(self.window, "Warning", "No frames found in the selected folder.")
         else:
@@ -263,23 +376,22 @@ class SAM2Interface:
 
         if new_idx != self.current_frame_idx:
             if direction == "right":
-                if self.masks and any(np.any(mask) for mask in self.masks.values()):
+                if self.masks and any(mask_any(mask) for mask in self.masks.values()):
                     # self.export_current_frame_to_coco()
 
                     tracked_objects = self.object_manager.get_tracked_objects()
                     self.video_segments = self.sam2_predictor.propagate_masks(
                         start_frame_idx=self.current_frame_idx,
                         max_frame_num_to_track=2,
-                        tracked_objects=tracked_objects
+                        tracked_objects=tracked_objects,
+                        seed_masks=self.masks
                     )
+                    self.record_object_spans()
                     
-                    non_tracked_objects = self.object_manager.get_non_tracked_objects()
-                    for obj_id in non_tracked_objects:
+                    for obj_id in self.object_manager.get_non_tracked_objects():
                         current_mask = self.masks.get(obj_id)
                         if current_mask is not None:
-                            if new_idx not in self.video_segments:
-                                self.video_segments[new_idx] = {}
-                            self.video_segments[new_idx][obj_id] = current_mask
+                            self.object_manager.set_static_mask(obj_id, current_mask, self.current_frame_idx, new_idx + 1)
 
                     self.masks_propagated = True
                     self.ui.export_btn.setEnabled(True)
@@ -288,48 +400,130 @@ class SAM2Interface:
                     self.ui.add_obj_btn.setEnabled(False)
                     self.ui.propagate_btn.setEnabled(False)
                     self.ui.load_coco_btn.setEnabled(False)
-                    self.ui.set_delete_buttons_enabled(False)
 
-            self.current_frame_idx = new_idx
-            self.current_image = cv2.imread(os.path.join(self.video_dir, self.frame_names[self.current_frame_idx]))
-            self.prompts = {}
-            
-            if self.current_frame_idx in self.video_segments:
-                self.masks.update(self.video_segments[self.current_frame_idx])
-            else:
-                tracked_objects = self.object_manager.get_tracked_objects()
-                for obj_id in tracked_objects:
-                    if obj_id in self.masks:
-                        del self.masks[obj_id]
-            
-            self.update_display(self.current_image)
+            self.go_to_frame(new_idx)
+
+    def go_to_frame(self, frame_idx):
+        self.current_frame_idx = frame_idx
+        self.current_image = self.read_frame(self.current_frame_idx)
+        self.prompts = {}
+        
+        frame_masks = self.video_segments[self.current_frame_idx] if self.current_frame_idx in self.video_segments else {}
+        # Tracked objects without a mask here (not propagated this far, or dropped after
+        # being lost) are not shown
+        for obj_id in self.object_manager.get_tracked_objects():
+            if obj_id in self.masks and obj_id not in frame_masks:
+                del self.masks[obj_id]
+        self.masks.update(frame_masks)
+        self.masks.update(self.object_manager.get_static_masks(self.current_frame_idx))
+        
+        self.update_display(self.current_image)
+
+    def record_object_spans(self):
+        for obj_id, (start, end) in self.sam2_predictor.object_spans.items():
+            self.object_manager.add_active_span(obj_id, start, end + 1)
+
+    def jump_to_suspicious(self, direction):
+        # Skips straight to the next frame the quality monitor flagged during propagation
+        if direction == "right":
+            frame_idx = self.quality.next_flagged(self.current_frame_idx)
+        else:
+            frame_idx = self.quality.previous_flagged(self.current_frame_idx)
+
+        if frame_idx is None:
+            QMessageBox.information(self.window, "Review", "No more frames flagged for review in this direction.")
+            return
+        self.go_to_frame(frame_idx)
+
+    def read_frame(self, frame_idx):
+        with profiler.span('frame.read'):
+            return self.frame_source.read(frame_idx)
     
     # Display Update
     # --------------
     def update_display(self, image):
+        with profiler.span('display.update'):
+            self._update_display(image)
+
+    def _update_display(self, image):
         if image is not None:
-            self.ui.mpl_widget.clear()
             self.ui.mpl_widget.show_image(image)
-            self.ui.frame_info_label.setText(f'Current Frame: {self.current_frame_idx + 1} / {len(self.frame_names)}')
-
+            region, step = self.ui.mpl_widget.render_region, self.ui.mpl_widget.render_step
+            frame_info = f'Current Frame: {self.current_frame_idx + 1} / {len(self.frame_names)}'
+            review = self.quality.describe(self.current_frame_idx, {obj_id: obj_data['category_name']
+                                                                    for obj_id, obj_data in self.object_manager.get_all_objects().items()})
+            if review:
+                frame_info += f'  |  Review: {review}'
+            self.ui.frame_info_label.setText(frame_info)
+
+            frame_masks = None
             if self.current_frame_idx in self.video_segments:
-                self.masks.update(self.video_segments[self.current_frame_idx])
+                frame_masks = self.video_segments[self.current_frame_idx]
+                self.masks.update(frame_masks)
+
+            # Masks still coming straight from a label map are drawn together in one image
+            layered = set()
+            if isinstance(frame_masks, LabelMap):
+                layered = {obj_id for obj_id, mask in self.masks.items()
+                           if obj_id in self.object_manager.get_all_objects() and obj_id in frame_masks and frame_masks[obj_id] is mask}
+                show_label_map(frame_masks, self.ui.mpl_widget.ax, layered, region, step)
 
             for obj_id, mask in self.masks.items():
                 if obj_id in self.object_manager.get_all_objects():
-                    show_mask(mask, self.ui.mpl_widget.ax, obj_id)
+                    if obj_id not in layered:
+                        show_mask(mask, self.ui.mpl_widget.ax, obj_id, region=region, step=step)
                     category_name = self.object_manager.get_object(obj_id)['category_name']
-                    bbox = show_mask_with_contours_and_bbox(mask, self.ui.mpl_widget.ax, obj_id, category_name)
-                    if self.current_frame_idx not in self.object_bboxes:
-                        self.object_bboxes[self.current_frame_idx] = {}
-                    self.object_bboxes[self.current_frame_idx][obj_id] = bbox
+                    geometry = self.geometry.lookup(self.current_frame_idx, obj_id, mask)
+                    show_mask_with_contours_and_bbox(mask, self.ui.mpl_widget.ax, obj_id, category_name, geometry=geometry,
+                                                     region=region, step=step)
 
-            self.ui.mpl_widget.canvas.draw()
+            if self.current_object_id in self.prompts:
+                coords, labels = self.prompts[self.current_object_id]
+                show_points(coords, labels, self.ui.mpl_widget.ax)
+
+            if self.show_perf_overlay:
+                self.draw_perf_overlay()
+
+            with profiler.span('display.draw'):
+                self.ui.mpl_widget.canvas.draw()
+
+    def draw_perf_overlay(self):
+        lines = []
+        display_fps = profiler.rate('display.update')
+        if display_fps is not None:
+            lines.append(f"display: {display_fps:5.1f} fps")
+        for name in ('display.update', 'display.draw', 'frame.read', 'propagate.inference', 'propagate.transfer', 'export.save'):
+            stats = profiler.stats(name)
+            if stats is not None:
+                lines.append(f"{name:<20} p50 {stats['p50_ms']:7.1f} ms  p90 {stats['p90_ms']:7.1f} ms")
+        if lines:
+            self.ui.mpl_widget.ax.text(0.01, 0.99, "\n".join(lines), transform=self.ui.mpl_widget.ax.transAxes,
+                                       color='white', fontsize=8, family='monospace', va='top', ha='left',
+                                       bbox=dict(facecolor='black', edgecolor='none', alpha=0.6))
+
+    def toggle_perf_overlay(self):
+        self.show_perf_overlay = not self.show_perf_overlay
+        self.update_display(self.current_image)
+
+    def export_profile(self):
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        default_file = os.path.join(self.default_export_dir, f"profile_{timestamp}.json")
+        profile_file = QFileDialog.getSaveFileName(self.window, "Save Profile Trace", default_file, "JSON files (*.json)")[0]
+        if not profile_file:
+            return
+
+        profiler.export_chrome_trace(profile_file)
+        summary = profiler.format_summary()
+        print(summary)
+        QMessageBox.information(self.window, "Profile Exported",
+                                f"Chrome trace written to {profile_file}\n"
+                                "Open it in chrome://tracing or ui.perfetto.dev.\n\n" + summary)
 
     # Mask Creation and Management
     # ----------------------------
     def on_click(self, event):
-        if self.current_image is None or event.inaxes != self.ui.mpl_widget.ax:
+        # The middle button pans the view
+        if self.current_image is None or event.inaxes != self.ui.mpl_widget.ax or event.button not in (1, 3):
             return
         
         if self.current_object_id is None:
@@ -345,8 +539,12 @@ class SAM2Interface:
         else:
             return
         
-        self.update_click_prompts(self.current_object_id, x, y, click_type_val)
+        obj_id = self.current_object_id
+        prompts_before, mask_before = self.prompts.get(obj_id), self.masks.get(obj_id)
+        self.update_click_prompts(obj_id, x, y, click_type_val)
         self.update_mask()
+        self.history.push(PromptCommand(self.current_frame_idx, obj_id, prompts_before, self.prompts.get(obj_id),
+                                        mask_before, self.masks.get(obj_id)))
         
         if not self.first_mask_created:
             self.first_mask_created = True
@@ -355,9 +553,13 @@ class SAM2Interface:
             self.ui.propagate_and_export_btn.setEnabled(True)
 
     def update_mask(self):
+        with profiler.span('display.mask_update'):
+            self._update_mask()
+
+    def _update_mask(self):
         if self.current_image is not None:
-            self.ui.mpl_widget.clear()
             self.ui.mpl_widget.show_image(self.current_image)
+            region, step = self.ui.mpl_widget.render_region, self.ui.mpl_widget.render_step
 
             if self.current_object_id is not None:
                 coords, labels = self.prompts.get(self.current_object_id, (None, None))
@@ -366,9 +568,11 @@ class SAM2Interface:
                     self.masks[self.current_object_id] = mask
             
             for obj_id, mask in self.masks.items():
-                show_mask(mask, self.ui.mpl_widget.ax, obj_id)
+                show_mask(mask, self.ui.mpl_widget.ax, obj_id, region=region, step=step)
                 category_name = self.object_manager.get_object(obj_id)['category_name']
-                show_mask_with_contours_and_bbox(mask, self.ui.mpl_widget.ax, obj_id, category_name)
+                geometry = self.geometry.lookup(self.current_frame_idx, obj_id, mask)
+                show_mask_with_contours_and_bbox(mask, self.ui.mpl_widget.ax, obj_id, category_name, geometry=geometry,
+                                                 region=region, step=step)
                 self.object_manager.update_last_valid_mask(obj_id, mask)
 
             if self.current_object_id in self.prompts:
@@ -378,14 +582,13 @@ class SAM2Interface:
             self.ui.mpl_widget.canvas.draw()
 
     def create_mask(self, frame_idx, obj_id, coords, labels):
-        out_mask_logits = self.sam2_predictor.generate_mask_with_points(frame_idx, obj_id, coords, labels)
+        mask = self.sam2_predictor.predict_mask_with_points(frame_idx, obj_id, coords, labels)
         
-        if len(out_mask_logits) > 0:
-            return (out_mask_logits[obj_id] > 0.0).cpu().numpy()
+        if mask is not None:
+            return mask
         else:
             print(f"Warning: No mask generated for object {obj_id}. Using empty mask.")
-            height, width = self.current_image.shape[:2]
-            return np.zeros((height, width), dtype=bool)
+            return SparseMask.empty(self.current_image.shape[:2])
 
     def update_click_prompts(self, object_id, x, y, click_type_val):
         if object_id not in self.prompts:
@@ -398,7 +601,7 @@ class SAM2Interface:
 
     # Mask Propagation
     # ----------------
-    def propagate_masks(self, type=None, max_frame_num_to_track=None):
+    def propagate_masks(self, type=None, max_frame_num_to_track=None, correction=False):
         if not self.video_dir:
             QMessageBox.warning(self.window, "Warning", "Please load a video first.")
             return
@@ -424,23 +627,40 @@ class SAM2Interface:
             progress.setValue(min(progress_value, 90))
             QApplication.processEvents()
 
+        # Only on request: a plain propagation after a reset recomputes every later frame
+        correction = correction and max_frame_num_to_track is None and self.previous_segments is not None and any(
+            frame_idx > self.current_frame_idx for frame_idx in self.previous_segments)
+
         try:
             tracked_objects = self.object_manager.get_tracked_objects()
-            self.video_segments = self.sam2_predictor.propagate_masks(
-                start_frame_idx=self.current_frame_idx,
-                max_frame_num_to_track=max_frame_num_to_track,
-                progress_callback=update_progress,
-                tracked_objects=tracked_objects
-            )
-
-            non_tracked_objects = self.object_manager.get_non_tracked_objects()
-            for obj_id in non_tracked_objects:
+            if correction:
+                # After a fix, only re-propagate until the new masks agree with the old ones
+                self.video_segments, last_frame = self.sam2_predictor.propagate_correction(
+                    self.previous_segments,
+                    start_frame_idx=self.current_frame_idx,
+                    progress_callback=update_progress,
+                    tracked_objects=tracked_objects,
+                    seed_masks=self.masks
+                )
+                end_frame = last_frame + 1
+            else:
+                self.video_segments = self.sam2_predictor.propagate_masks(
+                    start_frame_idx=self.current_frame_idx,
+                    max_frame_num_to_track=max_frame_num_to_track,
+                    progress_callback=update_progress,
+                    tracked_objects=tracked_objects,
+                    seed_masks=self.masks
+                )
+            self.previous_segments = None
+            self.ui.propagate_correction_btn.setEnabled(False)
+            self.record_object_spans()
+
+            # Non-tracked objects keep their current mask as one run of frames rather than
+            # a copy per frame
+            for obj_id in self.object_manager.get_non_tracked_objects():
                 current_mask = self.masks.get(obj_id)
                 if current_mask is not None:
-                    for frame_idx in range(self.current_frame_idx, end_frame):
-                        if frame_idx not in self.video_segments:
-                            self.video_segments[frame_idx] = {}
-                        self.video_segments[frame_idx][obj_id] = current_mask
+                    self.object_manager.set_static_mask(obj_id, current_mask, self.current_frame_idx, end_frame)
 
         except Exception as e:
             QMessageBox.critical(self.window, "Error", f"An error occurred during mask propagation: {str(e)}")
@@ -449,7 +669,10 @@ class SAM2Interface:
 
         progress.close()
 
-        print(f"Propagation completed from frame {self.current_frame_idx + 1} to the end.")
+        if correction:
+            print(f"Correction propagated from frame {self.current_frame_idx + 1} to frame {end_frame}; later frames kept.")
+        else:
+            print(f"Propagation completed from frame {self.current_frame_idx + 1} to the end.")
 
         progress.setValue(95)
         self.masks_propagated = True
@@ -459,14 +682,69 @@ class SAM2Interface:
         self.ui.add_obj_btn.setEnabled(False)
         self.ui.propagate_btn.setEnabled(False)
         self.ui.load_coco_btn.setEnabled(False)
-        self.ui.set_delete_buttons_enabled(False)
+        self.ui.update_table()
 
         progress.setValue(100)
         progress.close()
 
-        if type is None:
+        if type is None and correction:
+            QMessageBox.information(self.window, "Propagation Complete",
+                                    f"Re-propagated frames {self.current_frame_idx + 1} to {end_frame}, where the masks matched the "
+                                    "previous propagation again. Later frames were kept.")
+        elif type is None:
             QMessageBox.information(self.window, "Propagation Complete", "Mask propagation is complete. You can now start COCO export.")
 
+    def toggle_roi_mode(self):
+        # Track each object in a crop around its bbox instead of the full frame; meant for
+        # small objects in 4K/8K footage
+        self.sam2_predictor.roi_mode = self.ui.roi_mode_btn.isChecked()
+        self.ui.roi_mode_btn.setText(f"ROI Tracking: {'On' if self.sam2_predictor.roi_mode else 'Off'}")
+        print(f"ROI tracking set to: {self.sam2_predictor.roi_mode}")
+
+    def toggle_label_map_mode(self):
+        # Store propagated frames as one object-id image each; overlapping objects are
+        # resolved by the highest logit. Takes effect from the next propagation.
+        self.sam2_predictor.label_map_mode = self.ui.label_map_btn.isChecked()
+        self.ui.label_map_btn.setText(f"Label Maps: {'On' if self.sam2_predictor.label_map_mode else 'Off'}")
+        print(f"Label map mode set to: {self.sam2_predictor.label_map_mode}")
+
+    def toggle_prune_lost_objects(self):
+        # Objects lost for LOST_FRAMES frames in a row stop being tracked until they are
+        # prompted again. Takes effect from the next propagation.
+        self.sam2_predictor.prune_lost_objects = self.ui.prune_btn.isChecked()
+        self.ui.prune_btn.setText(f"Drop Lost Objects: {'On' if self.sam2_predictor.prune_lost_objects else 'Off'}")
+        print(f"Dropping lost objects set to: {self.sam2_predictor.prune_lost_objects}")
+
+    def toggle_sharded_export(self):
+        # "Propagate and Export All" splits the video into windows starting on prompted
+        # frames and propagates them in parallel worker processes
+        self.sharded_export = self.ui.sharded_btn.isChecked()
+        self.ui.sharded_btn.setText(f"Sharded Export: {'On' if self.sharded_export else 'Off'}")
+        print(f"Sharded export set to: {self.sharded_export}")
+
+    def set_polygon_simplification(self):
+        # Outlines on screen and polygons in COCO exports are simplified with these settings;
+        # cached outlines are kept per setting, so switching back and forth is free
+        tolerance, ok = QInputDialog.getDouble(self.window, "Polygon Simplification",
+                                               "Tolerance in pixels (0 keeps every vertex):",
+                                               simplification.tolerance, 0.0, 20.0, 1)
+        if not ok:
+            return
+        min_area, ok = QInputDialog.getDouble(self.window, "Polygon Simplification",
+                                              "Drop polygons smaller than (square pixels):",
+                                              simplification.min_area, 0.0, 10000.0, 1)
+        if not ok:
+            return
+        self.apply_polygon_simplification(tolerance, min_area)
+        if self.current_image is not None:
+            self.update_display(self.current_image)
+
+    def apply_polygon_simplification(self, tolerance, min_area):
+        simplification.tolerance = tolerance
+        simplification.min_area = min_area
+        self.ui.polygon_btn.setText(self.ui.polygon_button_text())
+        print(f"Polygon simplification set to: tolerance {tolerance} px, min area {min_area} px²")
+
     # Object Management
     # -----------------
     def prepare_new_object(self):
@@ -474,24 +752,39 @@ class SAM2Interface:
         category_name = f"Object {new_obj_id}"
         color = get_object_color(new_obj_id)
         self.object_manager.add_object(new_obj_id, category_name, color)
+        self.history.push(AddObjectCommand(new_obj_id, self.object_manager.get_object(new_obj_id)))
         self.ui.update_table()
         self.current_object_id = new_obj_id
         print(f"Prepared new object with ID {new_obj_id}")
 
-    def on_category_name_change(self, item):
-        if item.column() == 1:  # Category name column
-            new_name = item.text()
-            obj_id = list(self.object_manager.get_all_objects().keys())[item.row()]
-            self.object_manager.update_category_name(obj_id, new_name)
-            print(f"Category {obj_id} renamed to: {new_name}")
+    @property
+    def current_object_id(self):
+        return self._current_object_id
+
+    @current_object_id.setter
+    def current_object_id(self, obj_id):
+        # The re-segment column shows the selected object, so only the old and new rows repaint
+        previous = getattr(self, '_current_object_id', None)
+        self._current_object_id = obj_id
+        self.ui.table_model.refresh_object(previous)
+        self.ui.table_model.refresh_object(obj_id)
+
+    def on_category_name_change(self, obj_id, new_name):
+        old_name = self.object_manager.get_object(obj_id)['category_name']
+        if new_name == old_name:
+            return
+        self.object_manager.update_category_name(obj_id, new_name)
+        self.history.push(RenameCommand(obj_id, old_name, new_name))
+        print(f"Category {obj_id} renamed to: {new_name}")
+
+    def rename_object(self, obj_id, name):
+        self.object_manager.update_category_name(obj_id, name)
+        self.ui.update_table()
+        self.update_display(self.current_image)
 
     def on_resegment_checked(self, state, obj_id):
         if state == Qt.Checked:
-            for row in range(self.ui.table.rowCount()):
-                checkbox_widget = self.ui.table.cellWidget(row, 0)
-                if checkbox_widget.isChecked() and list(self.object_manager.get_all_objects().keys())[row] != obj_id:
-                    checkbox_widget.setChecked(False)
-            
+            # Selecting an object clears the previous selection's checkbox
             self.current_object_id = obj_id
             QMessageBox.information(self.window, "Object Selected", f"You can now edit Object {obj_id}")
         else:
@@ -506,7 +799,7 @@ class SAM2Interface:
             self.object_manager.update_last_valid_mask(obj_id, self.masks[obj_id])
         
         if tracking:
-            bbox = self.object_bboxes.get(self.current_frame_idx, {}).get(obj_id)
+            bbox = self.geometry.bbox(self.current_frame_idx, obj_id)
             if bbox is not None:
                 new_mask = self.sam2_predictor.generate_mask_with_box(self.current_frame_idx, obj_id, bbox)
                 self.masks[obj_id] = new_mask
@@ -514,21 +807,203 @@ class SAM2Interface:
 
         self.update_display(self.current_image)
 
-    def delete_object(self, obj_id):
+    def delete_object(self, obj_id, record=True):
+        # Frames spilled by the memory governor or still in a session archive stay packed
+        segments = remove_object_masks(self.video_segments, obj_id)
+        if record:
+            self.history.push(DeleteObjectCommand(obj_id, self.object_manager.get_object(obj_id), self.masks.get(obj_id), segments))
+        if self.current_object_id == obj_id:
+            self.current_object_id = None
         self.object_manager.remove_object(obj_id)
         if obj_id in self.masks:
             del self.masks[obj_id]
-        for frame in self.object_bboxes:
-            if obj_id in self.object_bboxes[frame]:
-                del self.object_bboxes[frame][obj_id]
-        # Remove the object from video_segments
-        for frame in self.video_segments:
-            if obj_id in self.video_segments[frame]:
-                del self.video_segments[frame][obj_id]
-                
+        self.geometry.remove_object(obj_id)
+        self.quality.remove_object(obj_id)
+
         self.update_display(self.current_image)
         self.ui.update_table()
 
+    def restore_object(self, obj_id, obj_data, mask, segments):
+        self.object_manager.add_object(obj_id, obj_data['category_name'], obj_data['color'], obj_data['tracking'])
+        self.object_manager.update_last_valid_mask(obj_id, obj_data['last_valid_mask'])
+        self.object_manager.restore_runs(obj_id, obj_data['static_masks'], obj_data['active_spans'])
+        if mask is not None:
+            self.masks[obj_id] = mask
+        insert_object_masks(self.video_segments, obj_id, segments)
+
+        self.update_display(self.current_image)
+        self.ui.update_table()
+
+    # Undo / Redo
+    # -----------
+    def undo(self):
+        if self.history.undo(self) is None:
+            print("Nothing to undo")
+
+    def redo(self):
+        if self.history.redo(self) is None:
+            print("Nothing to redo")
+
+    def restore_prompt_state(self, frame_idx, obj_id, prompts, mask_delta, forward):
+        if frame_idx != self.current_frame_idx:
+            self.go_to_frame(frame_idx)
+
+        # Bring the predictor's prompts for this frame back in line with the restored ones
+        if prompts is not None:
+            self.prompts[obj_id] = prompts
+            self.sam2_predictor.generate_mask_with_points(frame_idx, obj_id, *prompts)
+        else:
+            self.prompts.pop(obj_id, None)
+            self.sam2_predictor.clear_prompts(frame_idx, obj_id)
+
+        if mask_delta is not None:
+            mask = mask_delta.apply(self.masks.get(obj_id), forward)
+            targets = [self.masks]
+            if frame_idx in self.video_segments:
+                targets.append(self.video_segments[frame_idx])
+            for target in targets:
+                if mask is None:
+                    target.pop(obj_id, None)
+                else:
+                    target[obj_id] = mask
+            if mask is not None:
+                self.object_manager.update_last_valid_mask(obj_id, mask)
+
+        self.update_display(self.current_image)
+
+    # Session Save / Restore
+    # ----------------------
+    def save_session(self, choose_file=False):
+        # Called by the autosave timer with choose_file=False, which only saves sessions
+        # that already have a file
+        if not self.video_dir or self.frame_source is None:
+            return
+        if choose_file or self.session_file is None:
+            if not choose_file:
+                return
+            default_file = self.session_file or os.path.join(self.default_export_dir, f"{self.input_folder_name}{SESSION_EXTENSION}")
+            session_file = QFileDialog.getSaveFileName(self.window, "Save Session", default_file,
+                                                       f"SAM2 sessions (*{SESSION_EXTENSION})")[0]
+            if not session_file:
+                return
+            self.session_file = session_file
+
+        # Static masks are stored once each and referenced by key from their frame runs
+        static_masks = {}
+        static_keys = {}
+        static_runs = {}
+        for obj_id, obj_data in self.object_manager.get_all_objects().items():
+            runs = []
+            for start, end, mask in obj_data['static_masks']:
+                if id(mask) not in static_keys:
+                    static_keys[id(mask)] = len(static_masks)
+                    static_masks[static_keys[id(mask)]] = mask
+                runs.append([start, end, static_keys[id(mask)]])
+            static_runs[obj_id] = runs
+
+        meta = {
+            'version': SESSION_VERSION,
+            'video_path': os.path.abspath(self.video_dir),
+            'num_frames': len(self.frame_names),
+            'current_frame_idx': self.current_frame_idx,
+            'objects': [{'id': obj_id, 'category_name': obj_data['category_name'], 'tracking': obj_data['tracking'],
+                         'static_masks': static_runs[obj_id], 'active_spans': obj_data['active_spans']}
+                        for obj_id, obj_data in self.object_manager.get_all_objects().items()],
+            'prompts': {str(obj_id): [coords.tolist(), labels.tolist()] for obj_id, (coords, labels) in self.prompts.items()},
+            'prompt_log': self.sam2_predictor.compacted_prompt_log(),
+            'suspended': {str(obj_id): frame_idx for obj_id, frame_idx in self.sam2_predictor.suspended.items()},
+            'masks_propagated': self.masks_propagated,
+            'first_mask_created': self.first_mask_created,
+            'roi_mode': self.sam2_predictor.roi_mode,
+            'label_map_mode': self.sam2_predictor.label_map_mode,
+            'prune_lost_objects': self.sam2_predictor.prune_lost_objects,
+            'polygon_simplification': [simplification.tolerance, simplification.min_area],
+            'coco_export_file': self.coco_export_file,
+        }
+        try:
+            memory = self.sam2_predictor.export_memory(self.current_frame_idx)
+        except Exception as e:
+            print(f"Predictor memory not saved: {str(e)}")
+            memory = None
+        self.session_saver.save(self.session_file, meta, dict(self.masks), snapshot_segments(self.video_segments), memory,
+                                static_masks)
+
+    def load_session(self):
+        if not self.confirm_reload():
+            return
+
+        session_file = QFileDialog.getOpenFileName(self.window, "Select Session File", self.default_export_dir,
+                                                   f"SAM2 sessions (*{SESSION_EXTENSION})")[0]
+        if not session_file:
+            return
+
+        try:
+            meta, current_masks, segments, memory, static_masks = read_session(session_file)
+        except Exception as e:
+            QMessageBox.critical(self.window, "Error", f"Failed to read session: {str(e)}")
+            return
+
+        if not os.path.exists(meta['video_path']):
+            QMessageBox.critical(self.window, "Error", f"Video source not found: {meta['video_path']}")
+            return
+        if not self.load_frame_source(meta['video_path']):
+            return
+        if len(self.frame_names) != meta['num_frames']:
+            QMessageBox.warning(self.window, "Warning", "The video has a different number of frames than when the session was saved.")
+
+        self.object_manager.clear()
+        for obj in meta['objects']:
+            self.object_manager.add_object(obj['id'], obj['category_name'], get_object_color(obj['id']), obj['tracking'])
+            for start, end, key in obj.get('static_masks', []):
+                self.object_manager.set_static_mask(obj['id'], static_masks[key], start, end)
+            for start, end in obj.get('active_spans', []):
+                self.object_manager.add_active_span(obj['id'], start, end)
+
+        # Rebuild the predictor's conditioning frames, then the memory around the current frame
+        self.sam2_predictor.replay_prompts(meta['prompt_log'])
+        self.sam2_predictor.suspended = {int(obj_id): frame_idx for obj_id, frame_idx in meta.get('suspended', {}).items()}
+        if memory is not None:
+            try:
+                self.sam2_predictor.import_memory(memory)
+            except Exception as e:
+                print(f"Predictor memory not restored: {str(e)}")
+
+        self.video_segments = segments
+        self.previous_segments = None
+        self.ui.propagate_correction_btn.setEnabled(False)
+        self.current_frame_idx = meta['current_frame_idx']
+        self.current_image = self.read_frame(self.current_frame_idx)
+        self.prompts = {int(obj_id): (np.array(coords), np.array(labels)) for obj_id, (coords, labels) in meta['prompts'].items()}
+        self.masks = current_masks
+        for obj_id, mask in self.masks.items():
+            self.object_manager.update_last_valid_mask(obj_id, mask)
+        self.masks_propagated = meta['masks_propagated']
+        self.first_mask_created = meta['first_mask_created']
+        self.coco_export_file = meta['coco_export_file']
+        self.session_file = session_file
+        self.ui.roi_mode_btn.setChecked(meta['roi_mode'])
+        self.toggle_roi_mode()
+        self.ui.label_map_btn.setChecked(meta.get('label_map_mode', False))
+        self.toggle_label_map_mode()
+        self.ui.prune_btn.setChecked(meta.get('prune_lost_objects', False))
+        self.toggle_prune_lost_objects()
+        if 'polygon_simplification' in meta:
+            self.apply_polygon_simplification(*meta['polygon_simplification'])
+
+        if self.first_mask_created:
+            self.ui.save_curr_coco_btn.setEnabled(True)
+            self.ui.propagate_and_export_btn.setEnabled(True)
+            self.ui.propagate_btn.setEnabled(not self.masks_propagated)
+        if self.masks_propagated:
+            self.ui.export_btn.setEnabled(True)
+            self.ui.reset_btn.setEnabled(True)
+            self.ui.add_obj_btn.setEnabled(False)
+            self.ui.load_coco_btn.setEnabled(False)
+
+        self.ui.update_table()
+        self.update_display(self.current_image)
+        print(f"Restored session from {session_file}")
+
     # COCO Export
     # -----------
     def initialize_coco_export(self):
@@ -584,6 +1059,93 @@ class SAM2Interface:
         QMessageBox.information(self.window, "COCO Export", f"COCO export initialized.\nData will be {'updated' if use_existing else 'written'} to {self.coco_export_file}")
 
 
+    def export_video_coco(self):
+        # Whole-video export with one track per object, written in a single pass over the
+        # propagated masks (frames without masks get an image entry only)
+        if not self.video_dir:
+            QMessageBox.warning(self.window, "Warning", "Please load a video first.")
+            return
+
+        objects = {obj_id: obj_data['category_name'] for obj_id, obj_data in self.object_manager.get_all_objects().items()}
+        if not objects:
+            QMessageBox.warning(self.window, "Warning", "Please add at least one object before exporting.")
+            return
+
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        default_file = os.path.join(self.default_export_dir, f"{self.input_folder_name}_{timestamp}_vid.json")
+        export_file = QFileDialog.getSaveFileName(self.window, "Save Video COCO JSON File", default_file, "JSON files (*.json)")[0]
+        if not export_file:
+            return
+
+        # Unpropagated edits on the current frame are exported as shown
+        segments = self.object_manager.resolve(self.video_segments)
+        overrides = {self.current_frame_idx: self.masks} if self.masks and self.current_frame_idx not in segments else None
+
+        total_frames = len(self.frame_names)
+        progress = QProgressDialog("Exporting video annotations...", None, 0, total_frames, self.window)
+        progress.setWindowModality(Qt.WindowModal)
+        progress.setWindowTitle("Video COCO Export")
+        progress.show()
+
+        def update_progress(frame_idx):
+            if frame_idx % 50 == 0:
+                progress.setValue(frame_idx)
+                QApplication.processEvents()
+
+        try:
+            export_video_segments(export_file, self.input_folder_name, self.frame_names, self.frame_source.frame_size(0),
+                                  segments, objects, self.geometry, progress_callback=update_progress,
+                                  overrides=overrides)
+        except Exception as e:
+            QMessageBox.critical(self.window, "Error", f"Failed to export video annotations: {str(e)}")
+            return
+        finally:
+            progress.close()
+        QMessageBox.information(self.window, "Export Complete", f"Video annotations written to {export_file}")
+
+    def export_mask_archive(self):
+        # Per-frame label images (palette PNG, chunked NPZ or Zarr) for training dataloaders
+        if not self.video_dir:
+            QMessageBox.warning(self.window, "Warning", "Please load a video first.")
+            return
+
+        all_objects = self.object_manager.get_all_objects()
+        if not all_objects:
+            QMessageBox.warning(self.window, "Warning", "Please add at least one object before exporting.")
+            return
+
+        export_format, ok = QInputDialog.getItem(self.window, "Export Mask Archive", "Format:", list(EXPORT_FORMATS), 0, False)
+        if not ok:
+            return
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        default_dir = os.path.join(self.default_export_dir, f"{self.input_folder_name}_{timestamp}_masks")
+        output_dir = QFileDialog.getSaveFileName(self.window, "Mask Archive Folder", default_dir, "Folders (*)")[0]
+        if not output_dir:
+            return
+
+        objects = {obj_id: obj_data['category_name'] for obj_id, obj_data in all_objects.items()}
+        colors = {obj_id: obj_data['color'].getRgb()[:3] for obj_id, obj_data in all_objects.items()}
+        progress = QProgressDialog("Encoding masks...", None, 0, 1, self.window)
+        progress.setWindowModality(Qt.WindowModal)
+        progress.setWindowTitle("Mask Archive Export")
+        progress.show()
+
+        def update_progress(done, total):
+            progress.setMaximum(total)
+            progress.setValue(done)
+            QApplication.processEvents()
+
+        try:
+            exporter = MaskArchiveExporter(output_dir, export_format, self.frame_names, self.frame_source.frame_size(0),
+                                           objects, colors)
+            exporter.export(self.object_manager.resolve(self.video_segments), progress_callback=update_progress)
+        except Exception as e:
+            QMessageBox.critical(self.window, "Error", f"Failed to export masks: {str(e)}")
+            return
+        finally:
+            progress.close()
+        QMessageBox.information(self.window, "Export Complete", f"Mask archive written to {output_dir}")
+
     def export_current_frame_to_coco(self):
         if self.coco_exporter is None:
             self.initialize_coco_export()
@@ -599,20 +1161,20 @@ class SAM2Interface:
             height=self.current_image.shape[0]
         )
 
-        self.coco_exporter.coco_data['annotations'] = [
-            ann for ann in self.coco_exporter.coco_data['annotations'] 
-            if ann['image_id'] != image_id
-        ]
+        self.coco_exporter.clear_annotations(image_id)
 
-        if self.current_frame_idx not in self.video_segments:
+        # Propagated masks plus static masks of non-tracked objects, as the other exporters
+        # write them; unpropagated edits on the current frame are exported as shown
+        segments = self.object_manager.resolve(self.video_segments)
+        if self.current_frame_idx not in segments:
             masks_to_export = self.masks
         else:
-            masks_to_export = self.video_segments[self.current_frame_idx]
+            masks_to_export = segments[self.current_frame_idx]
 
         for obj_id, mask in masks_to_export.items():
             if obj_id in self.object_manager.get_all_objects():
-                if np.any(mask):
-                    self.coco_exporter.add_annotation(image_id, obj_id + 1, mask)
+                geometry = self.geometry.lookup(self.current_frame_idx, obj_id, mask)
+                self.coco_exporter.add_annotation(image_id, obj_id + 1, mask, geometry)
 
         self.coco_exporter.update_file()
 
@@ -644,11 +1206,21 @@ class SAM2Interface:
             progress.setLabelText(f"Propagating masks: {frame_count}/{total_frames}")
             QApplication.processEvents()
 
-        self.video_segments = self.sam2_predictor.propagate_masks(
-            start_frame_idx=0,
-            max_frame_num_to_track=None,
-            progress_callback=update_propagation_progress
-        )
+        if self.sharded_export:
+            try:
+                self.video_segments = propagate_sharded(self.sam2_predictor, self.frame_source,
+                                                        progress_callback=update_propagation_progress)
+            except Exception as e:
+                QMessageBox.critical(self.window, "Error", f"Sharded propagation failed: {str(e)}")
+                progress.close()
+                return
+        else:
+            self.video_segments = self.sam2_predictor.propagate_masks(
+                start_frame_idx=0,
+                max_frame_num_to_track=None,
+                progress_callback=update_propagation_progress
+            )
+        self.record_object_spans()
 
         if progress.wasCanceled():
             return
@@ -664,6 +1236,7 @@ class SAM2Interface:
             progress.close()
             return 
 
+        segments = self.object_manager.resolve(self.video_segments)
         for frame_idx in range(total_frames):
             if progress.wasCanceled():
                 break
@@ -672,29 +1245,34 @@ class SAM2Interface:
             progress.setLabelText(f"Exporting COCO data: {frame_idx + 1}/{total_frames}")
             QApplication.processEvents()
 
+            height, width = self.frame_source.frame_size(frame_idx)
             image_id = self.coco_exporter.add_image(
                 frame_number=frame_idx,
                 file_name=self.frame_names[frame_idx],
-                width=self.current_image.shape[1],
-                height=self.current_image.shape[0]
+                width=width,
+                height=height
             )
 
-            if frame_idx in self.video_segments:
-                for obj_id, mask in self.video_segments[frame_idx].items():
+            if frame_idx in segments:
+                for obj_id, mask in segments[frame_idx].items():
                     if obj_id in self.object_manager.get_all_objects():
-                        self.coco_exporter.add_annotation(image_id, obj_id + 1, mask)
+                        geometry = self.geometry.lookup(frame_idx, obj_id, mask)
+                        self.coco_exporter.add_annotation(image_id, obj_id + 1, mask, geometry)
 
         self.coco_exporter.update_file()
+        review_file = self.quality.save(os.path.splitext(self.coco_export_file)[0] + '_review.json')
         progress.close()
 
-        QMessageBox.information(self.window, "Export Complete", "Mask propagation and COCO export completed for all frames.")
+        QMessageBox.information(self.window, "Export Complete",
+                                "Mask propagation and COCO export completed for all frames.\n"
+                                f"{len(self.quality.flagged)} frames flagged for review (N / Shift+N to step through them), "
+                                f"listed in {review_file}")
 
         self.ui.export_btn.setEnabled(False)
         self.ui.reset_btn.setEnabled(True)
         self.ui.add_obj_btn.setEnabled(False)
         self.ui.propagate_btn.setEnabled(False)
         self.ui.load_coco_btn.setEnabled(False)
-        self.ui.set_delete_buttons_enabled(False)
 
     # COCO Loading
     # ----------------
@@ -709,20 +1287,20 @@ class SAM2Interface:
 
         self.coco_export_file = coco_file
 
-        coco_data = self.load_coco_data(coco_file)
-        if not coco_data:
+        coco_index = self.load_coco_data(coco_file)
+        if coco_index is None:
             QMessageBox.warning(self.window, "Error", "Failed to load COCO data.")
             return
 
-        last_frame = self.get_last_annotated_frame(coco_data)
+        last_frame = self.get_last_annotated_frame(coco_index)
         if last_frame is None:
             QMessageBox.warning(self.window, "Error", "No valid annotations found.")
             return
 
         self.current_frame_idx = last_frame - 1
-        self.current_image = cv2.imread(os.path.join(self.video_dir, self.frame_names[self.current_frame_idx]))
+        self.current_image = self.read_frame(self.current_frame_idx)
 
-        self.generate_masks_from_annotations(coco_data)
+        self.generate_masks_from_annotations(coco_index)
         self.propagate_masks(type='LOAD', max_frame_num_to_track=3)
         self.navigate_frame("right")
         self.reset_inference_state(type='LOAD')
@@ -739,27 +1317,28 @@ class SAM2Interface:
             return
 
         self.coco_export_file = coco_file
-        coco_data = self.load_coco_data(coco_file)
-        if not coco_data:
+        coco_index = self.load_coco_data(coco_file)
+        if coco_index is None:
             QMessageBox.warning(self.window, "Error", "Failed to load COCO data.")
             return
 
         self.object_manager.clear()
         self.masks.clear()
-        self.object_bboxes.clear()
+        self.geometry.clear()
+        self.history.clear()
 
-        for category in coco_data['categories']:
+        for category in coco_index.categories:
             category_id = category['id']
             obj_id = category_id - 1
             category_name = category['name']
             color = get_object_color(obj_id)
             self.object_manager.add_object(obj_id, category_name, color)
 
-        current_frame_annotations = [ann for ann in coco_data['annotations'] if ann['image_id'] == self.current_frame_idx + 1]
+        current_frame_annotations = coco_index.annotations_for(self.current_frame_idx + 1)
+        coco_index.close()
         
-        height, width = self.current_image.shape[:2]
         for obj_id in self.object_manager.get_all_objects():
-            self.masks[obj_id] = np.zeros((height, width), dtype=bool)
+            self.masks[obj_id] = SparseMask.empty(self.current_image.shape[:2])
 
         for annotation in current_frame_annotations:
             category_id = annotation['category_id']
@@ -771,9 +1350,7 @@ class SAM2Interface:
                 mask = self.sam2_predictor.generate_mask_with_box(self.current_frame_idx, obj_id, box)
                 if mask is not None:
                     self.masks[obj_id] = mask
-                    if self.current_frame_idx not in self.object_bboxes:
-                        self.object_bboxes[self.current_frame_idx] = {}
-                    self.object_bboxes[self.current_frame_idx][obj_id] = box
+                    self.geometry.lookup(self.current_frame_idx, obj_id, mask)
                 else:
                     print(f"Failed to generate mask for object {obj_id}")
             except Exception as e:
@@ -792,38 +1369,37 @@ class SAM2Interface:
                                 f"{len(current_frame_annotations)} annotations processed.")
     
     def load_coco_data(self, coco_file):
+        # Indexes the file without holding its entries; annotations are read per frame
         try:
-            with open(coco_file, 'r') as f:
-                return json.load(f)
+            return COCOIndex(coco_file)
         except Exception as e:
             print(f"Error loading COCO data: {str(e)}")
             return None
 
-    def get_last_annotated_frame(self, coco_data):
-        images = sorted(coco_data['images'], key=lambda x: x['id'], reverse=True)
-        for image in images:
-            if any(ann['image_id'] == image['id'] for ann in coco_data['annotations']):
-                return image['id']
-        return None
+    def get_last_annotated_frame(self, coco_index):
+        return coco_index.last_annotated_image_id()
     
-    def generate_masks_from_annotations(self, coco_data):
+    def generate_masks_from_annotations(self, coco_index):
         self.object_manager.clear()
         self.masks.clear()
-        self.object_bboxes.clear()
+        self.geometry.clear()
+        self.history.clear()
 
-        last_frame_annotations = [ann for ann in coco_data['annotations'] if ann['image_id'] == self.current_frame_idx + 1]
+        last_frame_annotations = coco_index.annotations_for(self.current_frame_idx + 1)
+        coco_index.close()
+        category_names = {cat['id']: cat['name'] for cat in coco_index.categories}
 
         for annotation in last_frame_annotations:
             category_id = annotation['category_id']
             obj_id = annotation['category_id'] - 1
             bbox = annotation['bbox']  # [x, y, width, height]
-            category_name = next((cat['name'] for cat in coco_data['categories'] if cat['id'] == category_id), f"Object {category_id}")
+            category_name = category_names.get(category_id, f"Object {category_id}")
             
             box = [bbox[0], bbox[1], bbox[0] + bbox[2], bbox[1] + bbox[3]]
             
             mask = self.sam2_predictor.generate_mask_with_box(self.current_frame_idx, obj_id, box)
             self.masks[obj_id] = mask
-            self.object_bboxes[self.current_frame_idx] = {obj_id: box}
+            self.geometry.lookup(self.current_frame_idx, obj_id, mask)
             
             color = get_object_color(obj_id)
             self.object_manager.add_object(obj_id, category_name, color)
@@ -836,7 +1412,11 @@ class SAM2Interface:
 
         current_masks = self.masks.copy()
         self.sam2_predictor.reset_state()
+        if self.video_segments:
+            self.previous_segments = self.video_segments
         self.video_segments = {}
+        # Recorded prompts refer to the predictor state that was just reset
+        self.history.clear()
         self.masks_propagated = False
         self.reinitialize_masks(current_masks)
         self.update_display(self.current_image)
@@ -846,41 +1426,38 @@ class SAM2Interface:
         self.ui.reset_btn.setEnabled(False)
         self.ui.add_obj_btn.setEnabled(True)
         self.ui.propagate_btn.setEnabled(True)
+        self.ui.propagate_correction_btn.setEnabled(self.previous_segments is not None)
         self.ui.load_coco_btn.setEnabled(True)
         self.ui.load_curr_coco_btn.setEnabled(True)
-        self.ui.set_delete_buttons_enabled(True)
         self.ui.propagate_and_export_btn.setEnabled(True)
 
         if type is None:
             QMessageBox.information(self.window, "Reset Complete", "Inference state has been reset.\nExisting masks are preserved. You can now edit objects or add new ones.")
             
     def reinitialize_masks(self, current_masks):
-        non_tracked_data = {}
+        non_tracked_masks = {}
         for obj_id, obj_data in self.object_manager.get_all_objects().items():
             if not obj_data['tracking']:
-                non_tracked_data[obj_id] = {
-                    'mask': current_masks.get(obj_id),
-                    'bbox': self.object_bboxes.get(self.current_frame_idx, {}).get(obj_id)
-                }
+                non_tracked_masks[obj_id] = current_masks.get(obj_id)
 
         self.sam2_predictor.reset_state()
         new_masks = {}
         for obj_id, obj_data in self.object_manager.get_all_objects().items():
-            bbox = self.object_bboxes.get(self.current_frame_idx, {}).get(obj_id)
+            bbox = self.geometry.bbox(self.current_frame_idx, obj_id)
             if bbox is not None:
                 new_mask = self.sam2_predictor.generate_mask_with_box(self.current_frame_idx, obj_id, bbox)
                 new_masks[obj_id] = new_mask
             else:
-                new_masks[obj_id] = current_masks.get(obj_id, np.zeros((self.current_image.shape[0], self.current_image.shape[1]), dtype=bool))
+                new_masks[obj_id] = current_masks.get(obj_id, SparseMask.empty(self.current_image.shape[:2]))
 
-        for obj_id, data in non_tracked_data.items():
-            if data['mask'] is not None:
-                new_masks[obj_id] = data['mask']
-            self.object_bboxes[self.current_frame_idx][obj_id] = data['bbox']
+        for obj_id, mask in non_tracked_masks.items():
+            if mask is not None:
+                new_masks[obj_id] = mask
 
         self.masks = new_masks
         for obj_id, mask in self.masks.items():
             self.object_manager.update_last_valid_mask(obj_id, mask)
+            self.geometry.lookup(self.current_frame_idx, obj_id, mask)
 
         print(f"Reinitialized masks for {len(self.masks)} objects")
 
@@ -888,6 +1465,9 @@ def run_interface():
     app = QApplication(sys.argv)
     interface = SAM2Interface()
     interface.run()
+    app.aboutToQuit.connect(interface.session_saver.wait)
+    if isinstance(interface.sam2_predictor, RemoteSAM2Predictor):
+        app.aboutToQuit.connect(interface.sam2_predictor.close)
     sys.exit(app.exec_())
 
 if __name__ == '__main__':
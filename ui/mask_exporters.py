@@ -0,0 +1,160 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+from profiler import profiler
+from mask_utils import LabelMap, as_sparse, label_dtype
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+# Binary mask exports for training pipelines. Each frame becomes one label image where
+# pixel value obj_id + 1 marks an object and 0 is background; overlaps go to the higher
+# object id, matching the draw order of the display. Formats:
+#   png   one indexed-palette PNG per frame (16-bit grayscale past 255 objects)
+#   npz   compressed (frames, H, W) chunks, masks_<first frame>.npz
+#   zarr  one chunked (frames, H, W) array, requires the optional zarr package
+# Every export writes labels.json describing label values and frame files. Frames are
+# encoded on a thread pool straight from the segment store (zlib and PNG encoding release
+# the GIL), so nothing larger than one chunk per worker is held in memory.
+
+EXPORT_FORMATS = ('png', 'npz', 'zarr')
+DEFAULT_CHUNK_FRAMES = 32
+
+
+def label_image(masks, shape, dtype=np.uint16):
+    if isinstance(masks, LabelMap):
+        return masks.remap({obj_id: obj_id + 1 for obj_id in masks}, dtype)
+    labels = np.zeros(shape, dtype=dtype)
+    for obj_id in sorted(masks):
+        mask = as_sparse(masks[obj_id])
+        if mask.area == 0:
+            continue
+        x0, y0 = mask.offset
+        h, w = mask.crop.shape
+        labels[y0:y0 + h, x0:x0 + w][mask.crop] = obj_id + 1
+    return labels
+
+
+def frame_masks(video_segments, frame_idx):
+    return video_segments[frame_idx] if frame_idx in video_segments else {}
+
+
+class MaskArchiveExporter:
+    def __init__(self, output_path, export_format, frame_names, frame_size, objects, colors=None,
+                 chunk_frames=DEFAULT_CHUNK_FRAMES, num_workers=8):
+        # objects maps obj_id -> category name, colors obj_id -> (r, g, b)
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f"Unknown mask export format: {export_format}")
+        if export_format == 'zarr' and zarr is None:
+            raise ImportError("Zarr export requires the zarr package (pip install zarr)")
+        self.output_path = output_path
+        self.export_format = export_format
+        self.frame_names = frame_names
+        self.frame_size = tuple(frame_size)
+        self.objects = objects
+        self.colors = colors or {}
+        self.chunk_frames = chunk_frames
+        self.num_workers = num_workers
+        self.dtype = label_dtype(max(objects, default=0) + 1)
+
+    def palette(self):
+        palette = np.zeros((256, 3), dtype=np.uint8)
+        for obj_id, color in self.colors.items():
+            if obj_id + 1 < 256:
+                palette[obj_id + 1] = color[:3]
+        return palette.ravel().tolist()
+
+    def frame_labels(self, video_segments, frame_idx):
+        masks = frame_masks(video_segments, frame_idx)
+        if isinstance(masks, LabelMap):
+            return masks.remap({obj_id: obj_id + 1 for obj_id in masks if obj_id in self.objects}, self.dtype)
+        masks = {obj_id: mask for obj_id, mask in masks.items() if obj_id in self.objects}
+        return label_image(masks, self.frame_size, self.dtype)
+
+    def write_png(self, video_segments, frame_idx, palette):
+        labels = self.frame_labels(video_segments, frame_idx)
+        file_name = os.path.splitext(self.frame_names[frame_idx])[0] + '.png'
+        path = os.path.join(self.output_path, file_name)
+        if self.dtype == np.uint8 and Image is not None:
+            # putpalette turns the grayscale image into a palette (P mode) image
+            image = Image.fromarray(labels)
+            image.putpalette(palette)
+            image.save(path, optimize=False, compress_level=6)
+        else:
+            cv2.imwrite(path, labels)
+        return file_name
+
+    def chunk_volume(self, video_segments, start, stop):
+        volume = np.zeros((stop - start,) + self.frame_size, dtype=self.dtype)
+        for frame_idx in range(start, stop):
+            volume[frame_idx - start] = self.frame_labels(video_segments, frame_idx)
+        return volume
+
+    def write_npz(self, video_segments, start, stop):
+        file_name = f"masks_{start:06d}.npz"
+        np.savez_compressed(os.path.join(self.output_path, file_name), labels=self.chunk_volume(video_segments, start, stop),
+                            frame_indices=np.arange(start, stop))
+        return file_name
+
+    def write_zarr(self, video_segments, array, start, stop):
+        # Chunk boundaries line up with the zarr chunks, so workers never share a chunk
+        array[start:stop] = self.chunk_volume(video_segments, start, stop)
+        return start
+
+    def export(self, video_segments, progress_callback=None):
+        num_frames = len(self.frame_names)
+        os.makedirs(self.output_path, exist_ok=True)
+        if self.export_format == 'png':
+            palette = self.palette()
+            jobs = [(self.write_png, (video_segments, frame_idx, palette)) for frame_idx in range(num_frames)]
+        else:
+            chunks = [(start, min(start + self.chunk_frames, num_frames)) for start in range(0, num_frames, self.chunk_frames)]
+            if self.export_format == 'npz':
+                jobs = [(self.write_npz, (video_segments, start, stop)) for start, stop in chunks]
+            else:
+                array = zarr.open_array(os.path.join(self.output_path, 'labels.zarr'), mode='w',
+                                        shape=(num_frames,) + self.frame_size,
+                                        chunks=(self.chunk_frames,) + self.frame_size, dtype=self.dtype)
+                jobs = [(self.write_zarr, (video_segments, array, start, stop)) for start, stop in chunks]
+
+        files = []
+        with profiler.span('export.masks'), ThreadPoolExecutor(max_workers=self.num_workers) as pool:
+            futures = [pool.submit(job, *args) for job, args in jobs]
+            for i, future in enumerate(futures):
+                files.append(future.result())
+                if progress_callback:
+                    progress_callback(i + 1, len(futures))
+
+        self.write_labels(files)
+        return self.output_path
+
+    def write_labels(self, files):
+        height, width = self.frame_size
+        labels = {
+            "format": self.export_format,
+            "dtype": np.dtype(self.dtype).name,
+            "height": height,
+            "width": width,
+            "num_frames": len(self.frame_names),
+            "frame_names": self.frame_names,
+            "background": 0,
+            "labels": [{"value": obj_id + 1, "obj_id": obj_id, "category_name": name,
+                        "color": list(self.colors[obj_id][:3]) if obj_id in self.colors else None}
+                       for obj_id, name in sorted(self.objects.items())],
+        }
+        if self.export_format == 'zarr':
+            labels["array"] = 'labels.zarr'
+            labels["chunk_frames"] = self.chunk_frames
+        else:
+            labels["files"] = files
+        with open(os.path.join(self.output_path, 'labels.json'), 'w') as f:
+            json.dump(labels, f, indent=2)
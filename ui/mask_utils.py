@@ -0,0 +1,440 @@
+import weakref
+from collections.abc import MutableMapping
+import numpy as np
+import cv2
+
+
+def squeeze_mask(mask):
+    mask = np.asarray(mask)
+    if len(mask.shape) > 2:
+        mask = mask.squeeze()
+    return mask if mask.dtype == bool else mask > 0
+
+
+class SparseMask:
+    # A boolean mask kept as the crop of its tight bbox plus the crop's (x, y) offset in a
+    # frame of the given (H, W) shape. np.asarray() expands it to a dense frame-sized mask.
+    def __init__(self, crop, offset, shape):
+        self.crop = crop
+        self.offset = offset
+        self.shape = shape
+        self._area = None
+
+    @classmethod
+    def from_crop(cls, crop, offset, shape):
+        crop = squeeze_mask(crop)
+        rows = np.flatnonzero(crop.any(axis=1))
+        if rows.size == 0:
+            return cls.empty(shape)
+        cols = np.flatnonzero(crop.any(axis=0))
+        y0, y1, x0, x1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+        return cls(crop[y0:y1, x0:x1], (offset[0] + int(x0), offset[1] + int(y0)), shape)
+
+    @classmethod
+    def from_dense(cls, mask):
+        mask = squeeze_mask(mask)
+        return cls.from_crop(mask, (0, 0), mask.shape)
+
+    @classmethod
+    def empty(cls, shape):
+        return cls(np.zeros((0, 0), dtype=bool), (0, 0), shape)
+
+    @property
+    def area(self):
+        if self._area is None:
+            self._area = int(np.count_nonzero(self.crop))
+        return self._area
+
+    @property
+    def bbox_xyxy(self):
+        x, y = self.offset
+        h, w = self.crop.shape
+        return [x, y, x + w, y + h]
+
+    def crop_to(self, roi):
+        # Dense mask covering roi = (x0, y0, x1, y1)
+        rx0, ry0, rx1, ry1 = roi
+        out = np.zeros((ry1 - ry0, rx1 - rx0), dtype=bool)
+        x0, y0, x1, y1 = self.bbox_xyxy
+        ix0, iy0, ix1, iy1 = max(x0, rx0), max(y0, ry0), min(x1, rx1), min(y1, ry1)
+        if ix0 < ix1 and iy0 < iy1:
+            out[iy0 - ry0:iy1 - ry0, ix0 - rx0:ix1 - rx0] = self.crop[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0]
+        return out
+
+    def to_dense(self):
+        return self.crop_to((0, 0, self.shape[1], self.shape[0]))
+
+    def intersection_area(self, other):
+        other = as_sparse(other)
+        x0, y0, x1, y1 = self.bbox_xyxy
+        ox0, oy0, ox1, oy1 = other.bbox_xyxy
+        ix0, iy0, ix1, iy1 = max(x0, ox0), max(y0, oy0), min(x1, ox1), min(y1, oy1)
+        if ix0 >= ix1 or iy0 >= iy1:
+            return 0
+        a = self.crop[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0]
+        b = other.crop[iy0 - oy0:iy1 - oy0, ix0 - ox0:ix1 - ox0]
+        return int(np.count_nonzero(a & b))
+
+    def iou(self, other):
+        other = as_sparse(other)
+        intersection = self.intersection_area(other)
+        union = self.area + other.area - intersection
+        return intersection / union if union > 0 else 0.0
+
+    def union(self, other):
+        other = as_sparse(other)
+        if other.area == 0:
+            return self
+        if self.area == 0:
+            return other
+        x0, y0, x1, y1 = self.bbox_xyxy
+        ox0, oy0, ox1, oy1 = other.bbox_xyxy
+        roi = (min(x0, ox0), min(y0, oy0), max(x1, ox1), max(y1, oy1))
+        return SparseMask(self.crop_to(roi) | other.crop_to(roi), roi[:2], self.shape)
+
+    def __array__(self, dtype=None, copy=None):
+        dense = self.to_dense()
+        return dense if dtype is None else dense.astype(dtype)
+
+
+def as_sparse(mask):
+    return mask if isinstance(mask, SparseMask) else SparseMask.from_dense(mask)
+
+
+def mask_iou(a, b):
+    # Two empty masks agree perfectly
+    a, b = as_sparse(a), as_sparse(b)
+    if a.area == 0 and b.area == 0:
+        return 1.0
+    return a.iou(b)
+
+
+def mask_any(mask):
+    if isinstance(mask, SparseMask):
+        return mask.area > 0
+    return bool(np.any(mask))
+
+
+class PolygonSimplification:
+    # Settings shared by export and display: Douglas-Peucker tolerance in pixels (0 keeps
+    # every traced vertex) and the smallest polygon area kept, in square pixels
+    def __init__(self, tolerance=1.0, min_area=4.0):
+        self.tolerance = tolerance
+        self.min_area = min_area
+
+
+simplification = PolygonSimplification()
+
+
+def simplify_contours(contours, tolerance=None, min_area=None):
+    # Drops polygons enclosing less than min_area, except the largest one so an object
+    # never loses its outline, then simplifies the rest within tolerance pixels; polygons
+    # too small to survive simplification are kept as traced
+    tolerance = simplification.tolerance if tolerance is None else tolerance
+    min_area = simplification.min_area if min_area is None else min_area
+    if not len(contours):
+        return []
+    areas = [cv2.contourArea(contour) for contour in contours]
+    largest = int(np.argmax(areas))
+    simplified = []
+    for index, contour in enumerate(contours):
+        if areas[index] < min_area and index != largest:
+            continue
+        if tolerance > 0 and len(contour) > 3:
+            approximated = cv2.approxPolyDP(contour, tolerance, True)
+            if len(approximated) > 2:
+                contour = approximated
+        if len(contour) > 2:
+            simplified.append(contour)
+    return simplified
+
+
+class MaskGeometry:
+    def __init__(self, mask, area, bbox, centroid):
+        # Only a weak reference is kept so cached geometry never keeps a mask alive
+        self.mask_ref = weakref.ref(mask) if mask is not None else None
+        # Measured without a mask object (from a label map); see GeometryIndex.lookup
+        self.unbound = mask is None
+        self.area = area
+        self.bbox = bbox
+        self.centroid = centroid
+        self.reset_contours()
+
+    def reset_contours(self):
+        self._contours = None
+        # (tolerance, min_area) -> simplified contours
+        self._simplified = {}
+        self._polygons = None
+
+    def describes(self, mask):
+        return self.mask_ref is not None and self.mask_ref() is mask
+
+    @property
+    def bbox_xyxy(self):
+        x, y, w, h = self.bbox
+        return [x, y, x + w, y + h]
+
+    @property
+    def contours(self):
+        if self._contours is None:
+            mask = self.mask_ref() if self.mask_ref is not None else None
+            if self.area == 0 or mask is None:
+                return ()
+            x, y, w, h = (int(v) for v in self.bbox)
+            if isinstance(mask, SparseMask):
+                ox, oy = mask.offset
+                crop = mask.crop[y - oy:y - oy + h, x - ox:x - ox + w].astype(np.uint8)
+            else:
+                crop = squeeze_mask(mask)[y:y + h, x:x + w].astype(np.uint8)
+            self._contours, _ = cv2.findContours(crop, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(x, y))
+        return self._contours
+
+    def simplified_contours(self, tolerance=None):
+        # Contours simplified with the shared settings, or with a given tolerance (display
+        # uses a coarser one when the frame is drawn from a reduced pyramid level)
+        key = (simplification.tolerance if tolerance is None else tolerance, simplification.min_area)
+        if key not in self._simplified:
+            self._simplified[key] = simplify_contours(self.contours, *key)
+        return self._simplified[key]
+
+    @property
+    def polygons(self):
+        # Simplified contours as flat [x0, y0, x1, y1, ...] lists, for the current settings
+        key = (simplification.tolerance, simplification.min_area)
+        if self._polygons is None or self._polygons[0] != key:
+            self._polygons = (key, [contour.flatten().tolist() for contour in self.simplified_contours()])
+        return self._polygons[1]
+
+
+def batch_mask_geometry(masks, mask_refs=None):
+    # masks is a boolean (N, H, W) stack. Row and column pixel counts give area, bbox
+    # and centroid for every object in two vectorized reductions; contours are traced
+    # lazily inside each bbox the first time they are needed.
+    num_masks, height, width = masks.shape
+    if mask_refs is None:
+        mask_refs = list(masks)
+    row_counts = masks.sum(axis=2, dtype=np.int64)
+    col_counts = masks.sum(axis=1, dtype=np.int64)
+    areas = row_counts.sum(axis=1)
+    rows_any = row_counts > 0
+    cols_any = col_counts > 0
+    y0 = rows_any.argmax(axis=1)
+    y1 = height - rows_any[:, ::-1].argmax(axis=1)
+    x0 = cols_any.argmax(axis=1)
+    x1 = width - cols_any[:, ::-1].argmax(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cy = row_counts @ np.arange(height) / areas
+        cx = col_counts @ np.arange(width) / areas
+
+    geometries = []
+    for i in range(num_masks):
+        if areas[i] == 0:
+            geometries.append(MaskGeometry(mask_refs[i], 0, [0.0, 0.0, 0.0, 0.0], None))
+            continue
+        bbox = [float(x0[i]), float(y0[i]), float(x1[i] - x0[i]), float(y1[i] - y0[i])]
+        geometries.append(MaskGeometry(mask_refs[i], int(areas[i]), bbox, (float(cx[i]), float(cy[i]))))
+    return geometries
+
+
+def mask_geometry(mask):
+    if isinstance(mask, SparseMask):
+        if mask.area == 0:
+            return MaskGeometry(mask, 0, [0.0, 0.0, 0.0, 0.0], None)
+        # Measured on the crop, then shifted into frame coordinates
+        geometry = batch_mask_geometry(mask.crop[None], [mask])[0]
+        ox, oy = mask.offset
+        geometry.bbox[0] += ox
+        geometry.bbox[1] += oy
+        geometry.centroid = (geometry.centroid[0] + ox, geometry.centroid[1] + oy)
+        return geometry
+    return batch_mask_geometry(squeeze_mask(mask)[None], [mask])[0]
+
+
+def label_dtype(num_labels):
+    return np.uint8 if num_labels <= np.iinfo(np.uint8).max else np.uint16
+
+
+class LabelMap(MutableMapping):
+    # All masks of a frame as one object-id image: pixel value i + 1 belongs to obj_ids[i],
+    # 0 is background, so every pixel has at most one owner. Per-object SparseMasks are
+    # cut from the image on access and shared while anything still holds them (cached
+    # geometry stays valid). Writing a mask paints it over whatever was there; copies share
+    # the image until one of them is written to.
+    def __init__(self, labels, obj_ids):
+        self.labels = labels
+        self.obj_ids = list(obj_ids)
+        self.values = {obj_id: i + 1 for i, obj_id in enumerate(self.obj_ids) if obj_id is not None}
+        self.derived = weakref.WeakValueDictionary()
+        self.shared = False
+        self._stats = None
+
+    @property
+    def shape(self):
+        return self.labels.shape
+
+    def copy(self):
+        other = LabelMap(self.labels, self.obj_ids)
+        other.values = dict(self.values)
+        self.shared = other.shared = True
+        return other
+
+    def stats(self):
+        # area, bbox (x0, y0, x1, y1) and centroid for every label value in one pass over
+        # the foreground pixels
+        if self._stats is None:
+            num_values = len(self.obj_ids) + 1
+            ys, xs = np.nonzero(self.labels)
+            values = self.labels[ys, xs].astype(np.int64)
+            areas = np.bincount(values, minlength=num_values)
+            boxes = np.zeros((num_values, 4), dtype=np.int64)
+            centroids = np.zeros((num_values, 2))
+            if values.size:
+                order = np.argsort(values, kind='stable')
+                values, ys, xs = values[order], ys[order], xs[order]
+                starts = np.flatnonzero(np.r_[True, values[1:] != values[:-1]])
+                present = values[starts]
+                # ys come out of nonzero in row order, so each group starts at its top row
+                boxes[present, 0] = np.minimum.reduceat(xs, starts)
+                boxes[present, 1] = ys[starts]
+                boxes[present, 2] = np.maximum.reduceat(xs, starts) + 1
+                boxes[present, 3] = ys[np.r_[starts[1:], values.size] - 1] + 1
+                centroids[present, 0] = np.add.reduceat(xs, starts) / areas[present]
+                centroids[present, 1] = np.add.reduceat(ys, starts) / areas[present]
+            self._stats = (areas, boxes, centroids)
+        return self._stats
+
+    def geometries(self):
+        # Area/bbox/centroid for every object without cutting masks; contours are traced
+        # later from the mask passed to GeometryIndex.lookup
+        areas, boxes, centroids = self.stats()
+        geometries = {}
+        for obj_id, value in self.values.items():
+            if areas[value] == 0:
+                geometries[obj_id] = MaskGeometry(None, 0, [0.0, 0.0, 0.0, 0.0], None)
+                continue
+            x0, y0, x1, y1 = (float(v) for v in boxes[value])
+            geometries[obj_id] = MaskGeometry(None, int(areas[value]), [x0, y0, x1 - x0, y1 - y0],
+                                              (float(centroids[value, 0]), float(centroids[value, 1])))
+        return geometries
+
+    def remap(self, obj_values, dtype=np.uint16):
+        # Label image with obj_values[obj_id] as pixel values; unlisted objects become 0
+        lut = np.zeros(len(self.obj_ids) + 1, dtype=dtype)
+        for obj_id, value in self.values.items():
+            lut[value] = obj_values.get(obj_id, 0)
+        return lut[self.labels]
+
+    def __getitem__(self, obj_id):
+        value = self.values[obj_id]
+        mask = self.derived.get(obj_id)
+        if mask is None:
+            areas, boxes, _ = self.stats()
+            if areas[value] == 0:
+                mask = SparseMask.empty(self.shape)
+            else:
+                x0, y0, x1, y1 = (int(v) for v in boxes[value])
+                mask = SparseMask(self.labels[y0:y1, x0:x1] == value, (x0, y0), self.shape)
+            self.derived[obj_id] = mask
+        return mask
+
+    def modify(self):
+        if self.shared:
+            self.labels = self.labels.copy()
+            self.shared = False
+        self.derived = weakref.WeakValueDictionary()
+        self._stats = None
+
+    def __setitem__(self, obj_id, mask):
+        mask = as_sparse(mask)
+        value = self.values.get(obj_id)
+        if value is None:
+            value = len(self.obj_ids) + 1
+            self.obj_ids.append(obj_id)
+            self.values[obj_id] = value
+            if value > np.iinfo(self.labels.dtype).max:
+                self.labels = self.labels.astype(label_dtype(value))
+                self.shared = False
+        self.modify()
+        self.labels[self.labels == value] = 0
+        if mask.area > 0:
+            x0, y0 = mask.offset
+            h, w = mask.crop.shape
+            self.labels[y0:y0 + h, x0:x0 + w][mask.crop] = value
+        self.derived[obj_id] = mask
+
+    def __delitem__(self, obj_id):
+        value = self.values.pop(obj_id)
+        self.obj_ids[value - 1] = None
+        self.modify()
+        self.labels[self.labels == value] = 0
+
+    def __contains__(self, obj_id):
+        return obj_id in self.values
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+
+class GeometryIndex:
+    # Per-frame bbox/area/centroid/contour cache shared by display, export and re-prompting.
+    # A mask object shown on many frames (a static object) shares one geometry, so its
+    # contours and polygons are computed and simplified once.
+    def __init__(self):
+        self.frames = {}
+        self.by_mask = weakref.WeakKeyDictionary()
+
+    def update_frame(self, frame_idx, obj_ids, masks):
+        self.frames.setdefault(frame_idx, {}).update((obj_id, mask_geometry(mask)) for obj_id, mask in zip(obj_ids, masks))
+
+    def update_from_label_map(self, frame_idx, label_map):
+        self.frames.setdefault(frame_idx, {}).update(label_map.geometries())
+
+    def lookup(self, frame_idx, obj_id, mask):
+        geometry = self.frames.get(frame_idx, {}).get(obj_id)
+        if geometry is not None and geometry.unbound and not geometry.describes(mask) and isinstance(mask, SparseMask) \
+                and geometry.area == mask.area and (mask.area == 0 or geometry.bbox_xyxy == mask.bbox_xyxy):
+            # Geometry measured from a label map is bound to whichever mask cut from it is
+            # being looked up; contours are traced from that mask
+            geometry.mask_ref = weakref.ref(mask)
+            geometry.reset_contours()
+        if geometry is None or not geometry.describes(mask):
+            geometry = self.by_mask.get(mask) if isinstance(mask, SparseMask) else None
+            if geometry is None:
+                geometry = mask_geometry(mask)
+                if isinstance(mask, SparseMask):
+                    self.by_mask[mask] = geometry
+            self.frames.setdefault(frame_idx, {})[obj_id] = geometry
+        return geometry
+
+    def get(self, frame_idx, obj_id):
+        return self.frames.get(frame_idx, {}).get(obj_id)
+
+    def bbox(self, frame_idx, obj_id):
+        geometry = self.get(frame_idx, obj_id)
+        if geometry is None or geometry.area == 0:
+            return None
+        return geometry.bbox_xyxy
+
+    def release_contours(self, keep_frames):
+        # Drops traced and simplified contours outside keep_frames; they are traced again
+        # if needed. Returns the number of geometries released.
+        released = 0
+        for frame_idx, frame_geometry in self.frames.items():
+            if frame_idx in keep_frames:
+                continue
+            for geometry in frame_geometry.values():
+                if geometry._contours is not None:
+                    geometry.reset_contours()
+                    released += 1
+        return released
+
+    def remove_object(self, obj_id):
+        for frame_geometry in self.frames.values():
+            frame_geometry.pop(obj_id, None)
+
+    def clear(self):
+        self.frames.clear()
+        self.by_mask.clear()
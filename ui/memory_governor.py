@@ -0,0 +1,273 @@
+import os
+import gc
+import time
+import zlib
+import ctypes
+import shutil
+import weakref
+import tempfile
+from collections import deque
+import numpy as np
+from profiler import profiler
+from mask_utils import LabelMap, SparseMask
+from session import PackedSegments, pack_masks
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Keeps long sessions inside a memory budget. Every few seconds the process RSS is compared
+# with the budget (SAM2_MEMORY_BUDGET_MB, half the physical memory by default); above
+# HIGH_WATER of it the governor frees memory in order of cost until RSS is back under
+# LOW_WATER:
+#   1. decoded frame caches of the frame source and the SAM2 frame loader
+#   2. SAM2 per-frame outputs outside the memory window of the current frame and of the
+#      last propagated frame (see SAM2Predictor.release_outputs)
+#   3. cached contours of frames outside the working window
+#   4. propagated masks of the frames farthest from the working window, packed, compressed
+#      and spilled to a temporary directory; a spilled frame is read back when shown,
+#      exported or saved
+# Each step is listed in the memory panel of the UI.
+
+MEMORY_CHECK_INTERVAL_MS = 5000
+HIGH_WATER = 0.9
+LOW_WATER = 0.75
+# Frames around the current frame and the propagation front that are never spilled
+WORKING_WINDOW = 32
+MAX_LOGGED_ACTIONS = 6
+
+try:
+    libc = ctypes.CDLL('libc.so.6')
+except OSError:
+    libc = None
+
+
+def current_rss_mb():
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def total_memory_mb():
+    if psutil is not None:
+        return psutil.virtual_memory().total / (1024 * 1024)
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (ValueError, AttributeError):
+        return None
+
+
+def default_budget_mb():
+    budget = os.environ.get('SAM2_MEMORY_BUDGET_MB')
+    if budget:
+        return float(budget)
+    total = total_memory_mb()
+    return total / 2 if total else 8192.0
+
+
+def return_freed_memory():
+    # Freed Python objects go back to the allocator; glibc keeps small blocks until trimmed
+    gc.collect()
+    if libc is not None and hasattr(libc, 'malloc_trim'):
+        libc.malloc_trim(0)
+
+
+def frame_nbytes(masks):
+    if isinstance(masks, LabelMap):
+        return masks.labels.nbytes
+    total = 0
+    for mask in masks.values():
+        total += mask.crop.nbytes if isinstance(mask, SparseMask) else np.asarray(mask).nbytes
+    return total
+
+
+class SpilledSegments(PackedSegments):
+    # video_segments whose frames can be spilled to compressed files on disk. Wraps a dict,
+    # or the LazySegments of a restored session whose archived frames are read from there.
+    load_span = 'memory.unspill'
+    # Stores are tracked by identity; Mapping would compare (and unspill) every frame
+    __eq__ = object.__eq__
+    __hash__ = object.__hash__
+
+    def __init__(self, segments=None):
+        super().__init__()
+        self.source = None
+        self.spilled = set()
+        self.directory = None
+        if isinstance(segments, PackedSegments):
+            with segments.lock:
+                self.source = segments
+                self.pending = set(segments.pending)
+                self.loaded = segments.loaded
+                segments.loaded = {}
+        elif segments:
+            self.loaded = dict(segments)
+
+    def path(self, frame_idx):
+        return os.path.join(self.directory, f"{frame_idx}.npz.z")
+
+    def read_packed(self, frame_idx):
+        if frame_idx in self.spilled:
+            with open(self.path(frame_idx), 'rb') as f:
+                return zlib.decompress(f.read())
+        return self.source.raw(frame_idx)
+
+    def write_packed(self, frame_idx, data):
+        # Packed frames edited in place (e.g. an object deleted) go back to disk; returns
+        # the bytes written
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='sam2-spill-')
+            weakref.finalize(self, shutil.rmtree, self.directory, True)
+        data = zlib.compress(data, 1)
+        with open(self.path(frame_idx), 'wb') as f:
+            f.write(data)
+        self.spilled.add(frame_idx)
+        return len(data)
+
+    def discard_packed(self, frame_idx):
+        if frame_idx in self.spilled:
+            self.spilled.discard(frame_idx)
+            os.remove(self.path(frame_idx))
+
+    def spill(self, frame_ids):
+        # Returns (frames spilled, bytes of masks freed, bytes written)
+        count = freed = written = 0
+        with self.lock, profiler.span('memory.spill'):
+            for frame_idx in frame_ids:
+                masks = self.loaded.pop(frame_idx, None)
+                if masks is None:
+                    continue
+                written += self.write_packed(frame_idx, pack_masks(masks))
+                self.pending.add(frame_idx)
+                count += 1
+                freed += frame_nbytes(masks)
+        return count, freed, written
+
+
+class MemoryGovernor:
+    def __init__(self, interface, budget_mb=None):
+        self.interface = interface
+        self.budget_mb = budget_mb or default_budget_mb()
+        self.rss_mb = None
+        self.exhausted = False
+        self.actions = deque(maxlen=MAX_LOGGED_ACTIONS)
+        # Every spillable store handed out, including ones still being filled by propagation
+        self.stores = weakref.WeakSet()
+
+    def new_segments(self):
+        store = SpilledSegments()
+        self.stores.add(store)
+        return store
+
+    def log(self, message):
+        self.actions.append(f"{time.strftime('%H:%M:%S')} {message}")
+        print(f"Memory governor: {message}")
+
+    def measure(self):
+        self.rss_mb = current_rss_mb()
+        return self.rss_mb
+
+    def over(self, fraction):
+        return self.rss_mb is not None and self.rss_mb > self.budget_mb * fraction
+
+    def working_frames(self):
+        interface = self.interface
+        anchors = [interface.current_frame_idx, interface.sam2_predictor.last_output_frame]
+        return [f for f in anchors if f is not None]
+
+    def check(self):
+        if self.measure() is None or not self.over(HIGH_WATER):
+            self.exhausted = False
+            return
+        with profiler.span('memory.govern'):
+            for step in (self.clear_frame_caches, self.release_model_outputs, self.release_contours, self.spill_segments):
+                step()
+                return_freed_memory()
+                self.measure()
+                if not self.over(LOW_WATER):
+                    break
+        if self.over(HIGH_WATER) and not self.exhausted:
+            # Logged once until usage drops below the budget again
+            self.exhausted = True
+            self.log(f"still at {self.rss_mb / 1024:.1f} GB after freeing what it can")
+
+    def clear_frame_caches(self):
+        interface = self.interface
+        cached = 0
+        for cache_owner in (interface.frame_source, interface.sam2_predictor.frame_loader):
+            cache = getattr(cache_owner, 'cache', None)
+            if cache:
+                cached += len(cache)
+                cache_owner.clear_cache()
+        if cached:
+            self.log(f"cleared {cached} decoded frames from frame caches")
+
+    def release_model_outputs(self):
+        released = self.interface.sam2_predictor.release_outputs(self.interface.current_frame_idx)
+        if released:
+            self.log(f"released SAM2 outputs of {released} object frames outside the memory window")
+
+    def release_contours(self):
+        keep = set()
+        for anchor in self.working_frames():
+            keep.update(range(anchor - WORKING_WINDOW, anchor + WORKING_WINDOW + 1))
+        released = self.interface.geometry.release_contours(keep)
+        if released:
+            self.log(f"dropped cached contours of {released} masks")
+
+    def adopt_segments(self):
+        # Puts the interface's segment mappings in spillable stores
+        interface = self.interface
+        for name in ('video_segments', 'previous_segments'):
+            segments = getattr(interface, name)
+            if segments and not isinstance(segments, SpilledSegments):
+                store = SpilledSegments(segments)
+                self.stores.add(store)
+                for other in ('video_segments', 'previous_segments'):
+                    if getattr(interface, other) is segments:
+                        setattr(interface, other, store)
+
+    def spill_segments(self):
+        self.adopt_segments()
+        anchors = self.working_frames()
+        candidates = []
+        for store in list(self.stores):
+            for frame_idx in list(store.loaded):
+                distance = min(abs(frame_idx - anchor) for anchor in anchors)
+                if distance > WORKING_WINDOW:
+                    candidates.append((distance, frame_idx, store))
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+
+        # Spills in batches until the masks freed cover the excess, measuring in between
+        excess = (self.rss_mb - self.budget_mb * LOW_WATER) * 1024 * 1024
+        count = freed = written = 0
+        batch_size = 256
+        for start in range(0, len(candidates), batch_size):
+            by_store = {}
+            for _, frame_idx, store in candidates[start:start + batch_size]:
+                by_store.setdefault(store, []).append(frame_idx)
+            for store, frame_ids in by_store.items():
+                spilled = store.spill(frame_ids)
+                count, freed, written = count + spilled[0], freed + spilled[1], written + spilled[2]
+            if freed >= excess:
+                break
+        if count:
+            self.log(f"spilled masks of {count} frames to disk ({freed / 2**20:.0f} MB -> {written / 2**20:.1f} MB compressed)")
+
+    def spilled_frames(self):
+        return sum(len(store.spilled) for store in list(self.stores))
+
+    def status(self):
+        if self.rss_mb is None:
+            return "Memory: usage unavailable on this platform"
+        lines = [f"Memory: {self.rss_mb / 1024:.1f} GB of {self.budget_mb / 1024:.1f} GB budget"]
+        spilled = self.spilled_frames()
+        if spilled:
+            lines.append(f"{spilled} frames of masks on disk")
+        lines.extend(self.actions)
+        return "\n".join(lines)
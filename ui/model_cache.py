@@ -0,0 +1,71 @@
+import os
+import torch
+from sam2.build_sam import build_sam2_video_predictor
+
+try:
+    from safetensors.torch import save_file, load_file
+except ImportError:
+    save_file = load_file = None
+
+# Predictors already built in this process, keyed by (config, checkpoint, device)
+_PREDICTORS = {}
+
+
+def get_safetensors_path(checkpoint):
+    return os.path.splitext(checkpoint)[0] + ".safetensors"
+
+
+# Converts the pickled checkpoint to safetensors once. Returns None when the cache
+# can't be used, in which case callers fall back to the original .pt file.
+def convert_checkpoint(checkpoint):
+    if save_file is None:
+        return None
+
+    cache_path = get_safetensors_path(checkpoint)
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(checkpoint):
+        return cache_path
+
+    try:
+        state_dict = torch.load(checkpoint, map_location="cpu", weights_only=True)["model"]
+        state_dict = {k: v.contiguous() for k, v in state_dict.items()}
+        tmp_path = cache_path + ".tmp"
+        save_file(state_dict, tmp_path)
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        print(f"Could not cache checkpoint as safetensors ({e}); using {checkpoint}")
+        return None
+
+    print(f"Cached checkpoint weights to {cache_path}")
+    return cache_path
+
+
+def build_predictor(model_cfg, checkpoint, device):
+    cache_path = convert_checkpoint(checkpoint)
+    if cache_path is None:
+        return build_sam2_video_predictor(model_cfg, checkpoint, device=device)
+
+    predictor = build_sam2_video_predictor(model_cfg, None, device=device)
+    # safetensors maps the file, and assign=True lets the parameters alias the mapped
+    # tensors instead of copying them into freshly allocated storage
+    state_dict = load_file(cache_path, device=str(device))
+    missing_keys, unexpected_keys = predictor.load_state_dict(state_dict, assign=True)
+    if missing_keys or unexpected_keys:
+        raise RuntimeError(f"Checkpoint mismatch: missing {missing_keys}, unexpected {unexpected_keys}")
+    return predictor.eval()
+
+
+def get_video_predictor(model_cfg, checkpoint, device):
+    key = (model_cfg, os.path.abspath(checkpoint), str(device))
+    predictor = _PREDICTORS.get(key)
+    if predictor is None:
+        predictor = build_predictor(model_cfg, checkpoint, device)
+        _PREDICTORS[key] = predictor
+    return predictor
+
+
+def is_cached(model_cfg, checkpoint, device):
+    return (model_cfg, os.path.abspath(checkpoint), str(device)) in _PREDICTORS
+
+
+def clear_cache():
+    _PREDICTORS.clear()
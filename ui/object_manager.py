@@ -1,22 +1,67 @@
+import bisect
+from collections.abc import Mapping
+
+
 class ObjectManager:
+    # Objects keep a row position (insertion order) with O(1) id <-> row lookups. Listeners
+    # are called as listener(event, row) around every change, so a table view can update
+    # single rows: 'inserting'/'inserted', 'removing'/'removed', 'changed', and
+    # 'resetting'/'reset' (row None) when everything is cleared.
     def __init__(self):
         self.objects = {}
         self.tracked_objects = set()
         self.non_tracked_objects = set()
+        self.order = []
+        self.rows = {}
+        self.listeners = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def notify(self, event, row):
+        for listener in self.listeners:
+            listener(event, row)
+
+    def changed(self, obj_id):
+        if obj_id in self.rows:
+            self.notify('changed', self.rows[obj_id])
+
+    def row_of(self, obj_id):
+        return self.rows.get(obj_id)
+
+    def obj_id_at(self, row):
+        return self.order[row]
+
+    def __len__(self):
+        return len(self.order)
 
     def add_object(self, obj_id, category_name, color, tracking=True):
+        is_new = obj_id not in self.objects
+        if is_new:
+            self.notify('inserting', len(self.order))
         self.objects[obj_id] = {
             'category_name': category_name,
             'color': color,
             'last_valid_mask': None,
-            'tracking': tracking
+            'tracking': tracking,
+            # (start, end, mask) runs of frames where a non-tracked object keeps one mask
+            'static_masks': [],
+            # [start, end) frame spans the object was tracked on
+            'active_spans': []
         }
         self._update_tracking_sets(obj_id, tracking)
+        if is_new:
+            self.rows[obj_id] = len(self.order)
+            self.order.append(obj_id)
+            self.notify('inserted', self.rows[obj_id])
+        else:
+            self.changed(obj_id)
 
     def set_tracking(self, obj_id, tracking):
         if obj_id in self.objects:
             self.objects[obj_id]['tracking'] = tracking
             self._update_tracking_sets(obj_id, tracking)
+            self.changed(obj_id)
 
     def _update_tracking_sets(self, obj_id, tracking):
         if tracking:
@@ -39,20 +84,139 @@ class ObjectManager:
         if obj_id in self.objects:
             self.objects[obj_id]['last_valid_mask'] = mask
 
+    def set_static_mask(self, obj_id, mask, start, end):
+        # Holds mask on frames [start, end), replacing any earlier runs there; a run that
+        # continues the previous one with the same mask is merged into it
+        if obj_id not in self.objects:
+            return
+        runs = []
+        for run_start, run_end, run_mask in self.objects[obj_id]['static_masks']:
+            if run_start < start:
+                runs.append((run_start, min(run_end, start), run_mask))
+            if run_end > end:
+                runs.append((max(run_start, end), run_end, run_mask))
+        runs.append((start, end, mask))
+        runs.sort(key=lambda run: run[0])
+
+        merged = []
+        for run in runs:
+            if merged and merged[-1][1] == run[0] and merged[-1][2] is run[2]:
+                merged[-1] = (merged[-1][0], run[1], run[2])
+            else:
+                merged.append(run)
+        # A new list, so copies of the object data taken for undo keep the old runs
+        self.objects[obj_id]['static_masks'] = merged
+
+    def get_static_mask(self, obj_id, frame_idx):
+        obj_data = self.objects.get(obj_id)
+        if obj_data is None or obj_data['tracking']:
+            return None
+        runs = obj_data['static_masks']
+        position = bisect.bisect_right(runs, frame_idx, key=lambda run: run[0]) - 1
+        if position >= 0 and frame_idx < runs[position][1]:
+            return runs[position][2]
+        return None
+
+    def get_static_masks(self, frame_idx):
+        # Static masks only apply while the object is not tracked
+        masks = {}
+        for obj_id in self.non_tracked_objects:
+            mask = self.get_static_mask(obj_id, frame_idx)
+            if mask is not None:
+                masks[obj_id] = mask
+        return masks
+
+    def static_frames(self):
+        frames = set()
+        for obj_id in self.non_tracked_objects:
+            for start, end, _ in self.objects[obj_id]['static_masks']:
+                frames.update(range(start, end))
+        return frames
+
+    def add_active_span(self, obj_id, start, end):
+        if obj_id not in self.objects:
+            return
+        spans = sorted(self.objects[obj_id]['active_spans'] + [(start, end)])
+        merged = []
+        for span_start, span_end in spans:
+            if merged and span_start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], span_end))
+            else:
+                merged.append((span_start, span_end))
+        self.objects[obj_id]['active_spans'] = merged
+        self.changed(obj_id)
+
+    def restore_runs(self, obj_id, static_masks, active_spans):
+        # Puts back the static mask runs and tracked spans of an object re-added by undo/redo
+        if obj_id not in self.objects:
+            return
+        self.objects[obj_id]['static_masks'] = list(static_masks)
+        self.objects[obj_id]['active_spans'] = list(active_spans)
+        self.changed(obj_id)
+
+    def get_active_spans(self, obj_id):
+        obj_data = self.objects.get(obj_id)
+        return obj_data['active_spans'] if obj_data is not None else []
+
+    def resolve(self, video_segments):
+        return ResolvedSegments(video_segments, self)
+
     def get_all_objects(self):
         return self.objects
 
     def update_category_name(self, obj_id, new_name):
         if obj_id in self.objects:
             self.objects[obj_id]['category_name'] = new_name
+            self.changed(obj_id)
 
     def remove_object(self, obj_id):
         if obj_id in self.objects:
+            row = self.rows[obj_id]
+            self.notify('removing', row)
             del self.objects[obj_id]
             self.tracked_objects.discard(obj_id)
             self.non_tracked_objects.discard(obj_id)
+            del self.order[row]
+            del self.rows[obj_id]
+            for later_row in range(row, len(self.order)):
+                self.rows[self.order[later_row]] = later_row
+            self.notify('removed', row)
 
     def clear(self):
+        self.notify('resetting', None)
         self.objects.clear()
         self.tracked_objects.clear()
-        self.non_tracked_objects.clear()
\ No newline at end of file
+        self.non_tracked_objects.clear()
+        self.order.clear()
+        self.rows.clear()
+        self.notify('reset', None)
+
+
+class ResolvedSegments(Mapping):
+    # video_segments as seen by display and export: propagated masks of a frame plus the
+    # static masks of non-tracked objects covering it
+    def __init__(self, video_segments, object_manager):
+        self.video_segments = video_segments
+        self.object_manager = object_manager
+
+    def __getitem__(self, frame_idx):
+        static_masks = self.object_manager.get_static_masks(frame_idx)
+        if frame_idx not in self.video_segments:
+            if not static_masks:
+                raise KeyError(frame_idx)
+            return static_masks
+        masks = self.video_segments[frame_idx]
+        if not static_masks:
+            return masks
+        masks = dict(masks)
+        masks.update(static_masks)
+        return masks
+
+    def __contains__(self, frame_idx):
+        return frame_idx in self.video_segments or bool(self.object_manager.get_static_masks(frame_idx))
+
+    def __iter__(self):
+        return iter(sorted(set(self.video_segments) | self.object_manager.static_frames()))
+
+    def __len__(self):
+        return len(set(self.video_segments) | self.object_manager.static_frames())
\ No newline at end of file
@@ -0,0 +1,113 @@
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex
+from PyQt5.QtGui import QBrush
+
+# Table model over the ObjectManager. Rows follow the manager's object order and are
+# looked up through its id <-> row index, so adding, renaming, retracking or removing an
+# object touches only that row instead of rebuilding every row with cell widgets; the view
+# only paints the rows on screen, which keeps the table responsive with hundreds of objects.
+
+RESEGMENT_COLUMN, CATEGORY_COLUMN, COLOR_COLUMN, TRACKING_COLUMN = range(4)
+HEADERS = ['Re-segment', 'Category', 'Color', 'Tracking']
+
+
+class ObjectTableModel(QAbstractTableModel):
+    def __init__(self, interface, object_manager, parent=None):
+        super().__init__(parent)
+        self.interface = interface
+        self.object_manager = object_manager
+        object_manager.add_listener(self.on_objects_changed)
+
+    def on_objects_changed(self, event, row):
+        if event == 'inserting':
+            self.beginInsertRows(QModelIndex(), row, row)
+        elif event == 'inserted':
+            self.endInsertRows()
+        elif event == 'removing':
+            self.beginRemoveRows(QModelIndex(), row, row)
+        elif event == 'removed':
+            self.endRemoveRows()
+        elif event == 'resetting':
+            self.beginResetModel()
+        elif event == 'reset':
+            self.endResetModel()
+        elif event == 'changed':
+            self.refresh_row(row)
+
+    def refresh_row(self, row):
+        if row is not None:
+            self.dataChanged.emit(self.index(row, 0), self.index(row, len(HEADERS) - 1))
+
+    def refresh_object(self, obj_id):
+        self.refresh_row(self.object_manager.row_of(obj_id))
+
+    def refresh(self):
+        # State kept outside the manager (selection, suspended objects) changed for any row
+        if len(self.object_manager):
+            self.dataChanged.emit(self.index(0, 0), self.index(len(self.object_manager) - 1, len(HEADERS) - 1))
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.object_manager)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(HEADERS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return HEADERS[section]
+        return None
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        if index.column() in (RESEGMENT_COLUMN, TRACKING_COLUMN):
+            return Qt.ItemIsEnabled | Qt.ItemIsUserCheckable
+        if index.column() == CATEGORY_COLUMN:
+            return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable
+        return Qt.ItemIsEnabled
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or index.row() >= len(self.object_manager):
+            return None
+        obj_id = self.object_manager.obj_id_at(index.row())
+        obj_data = self.object_manager.get_object(obj_id)
+        column = index.column()
+
+        if column == RESEGMENT_COLUMN and role == Qt.CheckStateRole:
+            return Qt.Checked if obj_id == self.interface.current_object_id else Qt.Unchecked
+        if column == TRACKING_COLUMN and role == Qt.CheckStateRole:
+            return Qt.Checked if obj_data['tracking'] else Qt.Unchecked
+        if column == CATEGORY_COLUMN:
+            if role in (Qt.DisplayRole, Qt.EditRole):
+                return obj_data['category_name']
+            if role == Qt.ToolTipRole:
+                return self.tooltip(obj_id, obj_data)
+        if column == COLOR_COLUMN and role == Qt.BackgroundRole:
+            return QBrush(obj_data['color'])
+        if role == Qt.TextAlignmentRole:
+            return Qt.AlignCenter
+        return None
+
+    def tooltip(self, obj_id, obj_data):
+        spans = ", ".join(f"{start + 1}-{end}" for start, end in obj_data['active_spans'])
+        tooltip = f"Tracked on frames {spans}" if spans else "Not tracked yet"
+        suspended = self.interface.sam2_predictor.suspended
+        if obj_id in suspended:
+            tooltip += f"\nLost after frame {suspended[obj_id] + 1}; click on it again to resume tracking"
+        return tooltip
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if not index.isValid():
+            return False
+        obj_id = self.object_manager.obj_id_at(index.row())
+        column = index.column()
+        # The interface handlers update the manager, which reports the changed rows back
+        if column == RESEGMENT_COLUMN and role == Qt.CheckStateRole:
+            self.interface.on_resegment_checked(value, obj_id)
+            return True
+        if column == TRACKING_COLUMN and role == Qt.CheckStateRole:
+            self.interface.on_tracking_changed(value, obj_id)
+            return True
+        if column == CATEGORY_COLUMN and role == Qt.EditRole:
+            self.interface.on_category_name_change(obj_id, str(value))
+            return True
+        return False
@@ -0,0 +1,120 @@
+import os
+import json
+import time
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+import numpy as np
+
+# Lightweight span/counter instrumentation for the annotation hot paths. Every span
+# feeds a rolling per-stage duration window and a bounded trace buffer that can be
+# written as a Chrome trace (chrome://tracing or https://ui.perfetto.dev).
+# Set SAM2_PROFILE=0 to turn recording off.
+
+
+class Profiler:
+    def __init__(self, history=512, trace_limit=200000):
+        self.enabled = os.environ.get('SAM2_PROFILE', '1') != '0'
+        self.history = history
+        self.durations = defaultdict(lambda: deque(maxlen=self.history))
+        self.end_times = defaultdict(lambda: deque(maxlen=self.history))
+        self.counters = defaultdict(float)
+        self.trace_events = deque(maxlen=trace_limit)
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter())
+
+    def record(self, name, start, end):
+        with self.lock:
+            self.durations[name].append(end - start)
+            self.end_times[name].append(end)
+            self.trace_events.append({
+                "name": name,
+                "cat": name.split('.')[0],
+                "ph": "X",
+                "ts": (start - self.origin) * 1e6,
+                "dur": (end - start) * 1e6,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+            })
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] += value
+            self.trace_events.append({
+                "name": name,
+                "ph": "C",
+                "ts": (time.perf_counter() - self.origin) * 1e6,
+                "pid": os.getpid(),
+                "args": {"value": self.counters[name]},
+            })
+
+    def stats(self, name):
+        with self.lock:
+            durations = np.array(self.durations.get(name, ()), dtype=np.float64) * 1000.0
+        if durations.size == 0:
+            return None
+        return {
+            "count": int(durations.size),
+            "mean_ms": float(durations.mean()),
+            "p50_ms": float(np.percentile(durations, 50)),
+            "p90_ms": float(np.percentile(durations, 90)),
+            "p99_ms": float(np.percentile(durations, 99)),
+            "max_ms": float(durations.max()),
+        }
+
+    def rate(self, name):
+        # Completed spans per second over the rolling window
+        with self.lock:
+            end_times = list(self.end_times.get(name, ()))
+        if len(end_times) < 2 or end_times[-1] <= end_times[0]:
+            return None
+        return (len(end_times) - 1) / (end_times[-1] - end_times[0])
+
+    def summary(self):
+        summary = {name: self.stats(name) for name in list(self.durations)}
+        summary = {name: stats for name, stats in summary.items() if stats is not None}
+        return {"spans": summary, "counters": dict(self.counters)}
+
+    def format_summary(self):
+        lines = []
+        for name, stats in sorted(self.summary()["spans"].items()):
+            lines.append(f"{name:<28} n={stats['count']:<6} p50={stats['p50_ms']:8.2f} ms  "
+                         f"p90={stats['p90_ms']:8.2f} ms  p99={stats['p99_ms']:8.2f} ms")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"{name:<28} {value:g}")
+        return "\n".join(lines)
+
+    def export_chrome_trace(self, path):
+        with self.lock:
+            events = list(self.trace_events)
+        with open(path, 'w') as f:
+            json.dump({
+                "traceEvents": events,
+                "displayTimeUnit": "ms",
+                "otherData": self.summary(),
+            }, f)
+        return path
+
+    def reset(self):
+        with self.lock:
+            self.durations.clear()
+            self.end_times.clear()
+            self.counters.clear()
+            self.trace_events.clear()
+            self.origin = time.perf_counter()
+
+
+profiler = Profiler()
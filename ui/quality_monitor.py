@@ -0,0 +1,123 @@
+import json
+import bisect
+from mask_utils import as_sparse, mask_iou
+
+# Per-frame tracking-quality signals gathered during propagation. Every object gets its
+# mask area, IoU with the previous frame and (when the model exposes it) the object-score
+# logit; frames where any signal looks wrong are kept in a sorted index so review can jump
+# straight to them.
+
+AREA_JUMP = 0.5          # relative area change between consecutive frames
+MIN_IOU = 0.5            # IoU with the previous frame
+MIN_OBJECT_SCORE = 0.0   # object-score logit; below 0 the model thinks the object is absent
+MIN_AREA = 64            # masks smaller than this are too noisy for area/IoU checks
+LOST_FRAMES = 15         # consecutive lost frames before an object stops being tracked
+
+
+class QualityIndex:
+    def __init__(self, area_jump=AREA_JUMP, min_iou=MIN_IOU, min_object_score=MIN_OBJECT_SCORE, min_area=MIN_AREA):
+        self.area_jump = area_jump
+        self.min_iou = min_iou
+        self.min_object_score = min_object_score
+        self.min_area = min_area
+        self.signals = {}
+        self.reasons = {}
+        self.flagged = []
+
+    def update_frame(self, frame_idx, masks, previous_masks=None, scores=None):
+        previous_masks = previous_masks or {}
+        scores = scores or {}
+        frame_signals = {}
+        frame_reasons = []
+        for obj_id, mask in masks.items():
+            mask = as_sparse(mask)
+            signals = {'area': mask.area}
+            if obj_id in scores:
+                signals['object_score'] = scores[obj_id]
+                if scores[obj_id] < self.min_object_score and mask.area > 0:
+                    frame_reasons.append((obj_id, 'low object score'))
+
+            previous = previous_masks.get(obj_id)
+            if previous is not None:
+                previous = as_sparse(previous)
+                signals['iou_prev'] = mask_iou(mask, previous)
+                if previous.area > 0 and mask.area == 0:
+                    frame_reasons.append((obj_id, 'object lost'))
+                elif max(previous.area, mask.area) >= self.min_area:
+                    if abs(mask.area - previous.area) > self.area_jump * max(previous.area, 1):
+                        frame_reasons.append((obj_id, 'area jump'))
+                    if signals['iou_prev'] < self.min_iou:
+                        frame_reasons.append((obj_id, 'low IoU with previous frame'))
+            frame_signals[obj_id] = signals
+
+        self.signals[frame_idx] = frame_signals
+        self.set_reasons(frame_idx, frame_reasons)
+
+    def set_reasons(self, frame_idx, frame_reasons):
+        position = bisect.bisect_left(self.flagged, frame_idx)
+        is_flagged = position < len(self.flagged) and self.flagged[position] == frame_idx
+        if frame_reasons:
+            self.reasons[frame_idx] = frame_reasons
+            if not is_flagged:
+                self.flagged.insert(position, frame_idx)
+        else:
+            self.reasons.pop(frame_idx, None)
+            if is_flagged:
+                del self.flagged[position]
+
+    def next_flagged(self, frame_idx):
+        position = bisect.bisect_right(self.flagged, frame_idx)
+        return self.flagged[position] if position < len(self.flagged) else None
+
+    def previous_flagged(self, frame_idx):
+        position = bisect.bisect_left(self.flagged, frame_idx)
+        return self.flagged[position - 1] if position > 0 else None
+
+    def describe(self, frame_idx, object_names=None):
+        object_names = object_names or {}
+        return ", ".join(f"{object_names.get(obj_id, f'Object {obj_id}')}: {reason}"
+                         for obj_id, reason in self.reasons.get(frame_idx, ()))
+
+    def remove_object(self, obj_id):
+        for frame_idx in list(self.reasons):
+            self.signals[frame_idx].pop(obj_id, None)
+            self.set_reasons(frame_idx, [(o, r) for o, r in self.reasons[frame_idx] if o != obj_id])
+
+    def clear(self):
+        self.signals.clear()
+        self.reasons.clear()
+        self.flagged.clear()
+
+    def summary(self):
+        return {
+            "frames_checked": len(self.signals),
+            "frames_flagged": len(self.flagged),
+            "flagged": [{"frame_idx": frame_idx,
+                         "reasons": [{"obj_id": obj_id, "reason": reason} for obj_id, reason in self.reasons[frame_idx]]}
+                        for frame_idx in self.flagged],
+        }
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+        return path
+
+
+class ObjectLifecycle:
+    # Counts the consecutive frames each object was lost on (empty mask, or an object score
+    # saying it is absent) and reports objects that reached lost_frames, so propagation can
+    # stop spending decoder and memory-attention time on them
+    def __init__(self, lost_frames=LOST_FRAMES, min_object_score=MIN_OBJECT_SCORE):
+        self.lost_frames = lost_frames
+        self.min_object_score = min_object_score
+        self.lost_counts = {}
+
+    def update(self, masks, scores=None):
+        scores = scores or {}
+        expired = []
+        for obj_id, mask in masks.items():
+            lost = as_sparse(mask).area == 0 or scores.get(obj_id, self.min_object_score) < self.min_object_score
+            self.lost_counts[obj_id] = self.lost_counts.get(obj_id, 0) + 1 if lost else 0
+            if self.lost_counts[obj_id] >= self.lost_frames:
+                expired.append(obj_id)
+        return expired
@@ -0,0 +1,165 @@
+import select
+import socket
+import numpy as np
+from profiler import profiler
+from sam2_predictor import SAM2Predictor
+from mask_utils import LabelMap
+from inference_server import send_message, recv_message, attach_buffer, unpack_masks
+
+
+class RemoteSAM2Predictor(SAM2Predictor):
+    # SAM2Predictor whose model and inference state live in an inference server process
+    # (see inference_server.py). Prompt logs, suspended objects, the geometry index and
+    # quality flags are still kept here, so the interface uses it like the local one.
+    # idle_callback is called while waiting for the server, to keep the UI painting.
+    def __init__(self, socket_path, idle_callback=None):
+        super().__init__()
+        self.socket_path = socket_path
+        self.idle_callback = idle_callback
+        self.sock = None
+        self.shm = None
+
+    def call(self, op, **params):
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                self.sock.connect(self.socket_path)
+            except OSError as e:
+                self.sock = None
+                raise RuntimeError(f"Could not connect to the inference server at {self.socket_path}: {e}")
+        try:
+            send_message(self.sock, dict(op=op, **params))
+            if self.idle_callback is not None:
+                while not select.select([self.sock], [], [], 0.05)[0]:
+                    self.idle_callback()
+            reply = recv_message(self.sock)
+        except OSError as e:
+            # The server is gone along with its inference state; the next call reconnects
+            self.disconnect()
+            raise RuntimeError(f"Lost the connection to the inference server: {e}")
+        if not reply.get("ok"):
+            raise RuntimeError(f"Inference server error: {reply.get('error')}")
+        return reply
+
+    def masks(self, descriptor):
+        if self.shm is None or self.shm.name != descriptor["buffer"]:
+            if self.shm is not None:
+                self.shm.close()
+            self.shm = attach_buffer(descriptor["buffer"])
+        with profiler.span('remote.unpack'):
+            return unpack_masks(self.shm.buf, descriptor)
+
+    def disconnect(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.call('close')
+            except RuntimeError:
+                pass
+        self.disconnect()
+
+    def initialize_predictor(self, frame_source, progress_callback=None):
+        if progress_callback:
+            progress_callback("Initializing inference state on the inference server...")
+        with profiler.span('predictor.init_state'):
+            self.call('init', path=frame_source.path)
+        self.frame_loader = None
+        self.geometry.clear()
+        self.quality.clear()
+        self.prompt_log = []
+        self.suspended = {}
+
+        if progress_callback:
+            progress_callback("Initialization complete.")
+
+    def propagate_frames(self, start_frame_idx=0, max_frame_num_to_track=None, tracked_objects=None):
+        self.call('propagate', start_frame_idx=start_frame_idx, max_frame_num_to_track=max_frame_num_to_track,
+                  tracked_objects=list(tracked_objects) if tracked_objects is not None else None,
+                  label_map_mode=self.label_map_mode, prune_lost_objects=self.prune_lost_objects)
+        done = False
+        try:
+            while not done:
+                with profiler.span('propagate.inference'):
+                    reply = self.call('next')
+                self.mirror_suspended(reply["suspended"])
+                done = reply["done"]
+                if done:
+                    break
+                frame_idx = reply["frame_idx"]
+                frame_masks = self.masks(reply["masks"])
+                with profiler.span('propagate.geometry'):
+                    if isinstance(frame_masks, LabelMap):
+                        self.geometry.update_from_label_map(frame_idx, frame_masks)
+                    else:
+                        self.geometry.update_frame(frame_idx, list(frame_masks), list(frame_masks.values()))
+                yield frame_idx, frame_masks, dict(reply["scores"])
+        finally:
+            if not done and self.sock is not None:
+                self.call('stop')
+
+    def mirror_suspended(self, dropped):
+        for obj_id, frame_idx in dropped:
+            self.prompt_log.append({'type': 'remove', 'frame_idx': frame_idx, 'obj_id': obj_id})
+            self.suspended[obj_id] = frame_idx
+        if dropped:
+            print(f"Stopped tracking objects {[obj_id for obj_id, _ in dropped]}; prompt them again to resume")
+
+    def propagate_masks_roi(self, seed_masks, start_frame_idx=0, max_frame_num_to_track=None, progress_callback=None,
+                            tracked_objects=None, stop_condition=None):
+        print("ROI tracking is not available through the inference server; propagating full frames")
+        return self.propagate_masks(start_frame_idx, max_frame_num_to_track, progress_callback, tracked_objects,
+                                    stop_condition=stop_condition)
+
+    def suspend_object(self, obj_id, frame_idx):
+        if not self.call('remove', obj_id=obj_id, frame_idx=frame_idx)["removed"]:
+            return False
+        self.prompt_log.append({'type': 'remove', 'frame_idx': frame_idx, 'obj_id': obj_id})
+        self.suspended[obj_id] = frame_idx
+        return True
+
+    def generate_mask_with_points(self, frame_idx, obj_id, coords, labels):
+        # Returns the object's mask rather than the logits of every object
+        self.suspended.pop(obj_id, None)
+        coords, labels = np.asarray(coords).tolist(), np.asarray(labels).tolist()
+        self.prompt_log.append({'type': 'points', 'frame_idx': frame_idx, 'obj_id': obj_id, 'coords': coords, 'labels': labels})
+        with profiler.span('predict.points'):
+            reply = self.call('points', frame_idx=frame_idx, obj_id=obj_id, coords=coords, labels=labels)
+        return self.masks(reply["mask"])[obj_id] if reply["mask"] is not None else None
+
+    def predict_mask_with_points(self, frame_idx, obj_id, coords, labels):
+        return self.generate_mask_with_points(frame_idx, obj_id, coords, labels)
+
+    def generate_mask_with_box(self, frame_idx, obj_id, box):
+        self.suspended.pop(obj_id, None)
+        box = [float(v) for v in box]
+        self.prompt_log.append({'type': 'box', 'frame_idx': frame_idx, 'obj_id': obj_id, 'box': box})
+        with profiler.span('predict.box'):
+            reply = self.call('box', frame_idx=frame_idx, obj_id=obj_id, box=box)
+        return self.masks(reply["mask"])[obj_id]
+
+    def clear_prompts(self, frame_idx, obj_id):
+        self.prompt_log.extend(self.call('clear', frame_idx=frame_idx, obj_id=obj_id)["entries"])
+
+    def release_outputs(self, frame_idx):
+        # The inference state lives in the server process
+        return 0
+
+    def export_memory(self, frame_idx):
+        # The tracking memory stays on the server; restored sessions rebuild it from prompts
+        return {}
+
+    def import_memory(self, memory):
+        if memory:
+            print("Saved tracking memory is not sent to the inference server; it is rebuilt from the prompts")
+
+    def reset_state(self):
+        self.prompt_log = []
+        self.suspended = {}
+        self.call('reset')
@@ -1,12 +1,239 @@
+import cv2
 import torch
-from sam2.build_sam import build_sam2_video_predictor
+import numpy as np
+from collections import OrderedDict
+from contextlib import contextmanager
+import sam2.sam2_video_predictor as sam2_video_predictor_module
+from model_cache import get_video_predictor, is_cached
+from profiler import profiler
+from mask_utils import GeometryIndex, LabelMap, SparseMask, as_sparse, label_dtype, mask_iou
+from quality_monitor import ObjectLifecycle, QualityIndex
+
+class SAM2FrameLoader:
+    # Lazily decodes frames from a frame source into normalized model inputs, standing in
+    # for the frame tensor SAM2 normally builds by loading the whole video up front.
+    # roi = (x0, y0, x1, y1) restricts every frame to a crop, and frame_range = (start, end)
+    # exposes only that window of the video, renumbered from 0.
+    def __init__(self, frame_source, image_size, cache_size=16, roi=None, frame_range=None):
+        self.frame_source = frame_source
+        self.image_size = image_size
+        self.img_mean = torch.tensor((0.485, 0.456, 0.406), dtype=torch.float32)[:, None, None]
+        self.img_std = torch.tensor((0.229, 0.224, 0.225), dtype=torch.float32)[:, None, None]
+        self.roi = roi
+        self.frame_range = frame_range if frame_range is not None else (0, len(frame_source))
+        if roi is not None:
+            self.video_height, self.video_width = roi[3] - roi[1], roi[2] - roi[0]
+        else:
+            self.video_height, self.video_width = frame_source.frame_size()
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def __getitem__(self, index):
+        img = self.cache.get(index)
+        if img is not None:
+            self.cache.move_to_end(index)
+            return img
+
+        frame_idx = self.frame_range[0] + index
+        with profiler.span('frame.decode'):
+            frame = self.frame_source.read(frame_idx)
+        if frame is None:
+            raise IndexError(f"Could not decode frame {frame_idx} from {self.frame_source.path}")
+        if self.roi is not None:
+            x0, y0, x1, y1 = self.roi
+            frame = frame[y0:y1, x0:x1]
+        frame = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), (self.image_size, self.image_size),
+                           interpolation=cv2.INTER_CUBIC)
+        img = torch.from_numpy(frame).permute(2, 0, 1).float() / 255.0
+        img -= self.img_mean
+        img /= self.img_std
+
+        self.cache[index] = img
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return img
+
+    def __len__(self):
+        return self.frame_range[1] - self.frame_range[0]
+
+    def clear_cache(self):
+        self.cache.clear()
+
+
+@contextmanager
+def frames_from_loader(loader):
+    # init_state always goes through sam2's load_video_frames; swap it for the duration of
+    # the call so the inference state reads from our loader instead
+    original = sam2_video_predictor_module.load_video_frames
+    sam2_video_predictor_module.load_video_frames = lambda **kwargs: (loader, loader.video_height, loader.video_width)
+    try:
+        yield
+    finally:
+        sam2_video_predictor_module.load_video_frames = original
+
+
+def expand_roi(bbox, frame_height, frame_width, context=3.0, min_size=256):
+    # Square crop around bbox = (x0, y0, x1, y1) with room for the object to move, clamped
+    # to the frame
+    x0, y0, x1, y1 = bbox
+    side = max(min_size, context * max(x1 - x0, y1 - y0))
+    crop_w, crop_h = int(min(side, frame_width)), int(min(side, frame_height))
+    left = int(min(max((x0 + x1 - crop_w) / 2, 0), frame_width - crop_w))
+    top = int(min(max((y0 + y1 - crop_h) / 2, 0), frame_height - crop_h))
+    return left, top, left + crop_w, top + crop_h
+
+
+def needs_reseed(bbox, roi, frame_height, frame_width, border=0.15, max_fill=0.6):
+    # True once the object comes close to a crop edge that is not also a frame edge, or
+    # grows to fill most of the crop
+    x0, y0, x1, y1 = bbox
+    rx0, ry0, rx1, ry1 = roi
+    margin_x, margin_y = border * (rx1 - rx0), border * (ry1 - ry0)
+    near_edge = ((rx0 > 0 and x0 - rx0 < margin_x) or (rx1 < frame_width and rx1 - x1 < margin_x) or
+                 (ry0 > 0 and y0 - ry0 < margin_y) or (ry1 < frame_height and ry1 - y1 < margin_y))
+    too_large = ((rx1 - rx0 < frame_width and x1 - x0 > max_fill * (rx1 - rx0)) or
+                 (ry1 - ry0 < frame_height and y1 - y0 > max_fill * (ry1 - ry0)))
+    return near_edge or too_large
+
+
+class ROITrack:
+    # Tracks one object in its own inference state over a crop around its last bbox, so a
+    # small target in a large frame reaches the model at close to full input resolution
+    # and its masks are only ever materialized at crop size. When the object drifts toward
+    # the crop edge the track restarts in a new crop, seeded with its latest mask.
+    def __init__(self, predictor, frame_source, obj_id, seed_mask, start_frame_idx, end_frame_idx):
+        self.predictor = predictor
+        self.frame_source = frame_source
+        self.obj_id = obj_id
+        self.end_frame_idx = end_frame_idx
+        self.frame_height, self.frame_width = seed_mask.shape
+        self.start(start_frame_idx, seed_mask, emit_seed_frame=True)
+
+    def start(self, frame_idx, seed_mask, emit_seed_frame=False):
+        self.roi = expand_roi(seed_mask.bbox_xyxy, self.frame_height, self.frame_width)
+        self.first_frame_idx = frame_idx
+        loader = SAM2FrameLoader(self.frame_source, self.predictor.image_size, cache_size=2,
+                                 roi=self.roi, frame_range=(frame_idx, self.end_frame_idx))
+        with profiler.span('predictor.init_state'), frames_from_loader(loader):
+            self.inference_state = self.predictor.init_state(video_path=self.frame_source.path)
+        self.predictor.add_new_mask(self.inference_state, frame_idx=0, obj_id=self.obj_id,
+                                    mask=seed_mask.crop_to(self.roi))
+        self.propagation = self.predictor.propagate_in_video(self.inference_state, start_frame_idx=0)
+        if not emit_seed_frame:
+            next(self.propagation)
+
+    def step(self):
+        with profiler.span('propagate.inference'):
+            local_idx, _, out_mask_logits = next(self.propagation)
+        frame_idx = self.first_frame_idx + local_idx
+        with profiler.span('propagate.transfer'):
+            crop = (out_mask_logits[0] > 0.0).cpu().numpy()
+        mask = SparseMask.from_crop(crop, self.roi[:2], (self.frame_height, self.frame_width))
+        self.object_score = object_scores(self.inference_state, local_idx, [self.obj_id]).get(self.obj_id)
+
+        if (mask.area > 0 and frame_idx + 1 < self.end_frame_idx and
+                needs_reseed(mask.bbox_xyxy, self.roi, self.frame_height, self.frame_width)):
+            self.start(frame_idx, mask)
+        return frame_idx, mask
+
+
+def object_scores(inference_state, frame_idx, obj_ids):
+    # Object-score logits SAM2 stored for frame_idx, fetched in one transfer; objects
+    # without one are left out
+    found, logits = [], []
+    for obj_id in obj_ids:
+        obj_idx = inference_state.get("obj_id_to_idx", {}).get(obj_id)
+        if obj_idx is None:
+            continue
+        outputs = inference_state["output_dict_per_obj"][obj_idx]
+        out = outputs["cond_frame_outputs"].get(frame_idx) or outputs["non_cond_frame_outputs"].get(frame_idx)
+        if out is None or out.get("object_score_logits") is None:
+            continue
+        found.append(obj_id)
+        logits.append(out["object_score_logits"].reshape(-1)[:1])
+    if not logits:
+        return {}
+    return dict(zip(found, torch.cat(logits).float().cpu().tolist()))
+
+
+def crop_masks(masks):
+    # (N, 1, H, W) boolean device tensor -> list of SparseMask, copying only bbox crops
+    masks = masks.reshape(masks.shape[0], *masks.shape[-2:])
+    shape = tuple(masks.shape[-2:])
+    rows_any = masks.any(dim=2).cpu().numpy()
+    cols_any = masks.any(dim=1).cpu().numpy()
+    sparse_masks = []
+    for i in range(masks.shape[0]):
+        rows = rows_any[i].nonzero()[0]
+        if rows.size == 0:
+            sparse_masks.append(SparseMask.empty(shape))
+            continue
+        cols = cols_any[i].nonzero()[0]
+        y0, y1, x0, x1 = int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1
+        sparse_masks.append(SparseMask(masks[i, y0:y1, x0:x1].cpu().numpy(), (x0, y0), shape))
+    return sparse_masks
+
+
+def object_mask(out_obj_ids, out_mask_logits, obj_id):
+    # Logits come in inference-state order, which changes when objects are removed, so the
+    # object's row is found by id; None if SAM2 returned no mask for it
+    out_obj_ids = list(out_obj_ids)
+    if obj_id not in out_obj_ids:
+        return None
+    index = out_obj_ids.index(obj_id)
+    return crop_masks(out_mask_logits[index:index + 1] > 0.0)[0]
+
+
+def label_map_from_logits(mask_logits, obj_ids, threshold=0.0):
+    # (N, 1, H, W) logits -> LabelMap. Each pixel goes to the object with the highest logit
+    # if that logit clears the threshold, so overlaps are resolved on the device and a
+    # single (H, W) integer image is copied to the host
+    mask_logits = mask_logits.reshape(mask_logits.shape[0], *mask_logits.shape[-2:])
+    best_logits, best_idx = mask_logits.max(dim=0)
+    labels = torch.where(best_logits > threshold, best_idx + 1, torch.zeros_like(best_idx))
+    dtype = label_dtype(len(obj_ids))
+    labels = labels.to(torch.uint8 if dtype == np.uint8 else torch.int32).cpu().numpy().astype(dtype, copy=False)
+    return LabelMap(labels, obj_ids)
+
+
+def to_device(value, device):
+    if torch.is_tensor(value):
+        return value.to(device)
+    if isinstance(value, dict):
+        return {k: to_device(v, device) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(to_device(v, device) for v in value)
+    return value
+
 
 class SAM2Predictor:
     def __init__(self):
         self.predictor = None
         self.inference_state = None
+        self.frame_loader = None
+        self.geometry = GeometryIndex()
+        self.quality = QualityIndex()
+        self.roi_mode = False
+        # Store each propagated frame as one LabelMap instead of a dict of per-object masks
+        self.label_map_mode = False
+        # With prune_lost_objects, objects lost for LOST_FRAMES frames in a row are removed
+        # from the inference state (obj_id -> frame they were dropped on) until they are
+        # prompted again
+        self.prune_lost_objects = False
+        self.suspended = {}
+        # obj_id -> [first, last] frame each object was output on by the last propagation
+        self.object_spans = {}
+        # Every prompt given to the inference state since the last reset, so a saved
+        # session can rebuild the same conditioning frames
+        self.prompt_log = []
+        # Creates the mapping propagation stores frames in (the memory governor's spillable
+        # store in the UI) and the last frame propagation output, where it works next
+        self.segments_factory = dict
+        self.last_output_frame = None
 
-    def initialize_predictor(self, video_dir, progress_callback=None):
+    def initialize_predictor(self, frame_source, progress_callback=None, frame_range=None):
+        # frame_range = (start, end) limits the inference state to that window of the video,
+        # renumbered from 0
         sam2_checkpoint = "../external/sam2/checkpoints/sam2.1_hiera_large.pt"
         model_cfg = "configs/sam2.1/sam2.1_hiera_l.yaml"
         
@@ -21,12 +248,13 @@ class SAM2Predictor:
             device = torch.device("cpu")
         print(f"using device: {device}")
 
-        if device.type == "cuda":
+        first_build = not is_cached(model_cfg, sam2_checkpoint, device)
+        if device.type == "cuda" and first_build:
             torch.autocast("cuda", dtype=torch.bfloat16).__enter__()
             if torch.cuda.get_device_properties(0).major >= 8:
                 torch.backends.cuda.matmul.allow_tf32 = True
                 torch.backends.cudnn.allow_tf32 = True
-        elif device.type == "mps":
+        elif device.type == "mps" and first_build:
             print(
                 "\nSupport for MPS devices is preliminary. SAM 2 is trained with CUDA and might "
                 "give numerically different outputs and sometimes degraded performance on MPS. "
@@ -34,56 +262,329 @@ class SAM2Predictor:
             )
         
         if progress_callback:
-            progress_callback("Building SAM2 predictor...")
+            progress_callback("Building SAM2 predictor..." if first_build else "Reusing loaded SAM2 predictor...")
 
-        self.predictor = build_sam2_video_predictor(model_cfg, sam2_checkpoint, device=device)
+        with profiler.span('predictor.build'):
+            self.predictor = get_video_predictor(model_cfg, sam2_checkpoint, device)
         
         if progress_callback:
             progress_callback("Initializing inference state...")
 
-        self.inference_state = self.predictor.init_state(video_path=video_dir)
+        with profiler.span('predictor.init_state'):
+            self.inference_state = self.init_state(frame_source, frame_range)
         self.predictor.reset_state(self.inference_state)
+        self.geometry.clear()
+        self.quality.clear()
+        self.prompt_log = []
+        self.suspended = {}
+        self.last_output_frame = None
         
         if progress_callback:
             progress_callback("Initialization complete.")
 
-    def propagate_masks(self, start_frame_idx=0, max_frame_num_to_track=None, progress_callback=None, tracked_objects=None):
-        video_segments = {}
+    def init_state(self, frame_source, frame_range=None):
+        self.frame_loader = SAM2FrameLoader(frame_source, self.predictor.image_size, frame_range=frame_range)
+        with frames_from_loader(self.frame_loader):
+            return self.predictor.init_state(video_path=frame_source.path)
+
+    def propagate_masks(self, start_frame_idx=0, max_frame_num_to_track=None, progress_callback=None, tracked_objects=None, seed_masks=None,
+                        stop_condition=None):
+        # stop_condition(frame_idx, frame_masks) returning True ends propagation after that frame
+        if self.roi_mode and seed_masks is not None:
+            return self.propagate_masks_roi(seed_masks, start_frame_idx, max_frame_num_to_track, progress_callback, tracked_objects,
+                                            stop_condition)
+
+        video_segments = self.segments_factory()
+        self.object_spans = {}
+        frames = self.propagate_frames(start_frame_idx, max_frame_num_to_track, tracked_objects)
+        for frame_count, (out_frame_idx, frame_masks, scores) in enumerate(frames):
+            video_segments[out_frame_idx] = frame_masks
+            self.last_output_frame = out_frame_idx
+            with profiler.span('propagate.quality'):
+                self.quality.update_frame(out_frame_idx, frame_masks, video_segments.get(out_frame_idx - 1), scores)
+            self.update_object_spans(out_frame_idx, frame_masks)
+            profiler.count('propagate.frames')
+
+            if progress_callback:
+                progress_callback(frame_count)
+            if stop_condition is not None and stop_condition(out_frame_idx, frame_masks):
+                frames.close()
+                break
+
+        return video_segments
+
+    def propagate_frames(self, start_frame_idx=0, max_frame_num_to_track=None, tracked_objects=None):
+        # Yields (frame_idx, frame_masks, object scores) for each propagated frame, dropping
+        # objects that stay lost from the inference state on the way
         frame_count = 0
-        
-        for out_frame_idx, out_obj_ids, out_mask_logits in self.predictor.propagate_in_video(self.inference_state, start_frame_idx=start_frame_idx, max_frame_num_to_track=max_frame_num_to_track):
-            video_segments[out_frame_idx] = {}
-            for i, out_obj_id in enumerate(out_obj_ids):
-                if tracked_objects is None or out_obj_id in tracked_objects:
-                    video_segments[out_frame_idx][out_obj_id] = (out_mask_logits[i] > 0.0).cpu().numpy()
-            
+        lifecycle = ObjectLifecycle() if self.prune_lost_objects else None
+
+        propagation = self.predictor.propagate_in_video(self.inference_state, start_frame_idx=start_frame_idx, max_frame_num_to_track=max_frame_num_to_track)
+        try:
+            while True:
+                with profiler.span('propagate.inference'):
+                    output = next(propagation, None)
+                if output is None:
+                    break
+                out_frame_idx, out_obj_ids, out_mask_logits = output
+
+                frame_masks = self.postprocess_frame(out_frame_idx, out_obj_ids, out_mask_logits, tracked_objects)
+                with profiler.span('propagate.quality'):
+                    scores = object_scores(self.inference_state, out_frame_idx, frame_masks)
+                yield out_frame_idx, frame_masks, scores
+
+                frame_count += 1
+                if max_frame_num_to_track is not None and frame_count >= max_frame_num_to_track:
+                    break
+
+                if lifecycle is not None:
+                    expired = [obj_id for obj_id in lifecycle.update(frame_masks, scores)
+                               if self.suspend_object(obj_id, out_frame_idx)]
+                    if expired:
+                        # SAM2 fixes the object batch when propagation starts, so carry on from
+                        # the next frame with the smaller batch
+                        print(f"Stopped tracking objects {expired} after frame {out_frame_idx + 1}; prompt them again to resume")
+                        propagation.close()
+                        remaining = None if max_frame_num_to_track is None else max_frame_num_to_track - frame_count
+                        propagation = self.predictor.propagate_in_video(self.inference_state, start_frame_idx=out_frame_idx + 1,
+                                                                        max_frame_num_to_track=remaining)
+        finally:
+            propagation.close()
+
+    def suspend_object(self, obj_id, frame_idx):
+        # The last object can't be removed without resetting the whole state
+        obj_id_to_idx = self.inference_state.get("obj_id_to_idx", {})
+        if obj_id not in obj_id_to_idx or len(obj_id_to_idx) <= 1:
+            return False
+        self.predictor.remove_object(self.inference_state, obj_id, need_output=False)
+        self.prompt_log.append({'type': 'remove', 'frame_idx': frame_idx, 'obj_id': obj_id})
+        self.suspended[obj_id] = frame_idx
+        return True
+
+    def update_object_spans(self, frame_idx, frame_masks):
+        for obj_id in frame_masks:
+            span = self.object_spans.setdefault(obj_id, [frame_idx, frame_idx])
+            span[0] = min(span[0], frame_idx)
+            span[1] = max(span[1], frame_idx)
+
+    def propagate_correction(self, reference_segments, start_frame_idx, iou_threshold=0.9, converge_frames=5,
+                             progress_callback=None, tracked_objects=None, seed_masks=None):
+        # Re-propagates after an edit on start_frame_idx only until every object's new mask
+        # matches reference_segments (IoU >= iou_threshold) for converge_frames frames in a
+        # row; the reference is kept for all other frames. The recomputed frames are written
+        # into reference_segments, whose other frames are never read, so frames it keeps
+        # packed (spilled or in a session archive) stay packed. Returns reference_segments
+        # and the last recomputed frame.
+        streak = [0]
+
+        def converged(frame_idx, frame_masks):
+            reference = reference_segments.get(frame_idx, {})
+            agrees = bool(frame_masks) and all(
+                obj_id in reference and mask_iou(mask, reference[obj_id]) >= iou_threshold
+                for obj_id, mask in frame_masks.items())
+            streak[0] = streak[0] + 1 if agrees else 0
+            return streak[0] >= converge_frames
+
+        recomputed = self.propagate_masks(start_frame_idx=start_frame_idx, progress_callback=progress_callback,
+                                          tracked_objects=tracked_objects, seed_masks=seed_masks, stop_condition=converged)
+        for frame_idx, masks in recomputed.items():
+            # A copy, so snapshots taken for saving keep the reference frame
+            frame_masks = reference_segments[frame_idx].copy() if frame_idx in reference_segments else {}
+            frame_masks.update(masks)
+            reference_segments[frame_idx] = frame_masks
+        return reference_segments, max(recomputed, default=start_frame_idx)
+
+    def propagate_masks_roi(self, seed_masks, start_frame_idx=0, max_frame_num_to_track=None, progress_callback=None, tracked_objects=None,
+                            stop_condition=None):
+        # seed_masks holds each object's mask on start_frame_idx; objects without one (or
+        # with an empty one) have nothing to track from and are left out
+        frame_source = self.frame_loader.frame_source
+        end_frame_idx = len(frame_source)
+        if max_frame_num_to_track is not None:
+            end_frame_idx = min(start_frame_idx + max_frame_num_to_track, end_frame_idx)
+
+        tracks = []
+        for obj_id, mask in seed_masks.items():
+            if tracked_objects is not None and obj_id not in tracked_objects:
+                continue
+            seed_mask = as_sparse(mask)
+            if seed_mask.area > 0:
+                tracks.append(ROITrack(self.predictor, frame_source, obj_id, seed_mask, start_frame_idx, end_frame_idx))
+
+        video_segments = self.segments_factory()
+        self.object_spans = {}
+        lifecycle = ObjectLifecycle() if self.prune_lost_objects else None
+        for frame_count, frame_idx in enumerate(range(start_frame_idx, end_frame_idx)):
+            frame_masks = {}
+            for track in tracks:
+                _, frame_masks[track.obj_id] = track.step()
+            with profiler.span('propagate.geometry'):
+                self.geometry.update_frame(frame_idx, list(frame_masks), list(frame_masks.values()))
+            with profiler.span('propagate.quality'):
+                scores = {track.obj_id: track.object_score for track in tracks if track.object_score is not None}
+                self.quality.update_frame(frame_idx, frame_masks, video_segments.get(frame_idx - 1), scores)
+            video_segments[frame_idx] = frame_masks
+            self.last_output_frame = frame_idx
+            self.update_object_spans(frame_idx, frame_masks)
+            profiler.count('propagate.frames')
+
             if progress_callback:
                 progress_callback(frame_count)
-            
-            frame_count += 1
-            if max_frame_num_to_track is not None and frame_count >= max_frame_num_to_track:
+            if stop_condition is not None and stop_condition(frame_idx, frame_masks):
                 break
+            if lifecycle is not None:
+                # Each ROI track has its own state, so a lost one is simply dropped
+                expired = set(lifecycle.update(frame_masks, scores))
+                if expired:
+                    print(f"Stopped tracking objects {sorted(expired)} after frame {frame_idx + 1}; prompt them again to resume")
+                    self.suspended.update((obj_id, frame_idx) for obj_id in expired)
+                    tracks = [track for track in tracks if track.obj_id not in expired]
 
         return video_segments
 
+    def postprocess_frame(self, frame_idx, out_obj_ids, out_mask_logits, tracked_objects=None):
+        # Threshold every object at once on the device and find each mask's bbox there, so
+        # only the bbox crops are copied to the host
+        keep = [i for i, out_obj_id in enumerate(out_obj_ids) if tracked_objects is None or out_obj_id in tracked_objects]
+        if not keep:
+            return {}
+        obj_ids = [out_obj_ids[i] for i in keep]
+        if len(keep) < len(out_obj_ids):
+            out_mask_logits = out_mask_logits[keep]
+
+        if self.label_map_mode:
+            with profiler.span('propagate.transfer'):
+                label_map = label_map_from_logits(out_mask_logits, obj_ids)
+            with profiler.span('propagate.geometry'):
+                self.geometry.update_from_label_map(frame_idx, label_map)
+            return label_map
+
+        with profiler.span('propagate.transfer'):
+            mask_list = crop_masks(out_mask_logits > 0.0)
+        with profiler.span('propagate.geometry'):
+            self.geometry.update_frame(frame_idx, obj_ids, mask_list)
+        return dict(zip(obj_ids, mask_list))
+
     def generate_mask_with_points(self, frame_idx, obj_id, coords, labels):
-        _, _, out_mask_logits = self.predictor.add_new_points_or_box(
-            inference_state=self.inference_state,
-            frame_idx=frame_idx,
-            obj_id=obj_id,
-            points=coords,
-            labels=labels,
-        )
-        return out_mask_logits
+        self.suspended.pop(obj_id, None)
+        self.prompt_log.append({'type': 'points', 'frame_idx': frame_idx, 'obj_id': obj_id,
+                                'coords': np.asarray(coords).tolist(), 'labels': np.asarray(labels).tolist()})
+        with profiler.span('predict.points'):
+            _, out_obj_ids, out_mask_logits = self.predictor.add_new_points_or_box(
+                inference_state=self.inference_state,
+                frame_idx=frame_idx,
+                obj_id=obj_id,
+                points=coords,
+                labels=labels,
+            )
+        return out_obj_ids, out_mask_logits
+
+    def predict_mask_with_points(self, frame_idx, obj_id, coords, labels):
+        # The object's mask after adding the prompts, or None if SAM2 returned no masks
+        out_obj_ids, out_mask_logits = self.generate_mask_with_points(frame_idx, obj_id, coords, labels)
+        return object_mask(out_obj_ids, out_mask_logits, obj_id)
     
     def generate_mask_with_box(self, frame_idx, obj_id, box):
-        _, _, out_mask_logits = self.predictor.add_new_points_or_box(
-            inference_state=self.inference_state,
-            frame_idx=frame_idx,
-            obj_id=obj_id,
-            box=box
-        )
-        return (out_mask_logits[obj_id] > 0.0).cpu().numpy()
+        self.suspended.pop(obj_id, None)
+        self.prompt_log.append({'type': 'box', 'frame_idx': frame_idx, 'obj_id': obj_id, 'box': [float(v) for v in box]})
+        with profiler.span('predict.box'):
+            _, out_obj_ids, out_mask_logits = self.predictor.add_new_points_or_box(
+                inference_state=self.inference_state,
+                frame_idx=frame_idx,
+                obj_id=obj_id,
+                box=box
+            )
+        return object_mask(out_obj_ids, out_mask_logits, obj_id)
     
+    def add_mask_prompt(self, frame_idx, obj_id, mask):
+        # Conditions the object on a whole mask, e.g. one carried over from another window
+        self.suspended.pop(obj_id, None)
+        with profiler.span('predict.mask'):
+            self.predictor.add_new_mask(self.inference_state, frame_idx=frame_idx, obj_id=obj_id, mask=np.asarray(mask))
+
+    def clear_prompts(self, frame_idx, obj_id):
+        obj_idx = self.inference_state["obj_id_to_idx"].get(obj_id)
+        if obj_idx is None:
+            return
+        self.prompt_log.append({'type': 'clear', 'frame_idx': frame_idx, 'obj_id': obj_id})
+        self.predictor.clear_all_prompts_in_frame(self.inference_state, frame_idx, obj_id, need_output=False)
+        # SAM2 refuses to propagate an object without inputs, so an object whose last prompts
+        # were cleared leaves the inference state; prompting it again adds it back
+        if not self.inference_state["point_inputs_per_obj"][obj_idx] and not self.inference_state["mask_inputs_per_obj"][obj_idx]:
+            self.predictor.remove_object(self.inference_state, obj_id, need_output=False)
+            self.prompt_log.append({'type': 'remove', 'frame_idx': frame_idx, 'obj_id': obj_id})
+
+    def compacted_prompt_log(self):
+        # Each call replaces the object's prompts on that frame, so only the last entry
+        # per (frame, object) matters; removing an object drops all its earlier prompts.
+        # Entries keep the position of the first one for their key, so objects are created
+        # in the same order on replay and get the same obj_idx.
+        latest = {}
+        for entry in self.prompt_log:
+            if entry['type'] == 'remove':
+                for key in [key for key in latest if key[1] == entry['obj_id']]:
+                    del latest[key]
+                continue
+            latest[(entry['frame_idx'], entry['obj_id'])] = entry
+        return list(latest.values())
+
+    def replay_prompts(self, prompt_log):
+        for entry in prompt_log:
+            if entry['type'] == 'points':
+                self.generate_mask_with_points(entry['frame_idx'], entry['obj_id'],
+                                               np.array(entry['coords'], dtype=np.float32), np.array(entry['labels'], dtype=np.int32))
+            elif entry['type'] == 'box':
+                self.generate_mask_with_box(entry['frame_idx'], entry['obj_id'], entry['box'])
+            elif entry['type'] == 'clear':
+                self.clear_prompts(entry['frame_idx'], entry['obj_id'])
+            elif entry['type'] == 'remove':
+                self.suspend_object(entry['obj_id'], entry['frame_idx'])
+
+    def memory_window(self):
+        # How many frames back propagation attends to, through memory features or object pointers
+        return max(self.predictor.num_maskmem * self.predictor.memory_temporal_stride_for_eval,
+                   self.predictor.max_obj_ptrs_in_encoder)
+
+    def export_memory(self, frame_idx):
+        # Memory-bank outputs of the frames propagation from frame_idx would attend to,
+        # moved to the CPU
+        window = self.memory_window()
+        memory = {}
+        for obj_id, obj_idx in self.inference_state["obj_id_to_idx"].items():
+            outputs = self.inference_state["output_dict_per_obj"][obj_idx]["non_cond_frame_outputs"]
+            tracked = self.inference_state["frames_tracked_per_obj"][obj_idx]
+            memory[obj_id] = {f: (to_device(out, 'cpu'), tracked.get(f, {"reverse": False}))
+                              for f, out in outputs.items() if frame_idx - window <= f <= frame_idx}
+        return memory
+
+    def import_memory(self, memory):
+        device = self.inference_state["device"]
+        for obj_id, outputs in memory.items():
+            obj_idx = self.predictor._obj_id_to_idx(self.inference_state, obj_id)
+            for f, (out, tracked) in outputs.items():
+                self.inference_state["output_dict_per_obj"][obj_idx]["non_cond_frame_outputs"][f] = to_device(out, device)
+                self.inference_state["frames_tracked_per_obj"][obj_idx].setdefault(f, tracked)
+
+    def release_outputs(self, frame_idx):
+        # Drops the per-frame outputs (memory features, low-res masks, object pointers) of
+        # frames that aren't prompted and lie more than the memory window away from both
+        # frame_idx and the last propagated frame. Propagation near those two frames sees
+        # the same memory; propagating again from a released frame starts from the
+        # prompted frames, as after restoring a session. Returns the number released.
+        if self.inference_state is None:
+            return 0
+        window = self.memory_window()
+        anchors = [f for f in (frame_idx, self.last_output_frame) if f is not None]
+        released = 0
+        for outputs in self.inference_state["output_dict_per_obj"].values():
+            frame_outputs = outputs["non_cond_frame_outputs"]
+            for f in [f for f in frame_outputs if all(abs(f - anchor) > window for anchor in anchors)]:
+                del frame_outputs[f]
+                released += 1
+        return released
+
     def reset_state(self):
+        self.prompt_log = []
+        self.suspended = {}
+        self.last_output_frame = None
         self.predictor.reset_state(self.inference_state)
@@ -0,0 +1,281 @@
+import io
+import os
+import json
+import zipfile
+import threading
+from abc import abstractmethod
+from collections.abc import MutableMapping
+import numpy as np
+import torch
+from profiler import profiler
+from mask_utils import SparseMask, as_sparse
+
+# Annotation sessions are zip archives:
+#   meta.json          video path, current frame, objects, predictor prompt log
+#   current.npz        masks shown on the current frame
+#   static.npz         masks of non-tracked objects, referenced by frame runs in meta.json
+#   segments/<n>.npz   propagated masks for frame n, bit-packed bbox crops
+#   memory.pt          (optional) SAM2 memory-bank outputs near the current frame
+# Frames are decoded only when first accessed after a restore, and saving runs on a
+# background thread from a snapshot taken on the caller's thread.
+
+SESSION_VERSION = 1
+SESSION_EXTENSION = '.sam2session'
+AUTOSAVE_INTERVAL_MS = 5 * 60 * 1000
+
+
+def pack_masks(masks):
+    obj_ids = list(masks)
+    sparse = [as_sparse(masks[obj_id]) for obj_id in obj_ids]
+    packed = [np.packbits(mask.crop, axis=None) for mask in sparse]
+    buffer = io.BytesIO()
+    np.savez(buffer,
+             obj_ids=np.array(obj_ids, dtype=np.int64),
+             offsets=np.array([mask.offset for mask in sparse], dtype=np.int64).reshape(-1, 2),
+             crop_shapes=np.array([mask.crop.shape for mask in sparse], dtype=np.int64).reshape(-1, 2),
+             frame_shapes=np.array([mask.shape for mask in sparse], dtype=np.int64).reshape(-1, 2),
+             bit_offsets=np.cumsum([0] + [p.size for p in packed]),
+             bits=np.concatenate(packed) if packed else np.zeros(0, dtype=np.uint8))
+    return buffer.getvalue()
+
+
+def unpack_masks(data):
+    arrays = np.load(io.BytesIO(data))
+    masks = {}
+    bit_offsets = arrays['bit_offsets']
+    for i, obj_id in enumerate(arrays['obj_ids'].tolist()):
+        h, w = arrays['crop_shapes'][i].tolist()
+        bits = arrays['bits'][bit_offsets[i]:bit_offsets[i + 1]]
+        crop = np.unpackbits(bits, count=h * w).reshape(h, w).astype(bool)
+        masks[obj_id] = SparseMask(crop, tuple(arrays['offsets'][i].tolist()), tuple(arrays['frame_shapes'][i].tolist()))
+    return masks
+
+
+def packed_obj_ids(data):
+    # Object ids of a packed frame; only that array of the archive is read
+    return np.load(io.BytesIO(data))['obj_ids'].tolist()
+
+
+def segment_member(frame_idx):
+    return f"segments/{frame_idx}.npz"
+
+
+class PackedSegments(MutableMapping):
+    # video_segments keeping some frames packed (pack_masks bytes) outside memory: loaded
+    # holds unpacked frames, pending the frames read_packed can return, unpacked on first
+    # access. Subclasses say where packed frames live. Pending frames edited while packed
+    # go through write_packed, which keeps them in repacked unless a subclass stores them.
+    load_span = 'session.load_frame'
+
+    def __init__(self):
+        self.loaded = {}
+        self.pending = set()
+        self.repacked = {}
+        self.lock = threading.Lock()
+
+    @abstractmethod
+    def read_packed(self, frame_idx):
+        pass
+
+    def write_packed(self, frame_idx, data):
+        self.repacked[frame_idx] = data
+
+    def discard_packed(self, frame_idx):
+        # Called once a pending frame is unpacked, replaced or deleted
+        pass
+
+    def packed(self, frame_idx):
+        data = self.repacked.get(frame_idx)
+        return data if data is not None else self.read_packed(frame_idx)
+
+    def unpend(self, frame_idx):
+        self.pending.discard(frame_idx)
+        self.repacked.pop(frame_idx, None)
+        self.discard_packed(frame_idx)
+
+    def raw(self, frame_idx):
+        # Packed bytes of a frame that isn't unpacked, or None
+        with self.lock:
+            if frame_idx not in self.pending:
+                return None
+            return self.packed(frame_idx)
+
+    def __getitem__(self, frame_idx):
+        with self.lock:
+            if frame_idx in self.pending:
+                with profiler.span(self.load_span):
+                    self.loaded[frame_idx] = unpack_masks(self.packed(frame_idx))
+                self.unpend(frame_idx)
+            return self.loaded[frame_idx]
+
+    def __setitem__(self, frame_idx, masks):
+        with self.lock:
+            if frame_idx in self.pending:
+                self.unpend(frame_idx)
+            self.loaded[frame_idx] = masks
+
+    def __delitem__(self, frame_idx):
+        with self.lock:
+            if frame_idx in self.pending:
+                self.unpend(frame_idx)
+            else:
+                del self.loaded[frame_idx]
+
+    def remove_object(self, obj_id):
+        # Drops obj_id from every frame and returns its masks by frame. Packed frames that
+        # hold the object are repacked without it and stay packed; the others are not
+        # unpacked.
+        removed = {}
+        with self.lock:
+            for frame_idx, masks in self.loaded.items():
+                if obj_id in masks:
+                    removed[frame_idx] = masks.pop(obj_id)
+            for frame_idx in self.pending:
+                data = self.packed(frame_idx)
+                if obj_id in packed_obj_ids(data):
+                    masks = unpack_masks(data)
+                    removed[frame_idx] = masks.pop(obj_id)
+                    self.write_packed(frame_idx, pack_masks(masks))
+        return removed
+
+    def insert_object(self, obj_id, frame_masks):
+        # Puts back masks returned by remove_object, repacking frames that are still packed
+        with self.lock:
+            for frame_idx, mask in frame_masks.items():
+                if frame_idx in self.pending:
+                    masks = unpack_masks(self.packed(frame_idx))
+                    masks[obj_id] = mask
+                    self.write_packed(frame_idx, pack_masks(masks))
+                else:
+                    self.loaded.setdefault(frame_idx, {})[obj_id] = mask
+
+    def __contains__(self, frame_idx):
+        return frame_idx in self.pending or frame_idx in self.loaded
+
+    def __iter__(self):
+        return iter(sorted(self.pending | set(self.loaded)))
+
+    def __len__(self):
+        return len(self.pending) + len(self.loaded)
+
+
+class LazySegments(PackedSegments):
+    # video_segments backed by a session archive
+    def __init__(self, path):
+        super().__init__()
+        self.archive = zipfile.ZipFile(path, 'r')
+        for name in self.archive.namelist():
+            if name.startswith('segments/'):
+                self.pending.add(int(os.path.splitext(os.path.basename(name))[0]))
+
+    def read_packed(self, frame_idx):
+        return self.archive.read(segment_member(frame_idx))
+
+    def close(self):
+        self.archive.close()
+
+
+def remove_object_masks(video_segments, obj_id):
+    # Removes an object from every frame and returns its masks by frame, for undo
+    if isinstance(video_segments, PackedSegments):
+        return video_segments.remove_object(obj_id)
+    removed = {}
+    for frame_idx, masks in video_segments.items():
+        if obj_id in masks:
+            removed[frame_idx] = masks.pop(obj_id)
+    return removed
+
+
+def insert_object_masks(video_segments, obj_id, frame_masks):
+    if isinstance(video_segments, PackedSegments):
+        video_segments.insert_object(obj_id, frame_masks)
+        return
+    for frame_idx, mask in frame_masks.items():
+        video_segments.setdefault(frame_idx, {})[obj_id] = mask
+
+
+def snapshot_segments(video_segments):
+    # Shallow copies only: masks are never modified in place (label maps copy their image
+    # on the next write), so the background writer can read them while the UI keeps editing
+    if isinstance(video_segments, PackedSegments):
+        # Frames still packed (in the source archive or spilled to disk) are copied over as
+        # raw bytes
+        return {frame_idx: (video_segments.loaded[frame_idx].copy() if frame_idx in video_segments.loaded else video_segments)
+                for frame_idx in video_segments}
+    return {frame_idx: masks.copy() for frame_idx, masks in video_segments.items()}
+
+
+def write_session(path, meta, current_masks, segments, memory=None, static_masks=None):
+    tmp_path = path + '.tmp'
+    with profiler.span('session.save'), zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=1) as archive:
+        archive.writestr('meta.json', json.dumps(meta))
+        archive.writestr('current.npz', pack_masks(current_masks))
+        if static_masks:
+            archive.writestr('static.npz', pack_masks(static_masks))
+        for frame_idx, masks in segments.items():
+            if isinstance(masks, PackedSegments):
+                data = masks.raw(frame_idx)
+                data = data if data is not None else pack_masks(masks[frame_idx])
+            else:
+                data = pack_masks(masks)
+            archive.writestr(segment_member(frame_idx), data)
+        if memory is not None:
+            buffer = io.BytesIO()
+            torch.save(memory, buffer)
+            archive.writestr('memory.pt', buffer.getvalue())
+    os.replace(tmp_path, path)
+    return path
+
+
+class SessionSaver:
+    # Runs write_session on a worker thread; a save requested while one is running is
+    # coalesced into a single follow-up save of the newest snapshot
+    def __init__(self):
+        self.thread = None
+        self.busy = False
+        self.next_job = None
+        self.lock = threading.Lock()
+        self.last_error = None
+        self.last_saved = None
+
+    def save(self, path, meta, current_masks, segments, memory=None, static_masks=None):
+        job = (path, meta, current_masks, segments, memory, static_masks)
+        with self.lock:
+            if self.busy:
+                self.next_job = job
+                return
+            self.busy = True
+            self.thread = threading.Thread(target=self.run, args=(job,), daemon=True)
+            self.thread.start()
+
+    def run(self, job):
+        while job is not None:
+            try:
+                self.last_saved = write_session(*job)
+                self.last_error = None
+                print(f"Session saved to {job[0]}")
+            except Exception as e:
+                self.last_error = e
+                print(f"Error saving session: {str(e)}")
+            with self.lock:
+                job, self.next_job = self.next_job, None
+                if job is None:
+                    self.busy = False
+
+    def wait(self):
+        thread = self.thread
+        if thread is not None:
+            thread.join()
+
+
+def read_session(path):
+    with zipfile.ZipFile(path, 'r') as archive:
+        meta = json.loads(archive.read('meta.json'))
+        if meta.get('version') != SESSION_VERSION:
+            raise ValueError(f"Unsupported session version: {meta.get('version')}")
+        current_masks = unpack_masks(archive.read('current.npz'))
+        static_masks = unpack_masks(archive.read('static.npz')) if 'static.npz' in archive.namelist() else {}
+        memory = None
+        if 'memory.pt' in archive.namelist():
+            memory = torch.load(io.BytesIO(archive.read('memory.pt')), map_location='cpu', weights_only=True)
+    return meta, current_masks, LazySegments(path), memory, static_masks
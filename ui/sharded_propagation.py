@@ -0,0 +1,195 @@
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import torch
+from profiler import profiler
+from frame_source import open_frame_source
+from mask_utils import as_sparse, mask_iou
+from sam2_predictor import SAM2Predictor
+
+# Sharded propagation for "Propagate and Export All". The video is split into windows that
+# start on prompted frames (keyframes) and overlap the next window by a few frames; each
+# window is propagated in its own worker process with its own model and inference state,
+# so long videos finish in roughly length / workers. Windows are then stitched in order:
+#   - object ids of a window are matched to the ids already stitched by mean mask IoU over
+#     the overlap, so an object keeps one id across windows
+#   - objects the previous window tracked into the overlap but that have no prompts in the
+#     next window are carried on: the next window is propagated again for just those
+#     objects, seeded with their mask on its first frame. Carrying is sequential, so a
+#     video prompted only on frame 0 gains nothing from sharding; prompt objects on
+#     keyframes spread over the video to let every window start right away.
+
+DEFAULT_OVERLAP = 8
+STITCH_IOU = 0.5
+
+
+def default_workers():
+    if torch.cuda.is_available():
+        return max(1, torch.cuda.device_count())
+    return max(1, min(4, (os.cpu_count() or 1) // 2))
+
+
+def plan_shards(num_frames, keyframes, num_workers, overlap=DEFAULT_OVERLAP):
+    # Windows (start, end): the first starts at frame 0, later ones on the keyframe closest
+    # to an even split, each running into the next window by overlap frames
+    starts = [0]
+    for k in range(1, num_workers):
+        target = k * num_frames // num_workers
+        candidates = [f for f in keyframes if starts[-1] + overlap < f < num_frames]
+        if not candidates:
+            break
+        start = min(candidates, key=lambda f: abs(f - target))
+        if start > starts[-1]:
+            starts.append(start)
+    ends = [min(start + overlap, num_frames) for start in starts[1:]] + [num_frames]
+    return list(zip(starts, ends))
+
+
+def init_worker(counter):
+    # Pins each worker process to one GPU, round robin
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    if torch.cuda.is_available() and torch.cuda.device_count() > 1:
+        torch.cuda.set_device(index % torch.cuda.device_count())
+
+
+def run_shard(job):
+    # Worker process: propagates one window and returns {frame_idx: (masks, scores)} keyed
+    # by video frame. The loaded model stays cached in the worker for the next job.
+    start, end = job['frame_range']
+    session = job['session_factory']()
+    session.initialize_predictor(open_frame_source(job['video_path']), frame_range=(start, end))
+    session.replay_prompts([dict(entry, frame_idx=entry['frame_idx'] - start) for entry in job['prompts']])
+    for obj_id, mask in job['seed_masks'].items():
+        session.add_mask_prompt(0, obj_id, mask)
+    frames = {}
+    for frame_idx, frame_masks, scores in session.propagate_frames(0, tracked_objects=job['tracked_objects']):
+        frames[start + frame_idx] = (dict(frame_masks), scores)
+    return frames
+
+
+def match_ids(stitched, shard_frames, overlap_frames, threshold=STITCH_IOU):
+    # Maps each object id of a window to an already stitched id by mean IoU over the
+    # overlap; ties go to the same id, and ids without a match keep their own
+    totals = {}
+    for frame_idx in overlap_frames:
+        previous = stitched.get(frame_idx, {})
+        for obj_id, mask in shard_frames.get(frame_idx, ({}, {}))[0].items():
+            if as_sparse(mask).area == 0:
+                continue
+            for other_id, other_mask in previous.items():
+                if as_sparse(other_mask).area > 0:
+                    totals[(obj_id, other_id)] = totals.get((obj_id, other_id), 0.0) + mask_iou(mask, other_mask)
+
+    mapping, taken = {}, set()
+    pairs = sorted(totals.items(), key=lambda item: (item[1], item[0][0] == item[0][1]), reverse=True)
+    for (obj_id, other_id), total in pairs:
+        if total / max(len(overlap_frames), 1) < threshold:
+            break
+        if obj_id not in mapping and other_id not in taken:
+            mapping[obj_id] = other_id
+            taken.add(other_id)
+
+    local_ids = {obj_id for masks, _ in shard_frames.values() for obj_id in masks}
+    for obj_id in sorted(local_ids - set(mapping)):
+        if obj_id in taken:
+            print(f"Sharded propagation: dropped object {obj_id} of a later window, its id is matched to another object")
+            continue
+        mapping[obj_id] = obj_id
+    return mapping
+
+
+def merge_shard(stitched, stitched_scores, shard_frames, mapping):
+    for frame_idx, (masks, scores) in shard_frames.items():
+        frame = stitched.setdefault(frame_idx, {})
+        frame_scores = stitched_scores.setdefault(frame_idx, {})
+        for obj_id, mask in masks.items():
+            if obj_id in mapping:
+                frame[mapping[obj_id]] = mask
+                if obj_id in scores:
+                    frame_scores[mapping[obj_id]] = scores[obj_id]
+
+
+def propagate_sharded(predictor, frame_source, num_workers=None, overlap=DEFAULT_OVERLAP, tracked_objects=None,
+                      progress_callback=None, session_factory=None):
+    # Propagates the whole video with the prompts given to predictor so far and returns
+    # video_segments, in a store from predictor.segments_factory; predictor's geometry, quality flags and object spans are updated as
+    # if it had propagated the video itself. Workers always run the model locally.
+    session_factory = session_factory or SAM2Predictor
+    prompts = predictor.compacted_prompt_log()
+    if not prompts:
+        raise ValueError("Sharded propagation needs at least one prompted object")
+    num_frames = len(frame_source)
+    keyframes = sorted({entry['frame_idx'] for entry in prompts})
+    shards = plan_shards(num_frames, keyframes, num_workers or default_workers(), overlap)
+    print(f"Propagating {num_frames} frames in {len(shards)} windows: {shards}")
+
+    def make_job(start, end, seed_masks):
+        return {
+            'video_path': frame_source.path,
+            'frame_range': (start, end),
+            'prompts': [entry for entry in prompts if start <= entry['frame_idx'] < end] if not seed_masks else [],
+            'seed_masks': seed_masks,
+            'tracked_objects': tracked_objects,
+            'session_factory': session_factory,
+        }
+
+    total_work = sum(end - start for start, end in shards)
+    done_work = [0]
+
+    def wait_for(futures):
+        # futures maps future -> frames of work; polls so the caller's progress callback
+        # keeps the UI responsive
+        pending = set(futures)
+        while pending:
+            finished, pending = wait(pending, timeout=0.2, return_when=FIRST_COMPLETED)
+            for future in finished:
+                done_work[0] += futures[future]
+            if progress_callback:
+                progress_callback(min(done_work[0], total_work) * num_frames // max(total_work, 1))
+        return {future: future.result() for future in futures}
+
+    context = multiprocessing.get_context('spawn')
+    with profiler.span('propagate.sharded'), ProcessPoolExecutor(max_workers=len(shards), mp_context=context,
+                                                                  initializer=init_worker, initargs=(context.Value('i', 0),)) as pool:
+        shard_futures = {pool.submit(run_shard, make_job(start, end, {})): index for index, (start, end) in enumerate(shards)}
+        results = wait_for({future: shards[index][1] - shards[index][0] for future, index in shard_futures.items()})
+        shard_results = [{} for _ in shards]
+        for future, index in shard_futures.items():
+            shard_results[index] = results[future]
+
+        stitched, stitched_scores = {}, {}
+        for index, (start, end) in enumerate(shards):
+            shard_frames = shard_results[index]
+            if index == 0:
+                merge_shard(stitched, stitched_scores, shard_frames, {obj_id: obj_id for masks, _ in shard_frames.values() for obj_id in masks})
+                continue
+            overlap_frames = range(start, shards[index - 1][1])
+            mapping = match_ids(stitched, shard_frames, overlap_frames)
+            merge_shard(stitched, stitched_scores, shard_frames, mapping)
+
+            # Objects still visible where this window starts but absent from it
+            matched = set(mapping.values())
+            carried = {obj_id: mask for obj_id, mask in stitched.get(start, {}).items()
+                       if obj_id not in matched and as_sparse(mask).area > 0}
+            if carried:
+                total_work += end - start
+                carry_future = pool.submit(run_shard, make_job(start, end, carried))
+                carry_frames = wait_for({carry_future: end - start})[carry_future]
+                merge_shard(stitched, stitched_scores, carry_frames, {obj_id: obj_id for obj_id in carried})
+
+    predictor.object_spans = {}
+    video_segments = predictor.segments_factory()
+    for frame_idx in sorted(stitched):
+        frame_masks = stitched.pop(frame_idx)
+        video_segments[frame_idx] = frame_masks
+        predictor.last_output_frame = frame_idx
+        with profiler.span('propagate.geometry'):
+            predictor.geometry.update_frame(frame_idx, list(frame_masks), list(frame_masks.values()))
+        with profiler.span('propagate.quality'):
+            predictor.quality.update_frame(frame_idx, frame_masks, video_segments.get(frame_idx - 1), stitched_scores.get(frame_idx, {}))
+        predictor.update_object_spans(frame_idx, frame_masks)
+    if progress_callback:
+        progress_callback(num_frames)
+    return video_segments
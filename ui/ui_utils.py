@@ -1,12 +1,17 @@
 from PyQt5.QtWidgets import (QPushButton, QVBoxLayout, QHBoxLayout, QWidget, QLayout,
-                             QCheckBox, QStyledItemDelegate)
+                             QCheckBox, QStyledItemDelegate, QStyle, QStyleOptionButton, QApplication)
 from PyQt5.QtGui import QColor
-from PyQt5.QtCore import Qt, pyqtSignal
+from PyQt5.QtCore import Qt, pyqtSignal, QEvent, QRect, QTimer
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
+import numpy as np
 import cv2
 
+# Zoom limits and the tile grid crops of pyramid levels are aligned to
+MAX_ZOOM = 32.0
+TILE_SIZE = 256
+
 def create_button(text, callback):
     button = QPushButton(text)
     button.clicked.connect(callback)
@@ -58,7 +63,80 @@ class AlignDelegate(QStyledItemDelegate):
         option.displayAlignment = Qt.AlignCenter
         super().paint(painter, option, index)
 
+class CheckBoxDelegate(QStyledItemDelegate):
+    # Draws a model's check state as a centered checkbox, without a widget per cell
+    def check_rect(self, option):
+        style = QApplication.style()
+        check_option = QStyleOptionButton()
+        size = style.subElementRect(QStyle.SE_CheckBoxIndicator, check_option, None).size()
+        x = option.rect.x() + (option.rect.width() - size.width()) // 2
+        y = option.rect.y() + (option.rect.height() - size.height()) // 2
+        return QRect(x, y, size.width(), size.height())
+
+    def paint(self, painter, option, index):
+        check_option = QStyleOptionButton()
+        check_option.rect = self.check_rect(option)
+        check_option.state = QStyle.State_Enabled
+        check_option.state |= QStyle.State_On if index.data(Qt.CheckStateRole) == Qt.Checked else QStyle.State_Off
+        QApplication.style().drawControl(QStyle.CE_CheckBox, check_option, painter)
+
+    def editorEvent(self, event, model, option, index):
+        if not index.flags() & Qt.ItemIsUserCheckable:
+            return False
+        if event.type() == QEvent.MouseButtonRelease and event.button() == Qt.LeftButton:
+            if not self.check_rect(option).contains(event.pos()):
+                return False
+        elif event.type() == QEvent.MouseButtonDblClick:
+            return True
+        elif not (event.type() == QEvent.KeyPress and event.key() in (Qt.Key_Space, Qt.Key_Select)):
+            return False
+        state = Qt.Unchecked if index.data(Qt.CheckStateRole) == Qt.Checked else Qt.Checked
+        return model.setData(index, state, Qt.CheckStateRole)
+
+class ImagePyramid:
+    # RGB copies of a frame at halving resolutions (level 0 is the frame itself), built on
+    # first use. A view draws only the tiles it covers from the coarsest level that still
+    # has at least one image pixel per screen pixel.
+    def __init__(self, image):
+        self.source = image
+        self.shape = image.shape[:2]
+        self.levels = [cv2.cvtColor(image, cv2.COLOR_BGR2RGB)]
+
+    def level(self, index):
+        while len(self.levels) <= index:
+            previous = self.levels[-1]
+            size = (max(previous.shape[1] // 2, 1), max(previous.shape[0] // 2, 1))
+            self.levels.append(cv2.resize(previous, size, interpolation=cv2.INTER_AREA))
+        return self.levels[index]
+
+    def level_for(self, view_width, screen_width):
+        scale = view_width / max(screen_width, 1)
+        index = int(np.floor(np.log2(scale))) if scale >= 2 else 0
+        # Stop before levels get smaller than a tile
+        while index > 0 and min(self.shape) >> index < TILE_SIZE:
+            index -= 1
+        return index
+
+    def region(self, index, region):
+        # Crop of level index covering region = (x0, y0, x1, y1) in frame pixels, widened to
+        # whole tiles, with its imshow extent in frame coordinates
+        level = self.level(index)
+        height, width = self.shape
+        sx, sy = width / level.shape[1], height / level.shape[0]
+        x0, y0, x1, y1 = region
+        lx0 = max(int(x0 / sx) // TILE_SIZE * TILE_SIZE, 0)
+        ly0 = max(int(y0 / sy) // TILE_SIZE * TILE_SIZE, 0)
+        lx1 = min(-(-int(np.ceil(x1 / sx)) // TILE_SIZE) * TILE_SIZE, level.shape[1])
+        ly1 = min(-(-int(np.ceil(y1 / sy)) // TILE_SIZE) * TILE_SIZE, level.shape[0])
+        extent = (lx0 * sx - 0.5, lx1 * sx - 0.5, ly1 * sy - 0.5, ly0 * sy - 0.5)
+        return level[ly0:ly1, lx0:lx1], extent
+
+
 class MatplotlibWidget(QWidget):
+    # Frame display with wheel zoom around the cursor, middle-button drag to pan and F to
+    # show the whole frame again. Axes stay in frame pixel coordinates, so click positions
+    # need no mapping. While zooming or panning only the axis limits change; the frame and
+    # overlays are redrawn for the new view once the gesture settles (view_changed).
     def __init__(self, parent=None):
         super().__init__(parent)
         self.figure = Figure(figsize=(16, 9), dpi=100)
@@ -70,17 +148,125 @@ class MatplotlibWidget(QWidget):
         self.figure.subplots_adjust(left=0, right=1, top=1, bottom=0, wspace=0, hspace=0)
         self.setMinimumSize(1600, 900)  # Set fixed size for the widget
 
+        self.pyramid = None
+        # Visible part of the frame as (x0, y0, x1, y1), None for the whole frame
+        self.view = None
+        # Area drawn around the view (so short pans need no redraw) and the pyramid
+        # level's pixel step, for overlays to match
+        self.render_region = None
+        self.render_step = 1
+        self.view_changed = None
+        self.pan_start = None
+        self.redraw_timer = QTimer(self)
+        self.redraw_timer.setSingleShot(True)
+        self.redraw_timer.setInterval(120)
+        self.redraw_timer.timeout.connect(self.notify_view_changed)
+        self.canvas.mpl_connect('scroll_event', self.on_scroll)
+        self.canvas.mpl_connect('button_press_event', self.on_press)
+        self.canvas.mpl_connect('motion_notify_event', self.on_motion)
+        self.canvas.mpl_connect('button_release_event', self.on_release)
+
     def clear(self):
         self.ax.clear()
         self.ax.set_axis_off()
         self.canvas.draw()
 
     def show_image(self, image):
-        self.clear()
-        self.ax.imshow(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
-        self.ax.set_xlim(0, image.shape[1])
-        self.ax.set_ylim(image.shape[0], 0)  # Invert y-axis for correct image orientation
-        self.canvas.draw()
+        # Clears the axes and draws the visible part of image; the caller draws the canvas
+        # once its overlays are added
+        if self.pyramid is None or self.pyramid.source is not image:
+            if self.pyramid is not None and self.pyramid.shape != image.shape[:2]:
+                self.view = None
+            self.pyramid = ImagePyramid(image)
+        self.ax.clear()
+        self.ax.set_axis_off()
+
+        x0, y0, x1, y1 = self.visible_region()
+        # Half a view of margin on every side
+        margin_x, margin_y = (x1 - x0) / 2, (y1 - y0) / 2
+        height, width = self.pyramid.shape
+        self.render_region = (max(int(x0 - margin_x), 0), max(int(y0 - margin_y), 0),
+                              min(int(np.ceil(x1 + margin_x)), width), min(int(np.ceil(y1 + margin_y)), height))
+        level = self.pyramid.level_for(x1 - x0, self.canvas.width())
+        self.render_step = 2 ** level
+        crop, extent = self.pyramid.region(level, self.render_region)
+        self.ax.imshow(crop, extent=extent)
+        self.apply_view()
+
+    def visible_region(self):
+        if self.view is not None:
+            return self.view
+        height, width = self.pyramid.shape
+        return (0, 0, width, height)
+
+    def apply_view(self):
+        x0, y0, x1, y1 = self.visible_region()
+        self.ax.set_xlim(x0, x1)
+        self.ax.set_ylim(y1, y0)  # Invert y-axis for correct image orientation
+
+    def set_view(self, x0, y0, x1, y1):
+        height, width = self.pyramid.shape
+        view_width, view_height = x1 - x0, y1 - y0
+        if view_width >= width or view_height >= height:
+            self.view = None
+            return
+        # Keep the view inside the frame
+        x0 = min(max(x0, 0), width - view_width)
+        y0 = min(max(y0, 0), height - view_height)
+        self.view = (x0, y0, x0 + view_width, y0 + view_height)
+
+    def zoom(self, factor, center=None):
+        if self.pyramid is None:
+            return
+        height, width = self.pyramid.shape
+        x0, y0, x1, y1 = self.visible_region()
+        new_width = min(max((x1 - x0) / factor, width / MAX_ZOOM), width)
+        new_height = new_width * height / width
+        cx, cy = center if center is not None else ((x0 + x1) / 2, (y0 + y1) / 2)
+        # The point under the cursor stays where it is
+        nx0 = cx - (cx - x0) * new_width / (x1 - x0)
+        ny0 = cy - (cy - y0) * new_height / (y1 - y0)
+        self.set_view(nx0, ny0, nx0 + new_width, ny0 + new_height)
+        self.view_moved()
+
+    def reset_view(self):
+        self.view = None
+        if self.pyramid is not None:
+            self.view_moved()
+
+    def view_moved(self):
+        self.apply_view()
+        self.canvas.draw_idle()
+        self.redraw_timer.start()
+
+    def notify_view_changed(self):
+        if self.view_changed is not None:
+            self.view_changed()
+
+    def on_scroll(self, event):
+        center = (event.xdata, event.ydata) if event.inaxes == self.ax else None
+        self.zoom(1.25 ** event.step, center)
+
+    def on_press(self, event):
+        if event.button == 2 and self.pyramid is not None:
+            self.pan_start = (event.x, event.y, self.visible_region())
+
+    def on_motion(self, event):
+        if self.pan_start is None:
+            return
+        start_x, start_y, (x0, y0, x1, y1) = self.pan_start
+        bbox = self.ax.get_window_extent()
+        # Screen y grows upwards, frame y downwards
+        dx = (event.x - start_x) * (x1 - x0) / bbox.width
+        dy = (event.y - start_y) * (y1 - y0) / bbox.height
+        self.set_view(x0 - dx, y0 + dy, x1 - dx, y1 + dy)
+        self.apply_view()
+        self.canvas.draw_idle()
+
+    def on_release(self, event):
+        if event.button == 2 and self.pan_start is not None:
+            self.pan_start = None
+            self.redraw_timer.start()
 
     def resizeEvent(self, event):
         width = max(event.size().width(), 1600)
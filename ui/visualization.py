@@ -1,10 +1,16 @@
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
-import cv2
 from PyQt5.QtWidgets import QWidget, QVBoxLayout
+from mask_utils import mask_geometry, simplification, SparseMask
 
-def show_mask(mask, ax, obj_id=None, random_color=False):
+def intersects(bbox_xyxy, region):
+    return (region is None or (bbox_xyxy[0] < region[2] and bbox_xyxy[2] > region[0] and
+                               bbox_xyxy[1] < region[3] and bbox_xyxy[3] > region[1]))
+
+def show_mask(mask, ax, obj_id=None, random_color=False, region=None, step=1):
+    # region = (x0, y0, x1, y1) limits drawing to that part of the frame; step draws every
+    # step-th pixel, matching the pyramid level the frame is shown at
     if torch.is_tensor(mask):
         mask = mask.cpu().numpy()
     
@@ -14,10 +20,36 @@ def show_mask(mask, ax, obj_id=None, random_color=False):
         cmap = plt.get_cmap("tab20")
         cmap_idx = 0 if obj_id is None else obj_id
         color = np.array([*cmap(cmap_idx)[:3], 0.6])
+
+    if isinstance(mask, SparseMask):
+        # Only the bbox crop is colored, placed over the frame with extent
+        if mask.area == 0 or not intersects(mask.bbox_xyxy, region):
+            return
+        x0, y0, x1, y1 = mask.bbox_xyxy
+        rx0, ry0, rx1, ry1 = region or mask.bbox_xyxy
+        cx0, cy0, cx1, cy1 = max(x0, rx0), max(y0, ry0), min(x1, rx1), min(y1, ry1)
+        crop = mask.crop[cy0 - y0:cy1 - y0:step, cx0 - x0:cx1 - x0:step]
+        h, w = crop.shape
+        ax.imshow(crop[..., None] * color.reshape(1, 1, -1),
+                  extent=(cx0 - 0.5, cx0 + w * step - 0.5, cy0 + h * step - 0.5, cy0 - 0.5))
+        return
+
     h, w = mask.shape[-2:]
     mask_image = mask.reshape(h, w, 1) * color.reshape(1, 1, -1)
     ax.imshow(mask_image)
     
+def show_label_map(label_map, ax, obj_ids, region=None, step=1):
+    # Every listed object of a LabelMap in one image: a color table indexed by label value
+    cmap = plt.get_cmap("tab20")
+    lut = np.zeros((len(label_map.obj_ids) + 1, 4), dtype=np.uint8)
+    for obj_id in obj_ids:
+        lut[label_map.values[obj_id]] = [int(c * 255) for c in cmap(obj_id)[:3]] + [153]
+    height, width = label_map.shape
+    x0, y0, x1, y1 = region or (0, 0, width, height)
+    labels = label_map.labels[y0:y1:step, x0:x1:step]
+    h, w = labels.shape
+    ax.imshow(lut[labels], extent=(x0 - 0.5, x0 + w * step - 0.5, y0 + h * step - 0.5, y0 - 0.5))
+
 def show_points(coords, labels, ax, marker_size=200):
     pos_points = coords[labels==1]
     neg_points = coords[labels==0]
@@ -26,17 +58,23 @@ def show_points(coords, labels, ax, marker_size=200):
     if len(neg_points) > 0:
         ax.scatter(neg_points[:, 0], neg_points[:, 1], color='red', marker='*', s=marker_size, edgecolor='white', linewidth=1.25)
 
-def show_mask_with_contours_and_bbox(mask, ax, obj_id=None, category_name=None, random_color=False):
-    if len(mask.shape) > 2:
-        mask = mask.squeeze()
-    mask_binary = (mask > 0).astype(np.uint8) * 255
-    contours, _ = cv2.findContours(mask_binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    
-    for contour in contours:
-        contour = contour.reshape(-1, 2)
-        ax.plot(contour[:, 0], contour[:, 1], color="yellow", linewidth=2)
+def show_mask_with_contours_and_bbox(mask, ax, obj_id=None, category_name=None, random_color=False, geometry=None, region=None,
+                                     step=1):
+    if geometry is None:
+        geometry = mask_geometry(mask)
+    x, y, w, h = geometry.bbox
+    if not intersects([x, y, x + w, y + h], region):
+        return [x, y, x+w, y+h]
+
+    # Outlines are simplified like exported polygons, or more when the frame is drawn
+    # from a reduced pyramid level (deviations under half an image pixel aren't visible),
+    # and drawn as one closed line broken by NaNs
+    contours = geometry.simplified_contours(max(simplification.tolerance, step / 2) if step > 1 else None)
+    if contours:
+        outline = np.concatenate([np.vstack([contour.reshape(-1, 2), contour[:1].reshape(1, 2), [[np.nan, np.nan]]])
+                                  for contour in contours])
+        ax.plot(outline[:, 0], outline[:, 1], color="yellow", linewidth=2)
     
-    x, y, w, h = cv2.boundingRect(mask_binary)
     rect = plt.Rectangle((x, y), w, h, linewidth=2, edgecolor='red', facecolor='none')
     ax.add_patch(rect)
     